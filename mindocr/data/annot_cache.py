@@ -0,0 +1,198 @@
+'''
+Compiled columnar store of parsed annotation data, cached as a memory-mapped file.
+
+The string fields of the parsed data items (e.g., img_path and label) are kept as utf-8 bytes columns with offsets,
+instead of a list of dicts, so that loading a cached dataset costs O(1), and forked dataloader workers share the pages
+rather than copying python objects on access.
+'''
+from typing import Callable, List, Optional
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy as np
+
+__all__ = ['AnnotationTable', 'load_annotation_table']
+
+_CACHE_MAGIC = b'MOCRANN1'
+_CACHE_VERSION = 1
+_HEADER = struct.Struct('<8sQ')  # magic, meta length
+_ALIGN = 8
+
+
+def _file_signature(path, with_hash=True):
+    stat = os.stat(path)
+    sig = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        sig['sha1'] = sha1.hexdigest()
+    return sig
+
+
+class AnnotationTable(object):
+    '''
+    Columnar table of annotation data items, each of which is a dict of strings.
+
+    Args:
+        columns (dict): column name -> (bytes data as np.uint8 array, offsets as np.int64 array of length N + 1)
+        file_ids (np.ndarray): index of the label file that each item comes from, in shape [N]
+        indices (np.ndarray): optional, the items (and their order) to present. All items if None.
+    '''
+    def __init__(self, columns: dict, file_ids: np.ndarray, indices: Optional[np.ndarray] = None):
+        self.columns = columns
+        self.file_ids = file_ids
+        self.indices = indices
+
+    @classmethod
+    def from_items(cls, items: List[dict], file_ids: List[int]):
+        ''' build a table from parsed data items, or return None if any item has a non-string value or
+        the items do not share the same keys '''
+        if len(items) == 0:
+            return None
+        keys = list(items[0].keys())
+        columns = {}
+        for k in keys:
+            values = []
+            for item in items:
+                v = item.get(k)
+                if not isinstance(v, str) or len(item) != len(keys):
+                    return None
+                values.append(v.encode('utf-8'))
+            offsets = np.zeros(len(values) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(v) for v in values])
+            columns[k] = (np.frombuffer(b''.join(values), dtype=np.uint8), offsets)
+        return cls(columns, np.array(file_ids, dtype=np.int32))
+
+    def num_items(self):
+        ''' the number of all items, regardless of indices '''
+        return len(self.file_ids)
+
+    def take(self, indices: np.ndarray):
+        ''' return a table presenting the items at the given indices, sharing the data '''
+        return AnnotationTable(self.columns, self.file_ids, np.asarray(indices, dtype=np.int64))
+
+    def __len__(self):
+        return self.num_items() if self.indices is None else len(self.indices)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if self.indices is not None:
+            index = self.indices[index]
+        item = {}
+        for k, (data, offsets) in self.columns.items():
+            item[k] = data[offsets[index]: offsets[index + 1]].tobytes().decode('utf-8')
+        return item
+
+    def save(self, path: str, meta: dict):
+        ''' save the table (all items) with meta info into path, written atomically '''
+        arrays = [('file_ids', self.file_ids)]
+        for k, (data, offsets) in self.columns.items():
+            arrays += [(f'{k}.data', data), (f'{k}.offsets', offsets)]
+
+        meta = dict(meta, version=_CACHE_VERSION, arrays=[])
+        pos = 0
+        for name, arr in arrays:
+            meta['arrays'].append({'name': name, 'dtype': arr.dtype.str, 'count': len(arr), 'offset': pos})
+            pos += -(-arr.nbytes // _ALIGN) * _ALIGN
+        meta_bytes = json.dumps(meta).encode('utf-8')
+        meta_bytes += b' ' * (-(_HEADER.size + len(meta_bytes)) % _ALIGN)
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(_CACHE_MAGIC, len(meta_bytes)))
+            f.write(meta_bytes)
+            for name, arr in arrays:
+                f.write(arr.tobytes())
+                f.write(b'\0' * (-arr.nbytes % _ALIGN))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def read_meta(path: str):
+        ''' return (meta, data start position) of a saved table, or (None, None) if the file is invalid '''
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                return None, None
+            magic, meta_len = _HEADER.unpack(header)
+            if magic != _CACHE_MAGIC:
+                return None, None
+            meta = json.loads(f.read(meta_len).decode('utf-8'))
+        if meta.get('version') != _CACHE_VERSION:
+            return None, None
+        return meta, _HEADER.size + meta_len
+
+    @classmethod
+    def load(cls, path: str, meta: dict, data_pos: int):
+        ''' memory-map a saved table '''
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        arrays = {}
+        for a in meta['arrays']:
+            arrays[a['name']] = np.frombuffer(mm, dtype=a['dtype'], count=a['count'], offset=data_pos + a['offset'])
+        columns = {}
+        for name in arrays:
+            if name.endswith('.data'):
+                k = name[:-len('.data')]
+                columns[k] = (arrays[name], arrays[k + '.offsets'])
+        return cls(columns, arrays['file_ids'])
+
+
+def load_annotation_table(label_files: List[str],
+                          parse_fn: Callable[[str], dict],
+                          cache_dir: Optional[str] = None,
+                          cache_key: str = ''):
+    '''
+    Parse the label files into an AnnotationTable, using the compiled cache in cache_dir if it is valid.
+
+    The cache is valid if every label file has the same size and mtime as when it was compiled, or otherwise the same
+    sha1 hash (e.g., the files are copied or touched).
+
+    Args:
+        label_files: annotation file paths
+        parse_fn: function to parse a line in the label files into a data item, i.e. a dict of strings
+        cache_dir: directory to save the compiled cache. If None, no cache is used.
+        cache_key: extra info to identify the cache, which should change if parse_fn output changes, e.g., data_dir
+    Returns:
+        AnnotationTable, or None if the parsed data items can not be stored in columns
+    '''
+    cache_path = None
+    if cache_dir is not None:
+        name = json.dumps([[os.path.abspath(f) for f in label_files], cache_key])
+        cache_path = os.path.join(cache_dir, hashlib.sha1(name.encode('utf-8')).hexdigest()[:20] + '.annot')
+        if os.path.exists(cache_path):
+            meta, data_pos = AnnotationTable.read_meta(cache_path)
+            if meta is not None and meta.get('cache_key') == cache_key and len(meta['label_files']) == len(label_files):
+                valid = True
+                for f, sig in zip(label_files, meta['label_files']):
+                    cur = _file_signature(f, with_hash=False)
+                    if cur['size'] != sig['size']:
+                        valid = False
+                    elif cur['mtime_ns'] != sig['mtime_ns']:
+                        valid = _file_signature(f)['sha1'] == sig['sha1']
+                    if not valid:
+                        break
+                if valid:
+                    return AnnotationTable.load(cache_path, meta, data_pos)
+
+    items, file_ids = [], []
+    for idx, annot_file in enumerate(label_files):
+        with open(annot_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                items.append(parse_fn(line))
+                file_ids.append(idx)
+    table = AnnotationTable.from_items(items, file_ids)
+
+    if table is not None and cache_path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            table.save(cache_path, {'cache_key': cache_key,
+                                    'label_files': [_file_signature(f) for f in label_files]})
+            print(f'INFO: annotation cache of {label_files} saved in {cache_path}')
+        except OSError as e:
+            print(f'WARNING: failed to save annotation cache in {cache_path}: {e}')
+    return table
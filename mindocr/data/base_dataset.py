@@ -1,8 +1,13 @@
 from typing import Union, List
 import random
 import os
+import numpy as np
 
 from .transforms.transforms_factory import create_transforms, run_transforms
+from .transforms.key_schema import get_output_keys
+from .transforms.profiler import TransformProfiler
+from .annot_cache import load_annotation_table
+from ..utils.polygons import RaggedPolygons
 
 __all__ = ['BaseDataset']
 
@@ -21,6 +26,13 @@ class BaseDataset(object):
                     e.g., [{'DecodeImage': {'img_mode': 'BGR', 'channel_first': False}}]
             -       if None, default transform pipeline for text detection will be taken.
         output_keys (list): required, indicates the keys in data dict that are expected to output for dataloader. if None, all data keys will be used for return. 
+        annot_cache_dir (str): directory to save the compiled annotation cache, e.g. ~/.cache/mindocr/annotations.
+            The label files are parsed (and the images are checked for existence) only once, then loaded from the
+            memory-mapped cache as long as the label files and data_dir are unchanged. Images removed or added after
+            the cache is compiled are not checked again. If None, no cache is used and only the lines sampled by
+            sample_ratios are parsed, every time. Default: None
+        transform_profile_dir (str): if given, the wall time and memory of each transform class are recorded into this
+            directory by TransformProfiler, for all dataloader workers. See `report_transform_profile`.
         global_config: additional info, used in data transformation, possible keys:
             - character_dict_path
             
@@ -49,11 +61,14 @@ class BaseDataset(object):
             shuffle: bool = None,
             transform_pipeline: List[dict] = None, 
             output_keys: List[str] = None,
+            annot_cache_dir: str = None,
+            transform_profile_dir: str = None,
             #global_config: dict = None,
             **kwargs
             ):
         # check arg validation 
         self.data_dir = data_dir
+        self.annot_cache_dir = os.path.expanduser(annot_cache_dir) if annot_cache_dir is not None else None
         assert isinstance(shuffle, bool), f'type error of {shuffle}'
         if isinstance(label_files, str):
             label_files = [label_files]
@@ -69,25 +84,31 @@ class BaseDataset(object):
 
 
         # create transform
+        input_keys = list(self.data_list[0].keys())
         if transform_pipeline is not None:
-            self.transforms = create_transforms(transform_pipeline) #, global_config=global_config)
+            self.transforms = create_transforms(transform_pipeline, input_keys=input_keys, output_keys=output_keys)
         else:
             raise ValueError('No transform pipeline is specified!')
+        self.transform_profiler = TransformProfiler(transform_profile_dir) if transform_profile_dir is not None else None
 
-        # prefetch the data keys, to fit GeneratorDataset
-        _data = self.data_list[0]
-        _data = run_transforms(_data, transforms=self.transforms)
-        _available_keys = list(_data.keys())
-        
-        if output_keys is None:
-            self.output_keys = _available_keys   
+        if output_keys is not None and get_output_keys(self.transforms, input_keys) is not None:
+            # checked by create_transforms with the key schema of the transforms, without running them
+            self.output_keys = list(output_keys)
         else:
-            self.output_keys = []
-            for k in output_keys:
-                if k in _data:
-                    self.output_keys.append(k)
-                else:
-                    raise ValueError(f'Key {k} does not exist in data (available keys: {_data.keys()}). Please check the name or the completeness transformation pipeline.')
+            # prefetch the data keys, to fit GeneratorDataset
+            _data = dict(self.data_list[0])
+            _data = run_transforms(_data, transforms=self.transforms)
+            _available_keys = list(_data.keys())
+        
+            if output_keys is None:
+                self.output_keys = _available_keys   
+            else:
+                self.output_keys = []
+                for k in output_keys:
+                    if k in _data:
+                        self.output_keys.append(k)
+                    else:
+                        raise ValueError(f'Key {k} does not exist in data (available keys: {_data.keys()}). Please check the name or the completeness transformation pipeline.')
                     
     def __len__(self):
         return len(self.data_list)
@@ -97,12 +118,15 @@ class BaseDataset(object):
         return self.output_keys
 
     def __getitem__(self, index):
-        data = self.data_list[index]
+        # the transforms modify the dict in place
+        data = dict(self.data_list[index])
         
         # perform transformation on data
-        data = run_transforms(data, transforms=self.transforms)
+        data = run_transforms(data, transforms=self.transforms, profiler=self.transform_profiler)
             
-        output_tuple = tuple(data[k] for k in self.output_keys) 
+        # RaggedPolygons are padded into arrays for the dataloader
+        output_tuple = tuple(data[k].to_padded() if isinstance(data[k], RaggedPolygons) else data[k]
+                             for k in self.output_keys)
 
         return output_tuple
 
@@ -114,11 +138,29 @@ class BaseDataset(object):
             shuffle: shuffle the data list
 
         Returns:
-            data (List[dict]): A list of annotation dict, which contains keys: img_path, annot...
+            data (Sequence[dict]): A list (or an AnnotationTable) of annotation dict, which contains keys: img_path, annot...
         '''
         if isinstance(sample_ratios, float):
             sample_ratios = [sample_ratios for _ in label_files]
 
+        # compile the annotation into columns, or load the compiled cache. Without annot_cache_dir, the lines are
+        # sampled before parsing as below, so only the sampled images are checked.
+        table = None
+        if self.annot_cache_dir is not None:
+            cache_key = f'{type(self).__name__}:{os.path.abspath(self.data_dir)}'
+            table = load_annotation_table(label_files, self._parse_annotation, self.annot_cache_dir, cache_key)
+        if table is not None:
+            # items of each label file are contiguous in the table
+            bounds = np.searchsorted(table.file_ids, np.arange(len(label_files) + 1))
+            indices = []
+            for idx in range(len(label_files)):
+                file_indices = np.arange(bounds[idx], bounds[idx + 1])
+                num = round(len(file_indices) * sample_ratios[idx])
+                if shuffle:
+                    file_indices = np.random.permutation(file_indices)
+                indices.append(file_indices[:num])
+            return table.take(np.concatenate(indices))
+
         # read annotation files
         data_lines = []
         for idx, annot_file in enumerate(label_files):
@@ -4,8 +4,23 @@ from addict import Dict
 from .det_dataset import DetDataset
 from .rec_dataset import RecDataset
 from .rec_lmdb_dataset import LMDBDataset
+from .rec_shard_dataset import RecShardDataset
+from .preprocess_cache import PreprocessCache
+from .shm_loader import SharedMemoryLoader, infer_max_rowsize, probe_samples
+
+supported_dataset_types = ['BaseDataset', 'DetDataset', 'RecDataset', 'LMDBDataset', 'RecShardDataset']
+
+
+def get_width_buckets(transform_pipeline):
+    ''' return the sorted width buckets of RecResizeImg in the transform pipeline, or None if not used '''
+    for transform_config in transform_pipeline or []:
+        if isinstance(transform_config, dict) and 'RecResizeImg' in transform_config:
+            params = transform_config['RecResizeImg'] or {}
+            if params.get('width_buckets') is not None:
+                max_width = params['image_shape'][1]
+                return sorted(set(w for w in params['width_buckets'] if w < max_width) | {max_width})
+    return None
 
-supported_dataset_types = ['BaseDataset', 'DetDataset', 'RecDataset', 'LMDBDataset']
 
 def build_dataset(
         dataset_config: dict,
@@ -22,9 +37,20 @@ def build_dataset(
             - data_dir: folder to the dataset. 
             - annot_file (optional for recognition): absolute file path to the annotation file
             - transform_pipeline (list[dict]): config dict for image and label transformation
+            - preprocess_cache_dir (optional): if given, the transformed samples are cached in this directory at the
+                first run and read from the cache afterwards. Only for deterministic pipelines without shuffle, e.g., eval.
         loader_config (dict): dataloader configuration containing keys:
             - batch_size: batch size for data loader 
             - drop_remainder: whether to drop the data in the last batch when the total of data can not be divided by the batch_size
+            - max_rowsize: size (MB) of the shared memory for a sample passed from the workers, or 'auto' to infer it
+                from the largest of a few samples spread over the dataset, which are loaded at build time.
+            - shared_memory_ring (optional): if True, the samples are loaded by the workers of SharedMemoryLoader, which
+                write the arrays into a preallocated ring of shared memory slots instead of pickling them. The slot size
+                is inferred from a few samples, or given by `ring_slot_size` (MB).
+            If `width_buckets` is set for RecResizeImg in the transform pipeline, the images (in CHW) of the same width
+            are batched together, so that each batch has a fixed shape and graph mode compiles once per bucket. Batches
+            of a bucket are emitted as it fills, i.e. in proportion to the bucket size. In training, the last partial
+            batch of each bucket is always dropped.
         num_shards: num of devices for distributed mode
         shard_id: device id 
         is_train: whether it is in training stage 
@@ -33,6 +59,9 @@ def build_dataset(
         data_loader (Dataset): dataloader to generate data batch 
     '''
     # build datasets
+    width_buckets = get_width_buckets(dataset_config.get('transform_pipeline'))
+    preprocess_cache_dir = dataset_config.pop('preprocess_cache_dir', None)
+    cache_key_config = dict(dataset_config, is_train=is_train)
     dataset_class_name = dataset_config.pop('type')
     assert dataset_class_name in supported_dataset_types, "Invalid dataset name"
     dataset_class = eval(dataset_class_name)
@@ -41,6 +70,9 @@ def build_dataset(
     
     dataset_args = dict(is_train=is_train, **dataset_config) 
     dataset = dataset_class(**dataset_args)
+    if preprocess_cache_dir is not None:
+        assert not dataset_config.get('shuffle', False), 'preprocess_cache_dir can not be used with shuffle=True.'
+        dataset = PreprocessCache(dataset, preprocess_cache_dir, cache_key_config, num_workers=loader_config['num_workers'])
 
     # create batch loader
     dataset_column_names = dataset.get_column_names()
@@ -50,22 +82,59 @@ def build_dataset(
     #ms.dataset.config.set_prefetch_size(int(loader_config['batch_size']))
     #print('prfectch size:', ms.dataset.config.get_prefetch_size())
 
-    # TODO: config multiprocess and shared memory
-    ds = ms.dataset.GeneratorDataset(
+    max_rowsize = loader_config['max_rowsize']
+    probed_samples = None
+    if max_rowsize == 'auto':
+        probed_samples = probe_samples(dataset)
+        max_rowsize = infer_max_rowsize(probed_samples)
+        print('==> Inferred max_rowsize (MB): ', max_rowsize)
+
+    if loader_config.get('shared_memory_ring', False):
+        source = SharedMemoryLoader(dataset,
+                    num_workers=loader_config['num_workers'],
+                    shuffle=loader_config['shuffle'],
+                    num_shards=num_shards,
+                    shard_id=shard_id,
+                    slot_size=loader_config.get('ring_slot_size'),
+                    samples=probed_samples,
+                    )
+        # shuffle and sharding are done by the source
+        ds = ms.dataset.GeneratorDataset(
+                    source,
+                    column_names=dataset_column_names,
+                    num_parallel_workers=1,
+                    python_multiprocessing=False,
+                    )
+    else:
+        ds = ms.dataset.GeneratorDataset(
                     dataset,
                     column_names=dataset_column_names,
                     num_parallel_workers=loader_config['num_workers'],
                     num_shards=num_shards,
                     shard_id=shard_id,
                     python_multiprocessing=True,
-                    max_rowsize =loader_config['max_rowsize'], 
+                    max_rowsize=max_rowsize,
                     shuffle=loader_config['shuffle'],
                     )
 
-    # TODO: set default value for drop_remainder and max_rowsize
+    if width_buckets is not None:
+        print('==> Batching by image width buckets: ', width_buckets)
+        # the loss is computed on a fixed batch size, so the last partial batch of each bucket is dropped in training
+        drop_remainder = True if is_train else loader_config['drop_remainder']
+        if drop_remainder and not loader_config['drop_remainder']:
+            print('WARNING: drop_remainder is set to True for the training batches of the width buckets')
+        # bucket i takes the images of width in [width_buckets[i-1] + 1, width_buckets[i]], which is width_buckets[i]
+        return ds.bucket_batch_by_length(['image'],
+                    bucket_boundaries=[w + 1 for w in width_buckets[:-1]],
+                    bucket_batch_sizes=[loader_config['batch_size']] * len(width_buckets),
+                    element_length_function=lambda image: image.shape[-1],
+                    drop_remainder=drop_remainder,
+                    )
+
+    # TODO: set default value for drop_remainder
     dataloader = ds.batch(loader_config['batch_size'],
                     drop_remainder=loader_config['drop_remainder'],
-                    max_rowsize=loader_config['max_rowsize'],
+                    max_rowsize=max_rowsize,
                     #num_parallel_workers=loader_config['num_workers'],
                     )
 
@@ -0,0 +1,176 @@
+'''
+Cache of the preprocessed (post-transform) samples of a dataset with a deterministic transform pipeline, e.g.,
+the eval dataset, so that the pipeline only runs once instead of every epoch.
+'''
+from typing import Optional
+import hashlib
+import json
+import multiprocessing
+import os
+import numpy as np
+
+__all__ = ['PreprocessCache']
+
+_ALIGN = 16
+
+# the dataset to preprocess in the spawned worker processes
+_dataset_to_cache = None
+
+
+def _init_worker(dataset):
+    global _dataset_to_cache
+    _dataset_to_cache = dataset
+
+
+def _get_sample(index):
+    return _dataset_to_cache[index]
+
+
+def _dir_signature(data_dir):
+    ''' number, total size and latest mtime of the files under data_dir, which change if the images are changed '''
+    num_files, total_size, mtime = 0, 0, 0
+    for dirpath, _, filenames in os.walk(data_dir):
+        for name in filenames:
+            stat = os.stat(os.path.join(dirpath, name))
+            num_files += 1
+            total_size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+    return [os.path.abspath(data_dir), num_files, total_size, mtime]
+
+
+def _config_hash(config):
+    ''' hash of the dataset config (including the transform pipeline), the signatures of the label files and of the
+    files under data_dir '''
+    label_files = config.get('label_files') or []
+    if isinstance(label_files, str):
+        label_files = [label_files]
+    signatures = []
+    for f in label_files:
+        stat = os.stat(f)
+        signatures.append([os.path.abspath(f), stat.st_size, stat.st_mtime_ns])
+    if config.get('data_dir') is not None:
+        signatures.append(_dir_signature(config['data_dir']))
+    key = json.dumps([config, signatures], sort_keys=True, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+
+class PreprocessCache(object):
+    '''
+    Wrap a dataset, whose __getitem__ returns a tuple of arrays (or scalars, strings), to read the samples from a
+    memory-mapped cache in `cache_dir`. The cache is built by one pass over the dataset if it does not exist, and is
+    identified by the hash of the dataset config, so a change to the transform pipeline or label files builds a new one.
+    The files under data_dir are also part of the key by their number, total size and latest mtime, which are
+    computed by walking data_dir each time the dataset is built. An image replaced by one of the same size with an
+    older mtime is not detected.
+
+    Only use it for a dataset whose samples are deterministic and in a fixed order, i.e. no random augmentation and
+    no shuffle, typically the eval dataset.
+
+    Args:
+        dataset: the dataset to cache, with `__len__`, `__getitem__` and `get_column_names`
+        cache_dir: directory to save the caches
+        dataset_config (dict): the config the dataset is built from, to identify the cache
+        num_workers (int): number of processes to build the cache, which are spawned, so the dataset has to be
+            picklable
+    '''
+    def __init__(self, dataset, cache_dir: str, dataset_config: dict, num_workers: Optional[int] = 1):
+        self.column_names = dataset.get_column_names()
+        self.cache_path = os.path.join(cache_dir, _config_hash(dataset_config))
+        if not os.path.exists(os.path.join(self.cache_path, 'index.npz')):
+            self.build(dataset, num_workers)
+        else:
+            print(f'INFO: load preprocessed samples from cache {self.cache_path}')
+
+        index = np.load(os.path.join(self.cache_path, 'index.npz'))
+        self.offsets = index['offsets']  # [N, num_columns]
+        self.shapes = index['shapes']  # [N, num_columns, max_ndim], -1 for the dimensions not used
+        self.dtypes = [np.dtype(d) for d in index['dtypes']]
+        self.dtype_ids = index['dtype_ids']  # [N, num_columns]
+        self.is_scalar = index['is_scalar']  # [num_columns], python scalars or strings are not returned as arrays
+        self._data = None
+
+    def build(self, dataset, num_workers):
+        os.makedirs(self.cache_path, exist_ok=True)
+        print(f'INFO: building preprocessed sample cache {self.cache_path} for {len(dataset)} samples...')
+        data_path = os.path.join(self.cache_path, 'data.bin')
+        tmp_path = f'{data_path}.{os.getpid()}.tmp'
+
+        num_columns = len(self.column_names)
+        offsets = np.zeros((len(dataset), num_columns), dtype=np.int64)
+        shapes, dtype_ids, dtypes = [], np.zeros((len(dataset), num_columns), dtype=np.int32), []
+        is_scalar = np.zeros(num_columns, dtype=bool)
+
+        pool = None
+        if num_workers is not None and num_workers > 1:
+            # spawned rather than forked, since the parent may already run the threads of the MindSpore runtime
+            pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer=_init_worker,
+                                                             initargs=(dataset,))
+            samples = pool.imap(_get_sample, range(len(dataset)), chunksize=8)
+        else:
+            samples = (dataset[i] for i in range(len(dataset)))
+
+        pos = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for i, sample in enumerate(samples):
+                    sample_shapes = []
+                    for j, value in enumerate(sample):
+                        if not isinstance(value, np.ndarray):
+                            is_scalar[j] = True
+                        arr = np.asarray(value)
+                        if arr.dtype == object:
+                            raise ValueError(f'Column {self.column_names[j]} of object type can not be cached.')
+                        if arr.dtype not in dtypes:
+                            dtypes.append(arr.dtype)
+                        dtype_ids[i, j] = dtypes.index(arr.dtype)
+                        offsets[i, j] = pos
+                        sample_shapes.append(arr.shape)
+                        f.write(arr.tobytes())
+                        padding = -arr.nbytes % _ALIGN
+                        f.write(b'\0' * padding)
+                        pos += arr.nbytes + padding
+                    shapes.append(sample_shapes)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        max_ndim = max([len(s) for sample_shapes in shapes for s in sample_shapes] + [1])
+        shape_array = np.full((len(dataset), num_columns, max_ndim), -1, dtype=np.int64)
+        for i, sample_shapes in enumerate(shapes):
+            for j, s in enumerate(sample_shapes):
+                shape_array[i, j, :len(s)] = s
+        os.replace(tmp_path, data_path)
+        # index is written last, its existence marks a complete cache
+        index_path = os.path.join(self.cache_path, 'index.npz')
+        tmp_index_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(tmp_index_path, 'wb') as f:
+            np.savez(f, offsets=offsets, shapes=shape_array, dtypes=np.array([d.str for d in dtypes]),
+                     dtype_ids=dtype_ids, is_scalar=is_scalar)
+        os.replace(tmp_index_path, index_path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get_column_names(self):
+        return self.column_names
+
+    def __getitem__(self, index):
+        if self._data is None:
+            data_path = os.path.join(self.cache_path, 'data.bin')
+            self._data = np.memmap(data_path, dtype=np.uint8, mode='r').view(np.ndarray) \
+                if os.path.getsize(data_path) > 0 else np.zeros(0, dtype=np.uint8)
+        sample = []
+        for j in range(len(self.column_names)):
+            dtype = self.dtypes[self.dtype_ids[index, j]]
+            shape = tuple(int(d) for d in self.shapes[index, j] if d >= 0)
+            start = int(self.offsets[index, j])
+            nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            arr = self._data[start: start + nbytes].view(dtype).reshape(shape)
+            sample.append(arr[()].item() if self.is_scalar[j] and arr.ndim == 0 else arr)
+        return tuple(sample)
@@ -1,14 +1,58 @@
 from typing import Union, List
+import cv2
 import numpy as np
 import random
 import lmdb
 import os
 
 from .transforms.transforms_factory import create_transforms, run_transforms
+from .transforms.key_schema import get_output_keys
+from .transforms.profiler import TransformProfiler
 from .base_dataset import BaseDataset
+from .sample_index import SampleIndex
 
 __all__ = ['LMDBDataset']
 
+# LMDB environments opened by the current process, keyed by path. lmdb allows one environment per path in a process,
+# so they are shared by all datasets.
+_lmdb_envs = {}
+_lmdb_envs_pid = None
+
+
+def _get_lmdb_env(dirpath, **kwargs):
+    ''' return the LMDB environment of the path for the current process, opened on first use '''
+    global _lmdb_envs, _lmdb_envs_pid
+    pid = os.getpid()
+    if _lmdb_envs_pid != pid:
+        # the environments inherited from the parent process must not be used after fork. They are read-only and
+        # lock-free, so closing them only releases the memory maps and file handles of this process.
+        for env in _lmdb_envs.values():
+            env.close()
+        _lmdb_envs = {}
+        _lmdb_envs_pid = pid
+    dirpath = os.path.abspath(dirpath)
+    env = _lmdb_envs.get(dirpath)
+    if env is None:
+        env = _lmdb_envs[dirpath] = lmdb.open(dirpath, readonly=True, lock=False, meminit=False, **kwargs)
+    return env
+
+
+def _read_num_samples(dirpath):
+    ''' read the number of samples of an LMDB dataset. Unless the environment is already opened by the current
+    process, it is closed right after, so that the process building the dataset holds no LMDB handle when the
+    dataloader workers are forked. '''
+    env = _lmdb_envs.get(os.path.abspath(dirpath)) if _lmdb_envs_pid == os.getpid() else None
+    if env is not None:
+        with env.begin(write=False) as txn:
+            return int(txn.get('num-samples'.encode()))
+    env = lmdb.open(dirpath, readonly=True, lock=False, meminit=False, readahead=False, max_readers=1)
+    try:
+        with env.begin(write=False) as txn:
+            return int(txn.get('num-samples'.encode()))
+    finally:
+        env.close()
+
+
 class LMDBDataset():
     """Data iterator for ocr datasets including ICDAR15 dataset. 
     The annotaiton format is required to aligned to paddle, which can be done using the `converter.py` script.
@@ -16,11 +60,19 @@ class LMDBDataset():
     Args:
         is_train: 
         data_dir: 
+        sample_ratios (Union[float, List[float]]): sampling ratio of each LMDB dataset under data_dir (in the sorted
+            order of their paths), or one ratio for all. A ratio above 1 repeats the samples of that dataset, so
+            datasets can be mixed with chosen weights.
         shuffle, Optional, if not given, shuffle = is_train
+        readahead (bool): whether to let the OS read ahead the LMDB files. Enable it if the data fits in memory, keep
+            it disabled for random access to large datasets. Default: False.
+        max_readers (int): max number of read transactions of an LMDB environment. Default: 126.
         transform_pipeline: list of dict, key - transform class name, value - a dict of param config.
                     e.g., [{'DecodeImage': {'img_mode': 'BGR', 'channel_first': False}}]
             -       if None, default transform pipeline for text detection will be taken.
         output_keys (list): required, indicates the keys in data dict that are expected to output for dataloader. if None, all data keys will be used for return. 
+        transform_profile_dir (str): if given, the wall time and memory of each transform class are recorded into this
+            directory by TransformProfiler, for all dataloader workers. See `report_transform_profile`.
         global_config: additional info, used in data transformation, possible keys:
             - character_dict_path
             
@@ -39,6 +91,10 @@ class LMDBDataset():
                 ├── data.mdb
                 ├── lock.mdb
             ├── ... 
+        2. LMDB environments are opened lazily in each process reading the data, and each sample is read in a
+            short-lived transaction, so that the dataloader worker processes never share LMDB handles or snapshots.
+            An environment is opened once per path and process with the readahead and max_readers of the first dataset
+            opening it.
     """
     def __init__(self, 
             is_train: bool = True, 
@@ -47,90 +103,86 @@ class LMDBDataset():
             shuffle: bool = None,
             transform_pipeline: List[dict] = None, 
             output_keys: List[str] = None,
+            transform_profile_dir: str = None,
+            readahead: bool = False,
+            max_readers: int = 126,
             #global_config: dict = None,
             **kwargs
             ):
         super(LMDBDataset, self).__init__()
 
         self.data_dir = data_dir
+        self.readahead = readahead
+        self.max_readers = max_readers
         assert isinstance(shuffle, bool), f'type error of {shuffle}'
         shuffle = shuffle if shuffle is not None else is_train
 
-        sample_ratio = sample_ratios[0] if isinstance(sample_ratios, list) else sample_ratios
         self.lmdb_sets = self.load_hierarchical_lmdb_dataset(data_dir)
-        self.data_idx_order_list = self.dataset_traversal(sample_ratio, shuffle)
+        self.dataset_traversal(sample_ratios, shuffle)
         
         # create transform
+        input_keys = ['img_lmdb', 'label']
         if transform_pipeline is not None:
-            self.transforms = create_transforms(transform_pipeline) #, global_config=global_config)
+            self.transforms = create_transforms(transform_pipeline, input_keys=input_keys, output_keys=output_keys)
         else:
             raise ValueError('No transform pipeline is specified!')
+        self.transform_profiler = TransformProfiler(transform_profile_dir) if transform_profile_dir is not None else None
 
-        # prefetch the data keys, to fit GeneratorDataset
-        _data = self.data_idx_order_list[0]
-        lmdb_idx, file_idx = self.data_idx_order_list[0]
-        lmdb_idx = int(lmdb_idx)
-        file_idx = int(file_idx)
-        sample_info = self.get_lmdb_sample_info(self.lmdb_sets[lmdb_idx]['txn'], file_idx)
-        _data = {
-            "img_lmdb": sample_info[0],
-            "label": sample_info[1]
-        }
-        _data = run_transforms(_data, transforms=self.transforms)
-        _available_keys = list(_data.keys())
-        
-        if output_keys is None:
-            self.output_keys = _available_keys   
+        if output_keys is not None and get_output_keys(self.transforms, input_keys) is not None:
+            # checked by create_transforms with the key schema of the transforms, without running them
+            self.output_keys = list(output_keys)
         else:
-            self.output_keys = []
-            for k in output_keys:
-                if k in _data:
-                    self.output_keys.append(k)
-                else:
-                    raise ValueError(f'Key {k} does not exist in data (available keys: {_data.keys()}). Please check the name or the completeness transformation pipeline.')
+            # prefetch the data keys, to fit GeneratorDataset
+            lmdb_idx, file_idx = self.get_lmdb_idx(0)
+            with self.get_lmdb_env(lmdb_idx).begin(write=False) as txn:
+                sample_info = self.get_lmdb_sample_info(txn, file_idx)
+            _data = {
+                "img_lmdb": sample_info[0],
+                "label": sample_info[1]
+            }
+            _data = run_transforms(_data, transforms=self.transforms)
+            _available_keys = list(_data.keys())
+        
+            if output_keys is None:
+                self.output_keys = _available_keys   
+            else:
+                self.output_keys = []
+                for k in output_keys:
+                    if k in _data:
+                        self.output_keys.append(k)
+                    else:
+                        raise ValueError(f'Key {k} does not exist in data (available keys: {_data.keys()}). Please check the name or the completeness transformation pipeline.')
+
+    def get_lmdb_env(self, lmdb_idx):
+        ''' return the LMDB environment of the lmdb_idx-th dataset for the current process, opened lazily on the first
+        read of each worker. If the same path is already opened by another dataset in the process, its environment is
+        shared. '''
+        return _get_lmdb_env(self.lmdb_sets[lmdb_idx]['dirpath'], readahead=self.readahead,
+                             max_readers=self.max_readers)
 
     def load_hierarchical_lmdb_dataset(self, data_dir, start_idx=0):
         
         lmdb_sets = {}
         dataset_idx = start_idx
         for dirpath, dirnames, filenames in os.walk(data_dir + '/'):
+            dirnames.sort()
             if not dirnames:
-                env = lmdb.open(
-                    dirpath,
-                    max_readers=32,
-                    readonly=True,
-                    lock=False,
-                    readahead=False,
-                    meminit=False)
-                txn = env.begin(write=False)
-                num_samples = int(txn.get('num-samples'.encode()))
-                lmdb_sets[dataset_idx] = {"dirpath":dirpath, "env":env, \
-                    "txn":txn, "num_samples":num_samples}
+                num_samples = _read_num_samples(dirpath)
+                lmdb_sets[dataset_idx] = {"dirpath":dirpath, "num_samples":num_samples}
                 dataset_idx += 1
         return lmdb_sets
 
-    def dataset_traversal(self, sample_ratio, shuffle):
-        lmdb_num = len(self.lmdb_sets)
-        total_sample_num = 0
-        for lno in range(lmdb_num):
-            total_sample_num += self.lmdb_sets[lno]['num_samples']
-        data_idx_order_list = np.zeros((total_sample_num, 2))
-        beg_idx = 0
-        for lno in range(lmdb_num):
-            tmp_sample_num = self.lmdb_sets[lno]['num_samples']
-            end_idx = beg_idx + tmp_sample_num
-            data_idx_order_list[beg_idx:end_idx, 0] = lno
-            data_idx_order_list[beg_idx:end_idx, 1] \
-                = list(range(tmp_sample_num))
-            data_idx_order_list[beg_idx:end_idx, 1] += 1
-            beg_idx = beg_idx + tmp_sample_num
-            
-        if shuffle:
-            np.random.shuffle(data_idx_order_list)
-
-        data_idx_order_list = data_idx_order_list[:round(len(data_idx_order_list) * sample_ratio)]
+    def dataset_traversal(self, sample_ratios, shuffle):
+        '''
+        Build the sample index, which only keeps O(number of LMDB datasets) data, see SampleIndex.
+        '''
+        num_samples = [self.lmdb_sets[lno]['num_samples'] for lno in range(len(self.lmdb_sets))]
+        self.sample_index = SampleIndex(num_samples, sample_ratios, shuffle)
 
-        return data_idx_order_list
+    def get_lmdb_idx(self, idx):
+        ''' map the dataset index to (lmdb index, file index), where file index starts from 1 as in LMDB keys '''
+        lmdb_idx, file_idx = self.sample_index(idx)
+        return lmdb_idx, file_idx + 1
 
     def get_img_data(self, value):
         """get_img_data"""
@@ -155,11 +207,9 @@ class LMDBDataset():
         return imgbuf, label
 
     def __getitem__(self, idx):
-        lmdb_idx, file_idx = self.data_idx_order_list[idx]
-        lmdb_idx = int(lmdb_idx)
-        file_idx = int(file_idx)
-        sample_info = self.get_lmdb_sample_info(self.lmdb_sets[lmdb_idx]['txn'],
-                                                file_idx)
+        lmdb_idx, file_idx = self.get_lmdb_idx(idx)
+        with self.get_lmdb_env(lmdb_idx).begin(write=False) as txn:
+            sample_info = self.get_lmdb_sample_info(txn, file_idx)
         if sample_info is None:
             return self.__getitem__(np.random.randint(self.__len__()))
         
@@ -169,7 +219,7 @@ class LMDBDataset():
         }
         
         # perform transformation on data
-        data = run_transforms(data, transforms=self.transforms)
+        data = run_transforms(data, transforms=self.transforms, profiler=self.transform_profiler)
             
         output_tuple = tuple(data[k] for k in self.output_keys) 
 
@@ -180,4 +230,4 @@ class LMDBDataset():
         return self.output_keys
 
     def __len__(self):
-        return self.data_idx_order_list.shape[0]
+        return len(self.sample_index)
@@ -0,0 +1,219 @@
+from typing import Union, List, Iterable, Tuple
+import mmap
+import os
+import struct
+import numpy as np
+
+from .transforms.transforms_factory import create_transforms, run_transforms
+from .transforms.key_schema import get_output_keys
+from .transforms.profiler import TransformProfiler
+from .sample_index import SampleIndex
+
+__all__ = ['RecShardDataset']
+
+# header: magic, num_samples, positions of image offsets, label offsets and label data sections
+_SHARD_MAGIC = b'MOCRSHD1'
+_SHARD_HEADER = struct.Struct('<8sQQQQ')
+SHARD_EXT = '.shard'
+
+
+def write_rec_shard(path: str, samples: Iterable[Tuple[bytes, str]]) -> int:
+    '''
+    Pack recognition samples into one shard file, which is read by RecShard.
+
+    The file contains a fixed header, then the encoded image bytes of all samples back to back, the utf-8 labels back
+    to back, and the uint64 offsets of images and labels (num_samples + 1 each, relative to their section start).
+
+    Args:
+        path: output shard file path
+        samples: iterable of (encoded image bytes, label text)
+    Returns:
+        the number of samples written
+    '''
+    img_offsets, labels = [0], []
+    with open(path, 'wb') as f:
+        f.write(b'\0' * _SHARD_HEADER.size)
+        for img, label in samples:
+            f.write(img)
+            img_offsets.append(img_offsets[-1] + len(img))
+            labels.append(label.encode('utf-8'))
+
+        label_data_pos = f.tell()
+        label_offsets = np.zeros(len(labels) + 1, dtype=np.uint64)
+        label_offsets[1:] = np.cumsum([len(label) for label in labels])
+        f.write(b''.join(labels))
+
+        img_offsets_pos = f.tell()
+        f.write(np.array(img_offsets, dtype='<u8').tobytes())
+        label_offsets_pos = f.tell()
+        f.write(label_offsets.astype('<u8').tobytes())
+
+        f.seek(0)
+        f.write(_SHARD_HEADER.pack(_SHARD_MAGIC, len(labels), img_offsets_pos, label_offsets_pos, label_data_pos))
+    return len(labels)
+
+
+class RecShard(object):
+    '''
+    Read-only view of a shard file written by `write_rec_shard`. The file is memory-mapped, so image buffers are
+    zero-copy slices and all processes reading the same shard share the page cache.
+
+    The mapping is opened lazily and is not pickled, so that each dataloader worker process maps the file by itself.
+
+    Args:
+        path: shard file path
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self._mm = None
+        self._pid = None
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pid = os.getpid()
+        magic, num_samples, img_offsets_pos, label_offsets_pos, label_data_pos = \
+            _SHARD_HEADER.unpack_from(self._mm, 0)
+        if magic != _SHARD_MAGIC:
+            raise ValueError(f'{self.path} is not a valid shard file.')
+        self.num_samples = num_samples
+        self._img_offsets = np.frombuffer(self._mm, dtype='<u8', count=num_samples + 1, offset=img_offsets_pos)
+        self._label_offsets = np.frombuffer(self._mm, dtype='<u8', count=num_samples + 1, offset=label_offsets_pos)
+        self._img_data_pos = _SHARD_HEADER.size
+        self._label_data_pos = label_data_pos
+        self._view = memoryview(self._mm)
+
+    def __getstate__(self):
+        return {'path': self.path, 'num_samples': self.num_samples}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._mm = None
+        self._pid = None
+
+    def __len__(self):
+        return self.num_samples
+
+    def get_sample(self, index: int) -> Tuple[memoryview, str]:
+        ''' return (encoded image buffer, label text) of the index-th sample '''
+        if self._pid != os.getpid():
+            self._open()
+        img_start, img_end = int(self._img_offsets[index]), int(self._img_offsets[index + 1])
+        label_start, label_end = int(self._label_offsets[index]), int(self._label_offsets[index + 1])
+        img = self._view[self._img_data_pos + img_start: self._img_data_pos + img_end]
+        label = str(self._view[self._label_data_pos + label_start: self._label_data_pos + label_end], 'utf-8')
+        return img, label
+
+
+class RecShardDataset(object):
+    """Data iterator for recognition datasets packed into shard files, e.g., converted from LMDB datasets by
+    `tools/dataset_converters/lmdb_to_shard.py`.
+
+    Compared to LMDBDataset, samples are read by slicing a memory-mapped file without any per-read transaction or
+    key formatting, and the number of dataloader workers is not limited by LMDB reader slots.
+
+    Args:
+        is_train: whether it is in training stage
+        data_dir: directory containing the shard files (searched recursively)
+        sample_ratios (Union[float, List[float]]): sampling ratio of each shard (in the sorted order of their paths),
+            or one ratio for all. A ratio above 1 repeats the samples of that shard.
+        shuffle, Optional, if not given, shuffle = is_train
+        transform_pipeline: list of dict, key - transform class name, value - a dict of param config.
+                    e.g., [{'DecodeImage': {'img_mode': 'BGR', 'channel_first': False}}]
+        output_keys (list): required, indicates the keys in data dict that are expected to output for dataloader. if None, all data keys will be used for return.
+        transform_profile_dir (str): if given, the wall time and memory of each transform class are recorded into this
+            directory by TransformProfiler, for all dataloader workers. See `report_transform_profile`.
+
+    Returns:
+        data (tuple): Depending on the transform pipeline, __get_item__ returns a tuple for the specified data item.
+        The encoded image buffer is given by the `img_lmdb` key, the same as LMDBDataset, so the transform pipelines of
+        LMDB datasets can be used as they are.
+
+    Notes:
+        1. Dataset file structure should follow:
+            data_dir
+            ├── dataset01.shard
+            ├── dataset02.shard
+            ├── ...
+    """
+    def __init__(self,
+            is_train: bool = True,
+            data_dir: str = '',
+            sample_ratios: Union[List, float] = 1.0,
+            shuffle: bool = None,
+            transform_pipeline: List[dict] = None,
+            output_keys: List[str] = None,
+            transform_profile_dir: str = None,
+            **kwargs
+            ):
+        self.data_dir = data_dir
+        shuffle = shuffle if shuffle is not None else is_train
+        assert isinstance(shuffle, bool), f'type error of {shuffle}'
+
+        self.shards = self.load_shards(data_dir)
+        self.dataset_traversal(sample_ratios, shuffle)
+
+        # create transform
+        input_keys = ['img_lmdb', 'label']
+        if transform_pipeline is not None:
+            self.transforms = create_transforms(transform_pipeline, input_keys=input_keys, output_keys=output_keys)
+        else:
+            raise ValueError('No transform pipeline is specified!')
+        self.transform_profiler = TransformProfiler(transform_profile_dir) if transform_profile_dir is not None else None
+
+        if output_keys is not None and get_output_keys(self.transforms, input_keys) is not None:
+            # checked by create_transforms with the key schema of the transforms, without running them
+            self.output_keys = list(output_keys)
+        else:
+            # prefetch the data keys, to fit GeneratorDataset
+            _data = self.get_sample(0)
+            _data = run_transforms(_data, transforms=self.transforms)
+            _available_keys = list(_data.keys())
+
+            if output_keys is None:
+                self.output_keys = _available_keys
+            else:
+                self.output_keys = []
+                for k in output_keys:
+                    if k in _data:
+                        self.output_keys.append(k)
+                    else:
+                        raise ValueError(f'Key {k} does not exist in data (available keys: {_data.keys()}). Please check the name or the completeness transformation pipeline.')
+
+    def load_shards(self, data_dir):
+        shard_paths = []
+        for dirpath, dirnames, filenames in os.walk(data_dir):
+            dirnames.sort()
+            shard_paths.extend(os.path.join(dirpath, fn) for fn in sorted(filenames) if fn.endswith(SHARD_EXT))
+        if len(shard_paths) == 0:
+            raise ValueError(f'No {SHARD_EXT} file found in {data_dir}')
+        return [RecShard(p) for p in shard_paths]
+
+    def dataset_traversal(self, sample_ratios, shuffle):
+        '''
+        Build the sample index, which only keeps O(number of shards) data, see SampleIndex.
+        '''
+        self.sample_index = SampleIndex([len(s) for s in self.shards], sample_ratios, shuffle)
+
+    def get_sample(self, idx):
+        shard_idx, sample_idx = self.sample_index(idx)
+        img, label = self.shards[shard_idx].get_sample(sample_idx)
+        return {'img_lmdb': img, 'label': label}
+
+    def __getitem__(self, idx):
+        data = self.get_sample(idx)
+
+        # perform transformation on data
+        data = run_transforms(data, transforms=self.transforms, profiler=self.transform_profiler)
+
+        output_tuple = tuple(data[k] for k in self.output_keys)
+
+        return output_tuple
+
+    def get_column_names(self):
+        ''' return list of names for the output data tuples'''
+        return self.output_keys
+
+    def __len__(self):
+        return len(self.sample_index)
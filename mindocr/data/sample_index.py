@@ -0,0 +1,92 @@
+'''
+Sample index over several datasets mixed with sampling ratios, which keeps O(number of datasets) data however many
+samples there are.
+'''
+from typing import Union, List, Optional
+import numpy as np
+
+__all__ = ['SampleIndex']
+
+
+class _FeistelPermutation(object):
+    ''' Seeded pseudo-random permutation of [0, size), computed on the fly with a Feistel network and cycle walking,
+    so it costs O(1) memory however large the size is.
+    '''
+    def __init__(self, size, seed, rounds=4):
+        self.size = size
+        half_bits = max(1, (max(size - 1, 1).bit_length() + 1) // 2)
+        self.half_bits = half_bits
+        self.half_mask = (1 << half_bits) - 1
+        rng = np.random.default_rng(seed)
+        self.keys = [int(k) for k in rng.integers(0, 2 ** 32, size=rounds)]
+
+    @staticmethod
+    def _mix(x, key):
+        x = ((x ^ key) * 0x9E3779B1 + key) & 0xFFFFFFFF
+        x ^= x >> 15
+        x = (x * 0x85EBCA77) & 0xFFFFFFFF
+        return x ^ (x >> 13)
+
+    def _encrypt(self, x):
+        left, right = x >> self.half_bits, x & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ (self._mix(right, key) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def __call__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(f'index {index} out of range for the permutation of size {self.size}')
+        # the domain is [0, 4 * size) at most, so a few steps of walking bring the result back into [0, size)
+        x = self._encrypt(index)
+        while x >= self.size:
+            x = self._encrypt(x)
+        return x
+
+
+class SampleIndex(object):
+    '''
+    Map the index of a mixed dataset to (dataset index, sample index). Only the cumulative offsets of the samples taken
+    from each dataset and, if shuffle, the seeds of on-the-fly permutations are kept.
+    The j-th sample taken from a dataset is its (j % num_samples)-th sample, in a shuffled order if shuffle.
+
+    Args:
+        num_samples (List[int]): number of samples of each dataset
+        sample_ratios (Union[float, List[float]]): sampling ratio of each dataset, or one ratio for all. A ratio above
+            1 repeats the samples of that dataset.
+        shuffle (bool): whether to shuffle the samples over all datasets
+        seed (int): seed of the shuffle, drawn from np.random if None
+    '''
+    def __init__(self, num_samples: List[int], sample_ratios: Union[float, List[float]] = 1.0, shuffle: bool = False,
+                 seed: Optional[int] = None):
+        num_sets = len(num_samples)
+        self.num_samples = np.array(num_samples, dtype=np.int64)
+        if not isinstance(sample_ratios, (list, tuple)):
+            sample_ratios = [sample_ratios]
+        if len(sample_ratios) == 1:
+            sample_ratios = list(sample_ratios) * num_sets
+        if len(sample_ratios) != num_sets:
+            raise ValueError(f'Got {len(sample_ratios)} sample_ratios for {num_sets} datasets')
+
+        self.num_taken = np.round(self.num_samples * np.array(sample_ratios, dtype=np.float64)).astype(np.int64)
+        self.taken_offsets = np.concatenate([[0], np.cumsum(self.num_taken)]).astype(np.int64)
+
+        self.shuffle = shuffle
+        if shuffle:
+            seed = np.random.randint(2 ** 31) if seed is None else seed
+            self._perm = _FeistelPermutation(len(self), seed)
+            self._set_perms = [_FeistelPermutation(int(n), seed + i + 1) for i, n in enumerate(self.num_samples)]
+
+    def __len__(self):
+        return int(self.taken_offsets[-1])
+
+    def __call__(self, idx):
+        ''' return (dataset index, sample index) of the idx-th sample, both starting from 0 '''
+        if not 0 <= idx < len(self):
+            raise IndexError(f'index {idx} out of range for {len(self)} samples')
+        if self.shuffle:
+            idx = self._perm(idx)
+        set_idx = int(np.searchsorted(self.taken_offsets, idx, side='right')) - 1
+        sample_idx = (idx - int(self.taken_offsets[set_idx])) % int(self.num_samples[set_idx])
+        if self.shuffle:
+            sample_idx = self._set_perms[set_idx](sample_idx)
+        return set_idx, sample_idx
@@ -0,0 +1,232 @@
+'''
+Dataloader workers passing the samples through a ring of shared memory slots instead of pickling them, for the datasets
+of large samples, e.g., the images and label maps for detection training.
+'''
+from typing import List, Optional
+import math
+import multiprocessing
+import queue
+import random
+import sys
+import traceback
+import weakref
+from multiprocessing import shared_memory
+import numpy as np
+
+__all__ = ['SharedMemoryLoader', 'infer_max_rowsize', 'probe_samples']
+
+_ALIGN = 64
+_MB = 1 << 20
+
+
+def _column_nbytes(value):
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return -(-value.nbytes // _ALIGN) * _ALIGN
+    return 0
+
+
+def probe_samples(dataset, num_samples: int = 8):
+    '''
+    Return a few samples spread evenly over the dataset, from which the buffer sizes for its samples are inferred.
+    '''
+    indices = np.unique(np.linspace(0, len(dataset) - 1, min(num_samples, len(dataset))).astype(np.int64))
+    return [dataset[int(i)] for i in indices]
+
+
+def infer_max_rowsize(samples, margin: float = 2.):
+    '''
+    Return the `max_rowsize` (in MB) of GeneratorDataset for the samples like the given ones (e.g. from
+    `probe_samples`), i.e. the size of the arrays of the largest one with a margin for the larger samples not probed.
+    '''
+    max_nbytes = max(sum(np.asarray(v).nbytes for v in sample) for sample in samples)
+    return max(1, math.ceil(max_nbytes * margin / _MB))
+
+
+def _write_slot(buf, sample):
+    ''' copy the arrays of the sample into the slot buffer, return the column descriptions to rebuild them '''
+    columns = []
+    pos = 0
+    for value in sample:
+        nbytes = _column_nbytes(value)
+        if nbytes > 0 and pos + value.nbytes <= len(buf):
+            buf[pos: pos + value.nbytes] = np.ascontiguousarray(value).reshape(-1).view(np.uint8)
+            columns.append(('shm', pos, value.shape, value.dtype.str))
+            pos += nbytes
+        else:
+            # scalars, strings, empty arrays and arrays exceeding the slot are pickled
+            columns.append(('obj', value))
+    return columns
+
+
+def _worker_loop(dataset, shm, slot_size, task_queue, result_queue, seed):
+    np.random.seed(seed)
+    random.seed(seed)
+    if 'imgaug' in sys.modules:
+        sys.modules['imgaug'].seed(seed)
+    ring = np.frombuffer(shm.buf, dtype=np.uint8)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        seq, index, slot = task
+        try:
+            columns = _write_slot(ring[slot * slot_size: (slot + 1) * slot_size], dataset[index])
+            result_queue.put((seq, columns, None))
+        except Exception:
+            result_queue.put((seq, None, traceback.format_exc()))
+    del ring
+
+
+def _shutdown(workers, task_queue, shm, views):
+    for _ in workers:
+        task_queue.put(None)
+    for w in workers:
+        w.join(timeout=5)
+        if w.is_alive():
+            w.terminate()
+    # the views of the buffer have to be released before closing it
+    views.clear()
+    shm.close()
+    shm.unlink()
+
+
+class SharedMemoryLoader(object):
+    '''
+    Iterable source for GeneratorDataset, which loads the samples of `dataset` in its own worker processes. The workers
+    write the arrays of each sample into a preallocated shared memory slot and only pass back the slot layout, so the
+    sample is copied once out of the slot instead of being pickled, sent through a pipe and unpickled.
+
+    The workers are forked when the loader is built, i.e. on the thread building the dataloader, before the loader is
+    passed to GeneratorDataset and iterated by the threads of its pipeline. They are stopped by `close`.
+
+    The slot size is inferred from the largest of a few probed samples (the arrays of all output columns) with `margin`.
+    Arrays of a sample exceeding its slot are pickled as a fallback. Samples are returned in order, with shuffle and sharding done here as
+    GeneratorDataset does not do them for an iterable source. The shuffle seed is drawn from np.random, so that it is
+    the same for all shards after `set_seed`.
+
+    Args:
+        dataset: dataset with `__len__`, `__getitem__` and `get_column_names`, e.g. DetDataset
+        num_workers (int): number of worker processes
+        shuffle (bool): whether to shuffle the samples each epoch
+        num_shards (int): number of shards for distributed training, None for no sharding
+        shard_id (int): shard of this process
+        slot_size (float): size of a slot in MB, inferred from the probed samples if None
+        num_slots (int): number of slots, i.e. samples in flight, default 2 * num_workers
+        margin (float): ratio of the inferred slot size to the size of the largest probed sample
+        samples (List[tuple]): samples of dataset already probed, e.g. by `probe_samples`, which is called if None
+    '''
+    def __init__(self, dataset, num_workers: int, shuffle: bool = False, num_shards: Optional[int] = None,
+                 shard_id: Optional[int] = None, slot_size: Optional[float] = None, num_slots: Optional[int] = None,
+                 margin: float = 1.5, samples: Optional[List[tuple]] = None):
+        self.dataset = dataset
+        self.num_workers = max(1, num_workers)
+        self.shuffle = shuffle
+        self.num_shards = num_shards or 1
+        self.shard_id = shard_id or 0
+        if slot_size is None:
+            samples = probe_samples(dataset) if samples is None else samples
+            max_nbytes = max(sum(_column_nbytes(v) for v in sample) for sample in samples)
+            self.slot_size = max(_ALIGN, int(max_nbytes * margin) // _ALIGN * _ALIGN)
+        else:
+            self.slot_size = int(slot_size * _MB) // _ALIGN * _ALIGN
+        self.num_slots = num_slots or 2 * self.num_workers
+        self.seed = np.random.randint(2 ** 31)
+        self.epoch = 0
+        self._workers = None
+        self._num_in_flight = 0
+        self._warned_overflow = False
+        self._start()
+        print(f'==> Shared memory loader: {self.num_workers} workers, {self.num_slots} slots of '
+              f'{self.slot_size / _MB:.2f} MB')
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.num_shards)
+
+    def get_column_names(self):
+        return self.dataset.get_column_names()
+
+    def get_indices(self, epoch):
+        ''' sample indices of this shard in the epoch, the shards are padded to the same length by wrapping around '''
+        indices = np.arange(len(self.dataset))
+        if self.shuffle:
+            np.random.RandomState((self.seed + epoch) % 2 ** 32).shuffle(indices)
+        indices = np.resize(indices, len(self) * self.num_shards)
+        return indices[self.shard_id::self.num_shards]
+
+    def _start(self):
+        ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slot_size * self.num_slots)
+        self._views = [np.frombuffer(self._shm.buf, dtype=np.uint8)]
+        self._task_queue = ctx.SimpleQueue()
+        self._result_queue = ctx.Queue()
+        self._workers = []
+        for i in range(self.num_workers):
+            w = ctx.Process(target=_worker_loop, daemon=True,
+                            args=(self.dataset, self._shm, self.slot_size, self._task_queue, self._result_queue,
+                                  (self.seed + i + 1) % 2 ** 32))
+            w.start()
+            self._workers.append(w)
+        self._finalizer = weakref.finalize(self, _shutdown, self._workers, self._task_queue, self._shm, self._views)
+
+    def close(self):
+        if self._workers is not None:
+            self._finalizer()
+            self._workers = None
+
+    def _get_result(self):
+        while True:
+            try:
+                result = self._result_queue.get(timeout=5)
+                self._num_in_flight -= 1
+                return result
+            except queue.Empty:
+                if not all(w.is_alive() for w in self._workers):
+                    raise RuntimeError('A dataloader worker exited unexpectedly.')
+
+    def _read_slot(self, slot, columns):
+        sample = []
+        ring = self._views[0]
+        start = slot * self.slot_size
+        for column in columns:
+            if column[0] == 'shm':
+                _, pos, shape, dtype = column
+                dtype = np.dtype(dtype)
+                count = int(np.prod(shape, dtype=np.int64))
+                sample.append(ring[start + pos: start + pos + count * dtype.itemsize].view(dtype).reshape(shape)
+                              .copy())
+            else:
+                if _column_nbytes(column[1]) > 0 and not self._warned_overflow:
+                    print(f'WARNING: sample arrays exceed the shared memory slot of {self.slot_size / _MB:.2f} MB and '
+                          f'are pickled instead. Set a larger slot size to avoid it.')
+                    self._warned_overflow = True
+                sample.append(column[1])
+        return tuple(sample)
+
+    def __iter__(self):
+        if self._workers is None:
+            raise RuntimeError('The shared memory loader is closed.')
+        # results of the previous epoch, if its iteration was stopped early, still occupy the slots
+        while self._num_in_flight > 0:
+            self._get_result()
+        indices = self.get_indices(self.epoch)
+        self.epoch += 1
+
+        free_slots = list(range(self.num_slots))
+        slot_of_seq, received = {}, {}
+        num_submitted = 0
+        for seq in range(len(indices)):
+            while free_slots and num_submitted < len(indices):
+                slot = free_slots.pop()
+                slot_of_seq[num_submitted] = slot
+                self._task_queue.put((num_submitted, int(indices[num_submitted]), slot))
+                self._num_in_flight += 1
+                num_submitted += 1
+            while seq not in received:
+                done_seq, columns, error = self._get_result()
+                if error is not None:
+                    raise RuntimeError(f'Exception in dataloader worker for sample {indices[done_seq]}:\n{error}')
+                received[done_seq] = columns
+            slot = slot_of_seq.pop(seq)
+            sample = self._read_slot(slot, received.pop(seq))
+            free_slots.append(slot)
+            yield sample
@@ -10,11 +10,217 @@ from shapely.geometry import Polygon
 import numpy as np
 import random
 
+from ...utils.polygons import RaggedPolygons
+from .key_schema import KeySchema
+
 __all__ = ['DetLabelEncode', 'MakeBorderMap', 'MakeShrinkMap', 'EastRandomCropData', 'PSERandomCrop']
 
+
+class _ScratchBuffers(object):
+    ''' float32 scratch buffers reused across calls, grown when a larger size is requested '''
+    def __init__(self):
+        self._buffers = {}
+
+    def __getstate__(self):
+        # do not copy the buffers to the dataloader workers
+        return {'_buffers': {}}
+
+    def get(self, name, height, width):
+        buf = self._buffers.get(name)
+        if buf is None or buf.size < height * width:
+            buf = self._buffers[name] = np.empty(height * width, dtype=np.float32)
+        return buf[:height * width].reshape(height, width)
+
+
+def edge_distance_map(polygon, height, width, mode='exact', buffers=None):
+    '''
+    Compute the distance from each pixel of a (height, width) grid to the nearest edge of the polygon, in float32.
+
+    In 'exact' mode, the distance to an edge is the same as `MakeBorderMap._distance`: the distance to the line through
+    the edge if the edge subtends an obtuse (or right) angle at the pixel, otherwise the distance to the nearer end point.
+    It is computed in place on reused scratch buffers, without the per-edge stack of distance maps.
+    In 'approx' mode, the edges are drawn on the grid and cv2.distanceTransform gives the distance to the nearest drawn
+    pixel, which is faster on large polygons with an error about one pixel.
+
+    Args:
+        polygon (np.ndarray): polygon points in shape [N, 2], relative to the grid origin
+        height, width (int): grid size
+        mode (str): 'exact' or 'approx'
+        buffers (_ScratchBuffers): optional, scratch buffers to reuse
+    Returns:
+        np.ndarray: the distance map in shape [height, width]
+    '''
+    if buffers is None:
+        buffers = _ScratchBuffers()
+    if mode == 'approx':
+        edges = np.ones((height, width), dtype=np.uint8)
+        cv2.polylines(edges, [np.round(polygon * 16).astype(np.int32)], True, 0, thickness=1, shift=4)
+        return cv2.distanceTransform(edges, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+
+    polygon = polygon.astype(np.float32)
+    xs = np.arange(width, dtype=np.float32).reshape(1, width)
+    ys = np.arange(height, dtype=np.float32).reshape(height, 1)
+    result = np.full((height, width), np.inf, dtype=np.float32)
+    square_distance_1 = buffers.get('square_distance_1', height, width)
+    square_distance_2 = buffers.get('square_distance_2', height, width)
+    line_distance = buffers.get('line_distance', height, width)
+    end_point_distance = buffers.get('end_point_distance', height, width)
+    use_end_point = np.empty((height, width), dtype=bool)
+
+    dx_1, dy_1 = xs - polygon[0, 0], ys - polygon[0, 1]
+    np.add(np.square(dx_1), np.square(dy_1), out=square_distance_1)
+    for i in range(polygon.shape[0]):
+        j = (i + 1) % polygon.shape[0]
+        dx_2, dy_2 = xs - polygon[j, 0], ys - polygon[j, 1]
+        np.add(np.square(dx_2), np.square(dy_2), out=square_distance_2)
+        edge_x, edge_y = polygon[j, 0] - polygon[i, 0], polygon[j, 1] - polygon[i, 1]
+        square_edge = edge_x * edge_x + edge_y * edge_y
+
+        # acute angle at the pixel <=> square_distance_1 + square_distance_2 > square_edge
+        np.add(square_distance_1, square_distance_2, out=line_distance)
+        np.greater(line_distance, square_edge, out=use_end_point)
+        # distance to the line = |cross(edge, pixel - point_i)| / |edge|
+        np.subtract(edge_x * dy_1, edge_y * dx_1, out=line_distance)
+        np.abs(line_distance, out=line_distance)
+        if square_edge > 0:
+            line_distance *= 1 / np.sqrt(square_edge)
+        np.fmin(square_distance_1, square_distance_2, out=end_point_distance)
+        np.sqrt(end_point_distance, out=end_point_distance)
+        np.copyto(line_distance, end_point_distance, where=use_end_point)
+        np.fmin(result, line_distance, out=result)
+
+        dx_1, dy_1 = dx_2, dy_2
+        square_distance_1, square_distance_2 = square_distance_2, square_distance_1
+    return result
+
+
+def _round_half_away(x):
+    return np.trunc(x + np.copysign(0.5, x))
+
+
+def polygon_areas(polygons):
+    '''
+    Signed areas of the polygons by the shoelace formula, with the same sign as `MakeShrinkMap.polygon_area`, computed at
+    once for the polygons with the same number of points.
+    '''
+    areas = np.zeros(len(polygons), dtype=np.float64)
+    groups = {}
+    for i, polygon in enumerate(polygons):
+        groups.setdefault(len(polygon), []).append(i)
+    for indices in groups.values():
+        pts = np.array([polygons[i] for i in indices], dtype=np.float64)
+        prev_pts = np.roll(pts, 1, axis=1)
+        areas[indices] = np.sum(pts[..., 0] * prev_pts[..., 1] - pts[..., 1] * prev_pts[..., 0], axis=1) / 2.0
+    return areas
+
+
+def shrink_convex_quads(polygons, shrink_ratio):
+    '''
+    Shrink the convex quadrilaterals among the polygons analytically, as pyclipper.PyclipperOffset does, by the distance
+    D = A * (1 - r^2) / L, where A and L are the area and perimeter of the polygon and r is the shrink ratio.
+
+    The areas and perimeters of all quads are computed at once by the shoelace formula. Each edge is then moved inward
+    by D, and the new vertices are the intersections of the adjacent moved edges, which is the exact offset of a convex
+    polygon as long as no edge vanishes. Like pyclipper, the input coordinates are truncated and the output coordinates
+    are rounded to integers.
+
+    Args:
+        polygons: list of polygons, each of shape [num_points, 2]
+        shrink_ratio (float): the shrink ratio r
+    Returns:
+        list: for each polygon, the shrunk quad in int32 of shape [4, 2], or None if the polygon is not a convex quad,
+            or loses an edge when shrunk, which should be shrunk by pyclipper instead
+    '''
+    results = [None] * len(polygons)
+    if isinstance(polygons, RaggedPolygons):
+        quad_indices = np.flatnonzero(polygons.num_points() == 4)
+    else:
+        quad_indices = [i for i, polygon in enumerate(polygons) if len(polygon) == 4]
+    if len(quad_indices) == 0:
+        return results
+
+    def _edges_area_convex(pts):
+        edges = np.roll(pts, -1, axis=1) - pts  # edge i: point i -> point i+1
+        next_edges = np.roll(edges, -1, axis=1)
+        turns = edges[..., 0] * next_edges[..., 1] - edges[..., 1] * next_edges[..., 0]
+        next_pts = np.roll(pts, -1, axis=1)
+        area = 0.5 * np.sum(pts[..., 0] * next_pts[..., 1] - next_pts[..., 0] * pts[..., 1], axis=1)
+        convex = np.all(turns > 0, axis=1) | np.all(turns < 0, axis=1)
+        return edges, area, convex
+
+    if isinstance(polygons, RaggedPolygons):
+        pts = polygons.points[polygons.offsets[quad_indices][:, None] + np.arange(4)].astype(np.float64)
+    else:
+        pts = np.array([polygons[i] for i in quad_indices], dtype=np.float64)
+    edges, area, convex = _edges_area_convex(pts)
+    perimeter = np.sum(np.sqrt(np.sum(np.square(edges), axis=2)), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distance = np.abs(area) * (1 - shrink_ratio ** 2) / perimeter
+
+    pts = np.trunc(pts)
+    edges, area, int_convex = _edges_area_convex(pts)
+    edge_length = np.sqrt(np.sum(np.square(edges), axis=2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # inward unit normals, on the left side of the edges if the points are in counterclockwise order
+        normals = np.stack([-edges[..., 1], edges[..., 0]], axis=2) / edge_length[..., None]
+        normals *= np.sign(area)[:, None, None]
+        # the moved edges, whose end points are rounded as pyclipper does
+        offsets = distance[:, None, None] * normals
+        starts = _round_half_away(pts + offsets)
+        directions = _round_half_away(np.roll(pts, -1, axis=1) + offsets) - starts
+        # vertex i moves to the intersection of the moved edges i-1 and i
+        prev_starts, prev_directions = np.roll(starts, 1, axis=1), np.roll(directions, 1, axis=1)
+        delta = starts - prev_starts
+        denom = prev_directions[..., 0] * directions[..., 1] - prev_directions[..., 1] * directions[..., 0]
+        t = (delta[..., 0] * directions[..., 1] - delta[..., 1] * directions[..., 0]) / denom
+        shrunk = prev_starts + t[..., None] * prev_directions
+    # an edge vanished if it reversed its direction, the ones shorter than a pixel are also left to pyclipper
+    shrunk_edges = np.roll(shrunk, -1, axis=1) - shrunk
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kept = np.all(np.sum(shrunk_edges * edges, axis=2) > edge_length, axis=1)
+    valid = convex & int_convex & kept & np.isfinite(distance) & np.all(np.isfinite(shrunk), axis=(1, 2))
+
+    shrunk = _round_half_away(shrunk)
+    for k in np.nonzero(valid)[0]:
+        results[quad_indices[k]] = shrunk[k].astype(np.int32)
+    return results
+
+
+def _fill_polys(canvas, polys, value):
+    '''
+    Fill int32 polygons on the canvas. cv2.fillPoly fills multiple polygons by the even-odd rule, which leaves the
+    overlapped regions unfilled, so the polygons are grouped into layers whose bounding boxes are disjoint, and each
+    layer is filled in one call.
+    '''
+    if len(polys) == 0:
+        return
+    boxes = np.array([[p[:, 0].min(), p[:, 1].min(), p[:, 0].max(), p[:, 1].max()] for p in polys])
+    overlap = (boxes[:, None, 0] <= boxes[None, :, 2]) & (boxes[None, :, 0] <= boxes[:, None, 2]) & \
+              (boxes[:, None, 1] <= boxes[None, :, 3]) & (boxes[None, :, 1] <= boxes[:, None, 3])
+    layers = np.zeros(len(polys), dtype=np.int64)
+    if np.count_nonzero(overlap) > len(polys):  # not only the diagonal
+        for i in range(1, len(polys)):
+            used = np.zeros(i + 1, dtype=bool)
+            used[layers[:i][overlap[i, :i]]] = True
+            layers[i] = np.argmin(used)
+    for layer in range(layers.max() + 1):
+        cv2.fillPoly(canvas, [p for p, l in zip(polys, layers) if l == layer], value)
+
+
 class DetLabelEncode(object):
-    def __init__(self, **kwargs):
-        pass
+    '''
+    Args:
+        ragged (bool): if True, the polygons are given as RaggedPolygons, which keeps the points of each polygon
+            without padding and holds the ignore flags (the same array as `ignore_tags`). Otherwise, the polygons are
+            padded to the max number of points by repeating the last point. Default: False
+
+    If the image is decoded at a reduced scale before (DecodeImage with target_max_side), the polygons are scaled by
+    `decode_scale` to match the image.
+    '''
+    key_schema = KeySchema(reads=('label', 'decode_scale'), writes=('polys', 'texts', 'ignore_tags'))
+
+    def __init__(self, ragged=False, **kwargs):
+        self.ragged = ragged
 
     def order_points_clockwise(self, pts):
         rect = np.zeros((4, 2), dtype="float32")
@@ -44,7 +250,7 @@ class DetLabelEncode(object):
             label (str): string containgin points and transcription in json format
         added keys:
             polys (np.ndarray): polygon boxes in an image, each polygon is represented by points 
-                            in shape [num_polygons, num_points, 2]
+                            in shape [num_polygons, num_points, 2], or RaggedPolygons if ragged
             texts (List(str)): text string
             ignore_tags (np.ndarray[bool]): indicators for ignorable texts (e.g., '###') 
         '''
@@ -63,9 +269,19 @@ class DetLabelEncode(object):
                 txt_tags.append(False)
         if len(boxes) == 0:
             return None
-        boxes = self.expand_points_num(boxes)
-        boxes = np.array(boxes, dtype=np.float32)
-        txt_tags = np.array(txt_tags, dtype=np.bool)
+        txt_tags = np.array(txt_tags, dtype=bool)
+        if self.ragged:
+            boxes = RaggedPolygons.from_polys(boxes, txt_tags)
+            txt_tags = boxes.ignore
+        else:
+            boxes = self.expand_points_num(boxes)
+            boxes = np.array(boxes, dtype=np.float32)
+        if data.get('decode_scale', (1.0, 1.0)) != (1.0, 1.0):
+            scale_x, scale_y = data['decode_scale']
+            if self.ragged:
+                boxes = boxes.scale(scale_x, scale_y)
+            else:
+                boxes *= np.array([scale_x, scale_y], dtype=np.float32)
 
         data['polys'] = boxes
         data['texts'] = txts
@@ -74,14 +290,26 @@ class DetLabelEncode(object):
 
 
 class MakeBorderMap(object):
+    '''
+    Args:
+        shrink_ratio, thresh_min, thresh_max: see DBNet
+        distance_mode (str): how to compute the distance to polygon edges, 'exact' or 'approx' (by cv2.distanceTransform,
+            error about one pixel). See `edge_distance_map`. Default: 'exact'
+    '''
+    key_schema = KeySchema(reads=('image', 'polys', 'ignore_tags'), writes=('threshold_map', 'threshold_mask'))
+
     def __init__(self,
                  shrink_ratio=0.4,
                  thresh_min=0.3,
                  thresh_max=0.7,
+                 distance_mode='exact',
                  **kwargs):
+        assert distance_mode in ['exact', 'approx'], f'Invalid distance_mode {distance_mode}, valid values are exact and approx'
         self.shrink_ratio = shrink_ratio
         self.thresh_min = thresh_min
         self.thresh_max = thresh_max
+        self.distance_mode = distance_mode
+        self._buffers = _ScratchBuffers()
 
     def __call__(self, data):
 
@@ -129,20 +357,9 @@ class MakeBorderMap(object):
         polygon[:, 0] = polygon[:, 0] - xmin
         polygon[:, 1] = polygon[:, 1] - ymin
 
-        xs = np.broadcast_to(
-            np.linspace(
-                0, width - 1, num=width).reshape(1, width), (height, width))
-        ys = np.broadcast_to(
-            np.linspace(
-                0, height - 1, num=height).reshape(height, 1), (height, width))
-
-        distance_map = np.zeros(
-            (polygon.shape[0], height, width), dtype=np.float32)
-        for i in range(polygon.shape[0]):
-            j = (i + 1) % polygon.shape[0]
-            absolute_distance = self._distance(xs, ys, polygon[i], polygon[j])
-            distance_map[i] = np.clip(absolute_distance / distance, 0, 1)
-        distance_map = distance_map.min(axis=0)
+        distance_map = edge_distance_map(polygon, height, width, self.distance_mode, self._buffers)
+        distance_map /= distance
+        np.clip(distance_map, 0, 1, out=distance_map)
 
         xmin_valid = min(max(0, xmin), canvas.shape[1] - 1)
         xmax_valid = min(max(0, xmax), canvas.shape[1] - 1)
@@ -218,6 +435,9 @@ class MakeShrinkMap(object):
     adopted from https://github.com/PaddlePaddle/PaddleOCR/blob/HEAD/ppocr/data/imaug/make_shrink_map.py
     '''
 
+    key_schema = KeySchema(reads=('image', 'polys', 'ignore_tags'),
+                           writes=('polys', 'ignore_tags', 'shrink_map', 'shrink_mask'))
+
     def __init__(self, min_text_size=8, shrink_ratio=0.4, **kwargs):
         self.min_text_size = min_text_size
         self.shrink_ratio = shrink_ratio
@@ -230,16 +450,22 @@ class MakeShrinkMap(object):
         h, w = image.shape[:2]
         text_polys, ignore_tags = self.validate_polygons(text_polys,
                                                          ignore_tags, h, w)
+        # polygons are validated in place, except RaggedPolygons which gives a new container
+        data['polys'], data['ignore_tags'] = text_polys, ignore_tags
         gt = np.zeros((h, w), dtype=np.float32)
         mask = np.ones((h, w), dtype=np.float32)
+        # convex quads are shrunk analytically all at once, other polygons by pyclipper
+        shrunk_quads = shrink_convex_quads(text_polys, self.shrink_ratio)
+        ignored_polys, shrunk_polys = [], []
         for i in range(len(text_polys)):
             polygon = text_polys[i]
             height = max(polygon[:, 1]) - min(polygon[:, 1])
             width = max(polygon[:, 0]) - min(polygon[:, 0])
             if ignore_tags[i] or min(height, width) < self.min_text_size:
-                cv2.fillPoly(mask,
-                             polygon.astype(np.int32)[np.newaxis, :, :], 0)
+                ignored_polys.append(polygon.astype(np.int32))
                 ignore_tags[i] = True
+            elif shrunk_quads[i] is not None:
+                shrunk_polys.append(shrunk_quads[i])
             else:
                 polygon_shape = Polygon(polygon)
                 subject = [tuple(l) for l in polygon]
@@ -262,14 +488,16 @@ class MakeShrinkMap(object):
                         break
 
                 if shrinked == []:
-                    cv2.fillPoly(mask,
-                                 polygon.astype(np.int32)[np.newaxis, :, :], 0)
+                    ignored_polys.append(polygon.astype(np.int32))
                     ignore_tags[i] = True
                     continue
 
                 for each_shirnk in shrinked:
                     shirnk = np.array(each_shirnk).reshape(-1, 2)
-                    cv2.fillPoly(gt, [shirnk.astype(np.int32)], 1)
+                    shrunk_polys.append(shirnk.astype(np.int32))
+
+        _fill_polys(mask, ignored_polys, 0)
+        _fill_polys(gt, shrunk_polys, 1)
 
         data['shrink_map'] = gt
         data['shrink_mask'] = mask
@@ -282,12 +510,20 @@ class MakeShrinkMap(object):
         if len(polygons) == 0:
             return polygons, ignore_tags
         assert len(polygons) == len(ignore_tags)
+        if isinstance(polygons, RaggedPolygons):
+            polygons = polygons.clip(w, h)
+            # polygon_area has the opposite sign of RaggedPolygons.areas
+            areas = -polygons.areas()
+            polygons.ignore[np.abs(areas) < 1] = True
+            polygons = polygons.reverse(areas > 0)
+            return polygons, polygons.ignore
+
         for polygon in polygons:
-            polygon[:, 0] = np.clip(polygon[:, 0], 0, w - 1)
-            polygon[:, 1] = np.clip(polygon[:, 1], 0, h - 1)
+            np.clip(polygon, 0, [w - 1, h - 1], out=polygon)
 
+        areas = polygon_areas(polygons)
         for i in range(len(polygons)):
-            area = self.polygon_area(polygons[i])
+            area = areas[i]
             if abs(area) < 1:
                 ignore_tags[i] = True
             if area > 0:
@@ -317,6 +553,9 @@ class EastRandomCropData():
     broken text instances, we will crop it's bbox and polygon coordinates. This
     transform is recommend to be used in segmentation-based network.
     '''
+    key_schema = KeySchema(reads=('image', 'polys', 'ignore_tags', 'texts'),
+                           writes=('image', 'polys', 'ignore_tags', 'texts'))
+
     def __init__(self, size=(640, 640), max_tries=50, min_crop_side_ratio=0.1, require_original_image=False, keep_ratio=True):
         self.size = size
         self.max_tries = max_tries
@@ -354,6 +593,15 @@ class EastRandomCropData():
         else:
             img = cv2.resize(im[crop_y:crop_y + crop_h, crop_x:crop_x + crop_w], tuple(self.size))
         # crop 文本框
+        if isinstance(text_polys, RaggedPolygons):
+            text_polys = text_polys.transform([[scale, 0, -crop_x * scale], [0, scale, -crop_y * scale]])
+            keep = np.flatnonzero(~text_polys.outside_rect(0, 0, w, h))
+            text_polys = text_polys.select(keep)
+            data['image'] = img
+            data['polys'] = text_polys
+            data['ignore_tags'] = text_polys.ignore
+            data['texts'] = [texts[i] for i in keep]
+            return data
         text_polys_crop = []
         ignore_tags_crop = []
         texts_crop = []
@@ -465,6 +713,8 @@ class PSERandomCrop():
     '''
     Code adopted from https://github1s.com/WenmuZhou/DBNet.pytorch/blob/master/data_loader/modules/random_crop_data.py
     '''
+    key_schema = KeySchema(reads=('imgs',), writes=('imgs',))
+
     def __init__(self, size):
         self.size = size
 
@@ -1,11 +1,37 @@
 from typing import List, Union
+import io
 import cv2
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 
 from mindcv.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 
-__all__ = ['DecodeImage', 'NormalizeImage', 'ToCHWImage', 'PackLoaderInputs']
+from .key_schema import KeySchema
+from ...utils.polygons import RaggedPolygons
+
+__all__ = ['DecodeImage', 'NormalizeImage', 'ToCHWImage', 'NormalizeToCHW', 'PackLoaderInputs', 'DropKeys']
+
+
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(buf):
+    ''' return (height, width) parsed from the JPEG header, or None if buf is not a JPEG image '''
+    buf = memoryview(buf)
+    if len(buf) < 4 or buf[0] != 0xFF or buf[1] != 0xD8:
+        return None
+    pos = 2
+    while pos + 9 <= len(buf):
+        if buf[pos] != 0xFF:
+            return None
+        marker = buf[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker in _SOF_MARKERS:
+            return (buf[pos + 5] << 8) | buf[pos + 6], (buf[pos + 7] << 8) | buf[pos + 8]
+        pos += 2 + ((buf[pos + 2] << 8) | buf[pos + 3])
+    return None
 
 
 # TODO: use mindspore C.decode for efficiency
@@ -13,12 +39,80 @@ class DecodeImage(object):
     """
     img_mode (str): The channel order of the output, 'BGR' and 'RGB'. Default to 'BGR'.
     channel_first (bool): if True, image shpae is CHW. If False, HWC. Default to False
+    backend (str): image decoding library, 'cv2' (OpenCV), 'pil' (Pillow) or 'turbojpeg' (PyTurboJPEG, which needs
+        libjpeg-turbo installed, and falls back to OpenCV for non-JPEG images). Note that turbojpeg does not apply the
+        EXIF orientation. Default to 'cv2'.
+    target_max_side (int): optional hint of the max image side needed by the following transforms. JPEG images larger
+        than 2x of it are decoded at 1/2, 1/4 or 1/8 scale in the DCT domain, which is much cheaper than decoding at
+        full resolution, while the longer side stays no smaller than target_max_side. The applied (scale_x, scale_y) is
+        recorded in `decode_scale`, which DetLabelEncode applies to the polygons it encodes afterwards. If `polys`
+        already exist in data, they are scaled here. Default to None, full resolution.
     """
-    def __init__(self, img_mode='BGR', channel_first=False, to_float32=False, ignore_orientation=False, **kwargs):
+    key_schema = KeySchema(reads=('img_path', 'img_lmdb', 'polys'), writes=('image',))
+
+    def __init__(self, img_mode='BGR', channel_first=False, to_float32=False, ignore_orientation=False,
+                 backend='cv2', target_max_side=None, **kwargs):
+        assert backend in ['cv2', 'pil', 'turbojpeg'], f'Invalid backend {backend}, valid values are cv2, pil and turbojpeg'
         self.img_mode = img_mode
         self.to_float32 = to_float32
         self.channel_first = channel_first
+        self.ignore_orientation = ignore_orientation
         self.flag = cv2.IMREAD_IGNORE_ORIENTATION | cv2.IMREAD_COLOR if ignore_orientation else cv2.IMREAD_COLOR
+        self.backend = backend
+        self.target_max_side = target_max_side
+        if target_max_side is not None:
+            self.key_schema = self.key_schema._replace(writes=('image', 'decode_scale'))
+        self._turbojpeg = None
+        if backend == 'turbojpeg':
+            try:
+                import turbojpeg
+            except ImportError:
+                raise ImportError('The turbojpeg backend requires PyTurboJPEG and libjpeg-turbo, '
+                                  'please install them by `pip install PyTurboJPEG` or use the cv2 backend.')
+
+    def __getstate__(self):
+        # the TurboJPEG handle can not be pickled, create it again in each worker process
+        state = self.__dict__.copy()
+        state['_turbojpeg'] = None
+        return state
+
+    def get_reduce_factor(self, buf):
+        ''' return the largest factor in [1, 2, 4, 8] to reduce the JPEG image by, according to target_max_side '''
+        if self.target_max_side is None:
+            return 1
+        size = jpeg_size(buf)
+        if size is None:
+            return 1
+        factor = 1
+        while factor < 8 and max(size) // (factor * 2) >= self.target_max_side:
+            factor *= 2
+        return factor
+
+    def decode_cv2(self, buf, factor):
+        flag = self.flag
+        if factor > 1:
+            flag = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}[factor]
+            if self.ignore_orientation:
+                flag |= cv2.IMREAD_IGNORE_ORIENTATION
+        return cv2.imdecode(np.frombuffer(buf, dtype='uint8'), flag)
+
+    def decode_pil(self, buf, factor):
+        img = Image.open(io.BytesIO(buf))
+        if factor > 1:
+            # JPEG draft mode picks the DCT scale giving a size no smaller than the requested one
+            img.draft('RGB', (img.size[0] // factor, img.size[1] // factor))
+        if not self.ignore_orientation:
+            img = ImageOps.exif_transpose(img)
+        img = np.asarray(img.convert('RGB'))
+        return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+    def decode_turbojpeg(self, buf, factor):
+        if jpeg_size(buf) is None:
+            return self.decode_cv2(buf, 1)
+        if self._turbojpeg is None:
+            from turbojpeg import TurboJPEG
+            self._turbojpeg = TurboJPEG()
+        return self._turbojpeg.decode(bytes(buf), scaling_factor=(1, factor) if factor > 1 else None)  # BGR by default
 
     def __call__(self, data):
         #img = cv2.imread(data['img_path'], self.flag)
@@ -28,8 +122,28 @@ class DecodeImage(object):
                 img = f.read()
         elif 'img_lmdb' in data:
             img = data["img_lmdb"]
-        img = np.frombuffer(img, dtype='uint8')
-        img = cv2.imdecode(img, self.flag)
+
+        factor = self.get_reduce_factor(img)
+        if self.backend == 'pil':
+            decoded = self.decode_pil(img, factor)
+        elif self.backend == 'turbojpeg':
+            decoded = self.decode_turbojpeg(img, factor)
+        else:
+            decoded = self.decode_cv2(img, factor)
+
+        if self.target_max_side is not None:
+            scale = (1.0, 1.0)
+            if factor > 1:
+                h, w = jpeg_size(img)
+                if (decoded.shape[0] > decoded.shape[1]) != (h > w) and h != w:
+                    h, w = w, h  # rotated by EXIF orientation
+                scale = (decoded.shape[1] / w, decoded.shape[0] / h)
+                if isinstance(data.get('polys'), RaggedPolygons):
+                    data['polys'] = data['polys'].scale(*scale)
+                elif 'polys' in data:
+                    data['polys'] = data['polys'] * np.array(scale, dtype=np.float32)
+            data['decode_scale'] = scale
+        img = decoded
 
         if self.img_mode == 'RGB':
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -50,6 +164,8 @@ class NormalizeImage:
     input image: by default, np.uint8, [0, 255], HWC format.
     return image: float32 numpy array
     """
+    key_schema = KeySchema(reads=('image',), writes=('image',))
+
     def __init__(self, mean: Union[List[float], str] = 'imagenet', std: Union[List[float], str] = 'imagenet',
                  is_hwc=True, bgr_to_rgb=False, rgb_to_bgr=False, **kwargs):
         # By default, imagnet MEAN and STD is in RGB order. inverse if input image is in BGR mode
@@ -91,6 +207,8 @@ class NormalizeImage:
 
 class ToCHWImage:
     # convert hwc image to chw image
+    key_schema = KeySchema(reads=('image',), writes=('image',))
+
     def __init__(self, **kwargs):
         pass
 
@@ -102,6 +220,67 @@ class ToCHWImage:
         return data
 
 
+class NormalizeToCHW:
+    """
+    Fused NormalizeImage (is_hwc=True) and ToCHWImage. uint8 pixels are mapped through per-channel lookup tables of the
+    normalized values and written to a contiguous CHW buffer directly, with the channel swap done in the same pass.
+    Output values are the same as NormalizeImage followed by ToCHWImage. Non-uint8 input is normalized arithmetically.
+
+    input image: np.uint8, [0, 255], HWC format.
+    return image: contiguous CHW numpy array of `dtype`
+
+    Args:
+        mean, std, bgr_to_rgb, rgb_to_bgr: see NormalizeImage
+        dtype (str): output data type, 'float32' or 'float16'
+    """
+    key_schema = KeySchema(reads=('image',), writes=('image',))
+
+    def __init__(self, mean: Union[List[float], str] = 'imagenet', std: Union[List[float], str] = 'imagenet',
+                 bgr_to_rgb=False, rgb_to_bgr=False, dtype='float32', **kwargs):
+        assert dtype in ['float32', 'float16'], f'Invalid dtype {dtype}, valid values are float32 and float16'
+        self.mean = np.array(NormalizeImage._get_value(mean, 'mean')).astype('float32')
+        self.std = np.array(NormalizeImage._get_value(std, 'std')).astype('float32')
+        self._channel_conversion = bgr_to_rgb or rgb_to_bgr
+        self.dtype = dtype
+        # luts[c][v] = (v - mean[c]) / std[c], computed in float32 as in NormalizeImage. cv2.LUT does not support
+        # float16, so float16 tables are applied as uint16 bit patterns.
+        values = np.arange(256, dtype='float32')
+        self._lut_dtype = 'float32' if dtype == 'float32' else 'uint16'
+        self.luts = [((values - m) / s).astype(dtype).view(self._lut_dtype).reshape(1, 256)
+                     for m, s in zip(self.mean, self.std)]
+
+    @classmethod
+    def from_transforms(cls, normalize: NormalizeImage, dtype='float32'):
+        ''' create from a NormalizeImage transform in HWC mode '''
+        assert normalize.is_hwc, 'only NormalizeImage in HWC mode can be fused with ToCHWImage'
+        return cls(mean=normalize.mean.reshape(-1).tolist(), std=normalize.std.reshape(-1).tolist(),
+                   bgr_to_rgb=normalize._channel_conversion, dtype=dtype)
+
+    def __call__(self, data):
+        img = data['image']
+        if isinstance(img, Image.Image):
+            img = np.array(img)
+        assert isinstance(img, np.ndarray) and img.ndim == 3, "invalid input 'img' in NormalizeToCHW"
+
+        num_channels = img.shape[2]
+        out = np.empty((num_channels, img.shape[0], img.shape[1]), dtype=self.dtype)
+        if img.dtype == np.uint8:
+            planes = cv2.split(img)
+            out_planes = out.view(self._lut_dtype)
+            for c in range(num_channels):
+                src = planes[num_channels - 1 - c] if self._channel_conversion else planes[c]
+                dst = out_planes[c]
+                res = cv2.LUT(src, self.luts[c], dst=dst)
+                if res.ctypes.data != dst.ctypes.data:
+                    dst[...] = res
+        else:
+            for c in range(num_channels):
+                src = img[..., num_channels - 1 - c] if self._channel_conversion else img[..., c]
+                out[c] = (src.astype('float32') - self.mean[c]) / self.std[c]
+        data['image'] = out
+        return data
+
+
 class PackLoaderInputs:
     """
     Args:
@@ -113,6 +292,7 @@ class PackLoaderInputs:
     """
     def __init__(self, output_keys: List, **kwargs):
         self.output_keys = output_keys
+        self.key_schema = KeySchema(reads=tuple(output_keys))
 
     def __call__(self, data):
         out = []
@@ -120,4 +300,25 @@ class PackLoaderInputs:
             assert k in data, f'key {k} does not exists in data, availabe keys are {data.keys()}'
             out.append(data[k])
 
-        return tuple(out)
\ No newline at end of file
+        return tuple(out)
+
+
+class DropKeys(object):
+    """
+    Delete keys from the data dict, e.g., the ones not used by the following transforms, to save memory. It is inserted
+    by `create_transforms` automatically if `output_keys` is given.
+
+    Args:
+        keys (list): the keys to delete, the missing ones are skipped
+    """
+    def __init__(self, keys: List, **kwargs):
+        self.keys = list(keys)
+        self.key_schema = KeySchema(drops=tuple(keys))
+
+    def __call__(self, data):
+        for k in self.keys:
+            data.pop(k, None)
+        return data
+
+    def __repr__(self):
+        return f'DropKeys({self.keys})'
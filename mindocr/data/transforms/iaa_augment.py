@@ -6,6 +6,9 @@ import numpy as np
 import imgaug
 import imgaug.augmenters as iaa
 
+from ...utils.polygons import RaggedPolygons
+from .key_schema import KeySchema
+
 __all__ = ['IaaAugment']
 
 class AugmenterBuilder(object):
@@ -38,6 +41,8 @@ class AugmenterBuilder(object):
 
 
 class IaaAugment():
+    key_schema = KeySchema(reads=('image', 'polys'), writes=('image', 'polys'))
+
     def __init__(self, augmenter_args=None, **kwargs):
         if augmenter_args is None:
             augmenter_args = [{
@@ -72,11 +77,15 @@ class IaaAugment():
         if aug is None:
             return data
 
-        line_polys = []
-        for poly in data['polys']:
-            new_poly = self.may_augment_poly(aug, shape, poly)
-            line_polys.append(new_poly)
-        data['polys'] = np.array(line_polys)
+        # the points of all polygons are augmented at once
+        polys = RaggedPolygons.from_polys(data['polys'])
+        keypoints = imgaug.KeypointsOnImage.from_xy_array(polys.points, shape=shape)
+        points = aug.augment_keypoints([keypoints])[0].to_xy_array()
+        if isinstance(data['polys'], RaggedPolygons):
+            data['polys'] = RaggedPolygons(points, polys.offsets, polys.ignore)
+        else:
+            points = points.astype(np.float64)
+            data['polys'] = np.array([points[polys.offsets[i]: polys.offsets[i + 1]] for i in range(len(polys))])
         return data
 
     def may_augment_poly(self, aug, img_shape, poly):
@@ -0,0 +1,56 @@
+'''
+Declaration of the data keys used by the transforms, to check the output keys of a transform pipeline statically and
+to drop the keys from the data dict as soon as the last transform using them has run.
+'''
+from collections import namedtuple
+
+__all__ = ['KeySchema', 'get_output_keys', 'plan_key_drops']
+
+# keys a transform reads (including the ones read or modified only if present), writes (always adds or sets) and drops
+# from data. A transform declares it as the class (or instance) attribute `key_schema`.
+KeySchema = namedtuple('KeySchema', ['reads', 'writes', 'drops'], defaults=((), (), ()))
+
+
+def get_output_keys(transforms, input_keys):
+    '''
+    Return the keys in the data dict after running the transforms on a data dict of input_keys, or None if a transform
+    does not declare its `key_schema`.
+    '''
+    keys = list(input_keys)
+    for transform in transforms:
+        schema = getattr(transform, 'key_schema', None)
+        if schema is None:
+            return None
+        keys = [k for k in keys if k not in schema.drops]
+        keys += [k for k in schema.writes if k not in keys]
+    return keys
+
+
+def plan_key_drops(transforms, input_keys, output_keys):
+    '''
+    Return the list of keys to drop after each transform, with the keys to drop before the first transform at index 0,
+    i.e. in length len(transforms) + 1. A key not in output_keys is dropped after the last transform reading or
+    writing it. A transform without `key_schema` is taken as using all keys, and nothing is dropped after the last
+    transform as the data dict is not used any more.
+    '''
+    last_use = {k: -1 for k in input_keys}
+    for i, transform in enumerate(transforms):
+        schema = getattr(transform, 'key_schema', None)
+        if schema is None:
+            for k in last_use:
+                last_use[k] = i
+            continue
+        # only the keys that may be in data, i.e. the input keys and the written ones, are tracked
+        for k in schema.reads:
+            if k in last_use:
+                last_use[k] = i
+        for k in schema.writes:
+            last_use[k] = i
+        for k in schema.drops:
+            last_use.pop(k, None)
+
+    drops = [[] for _ in range(len(transforms) + 1)]
+    for k, i in last_use.items():
+        if k not in output_keys and i < len(transforms) - 1:
+            drops[i + 1].append(k)
+    return drops
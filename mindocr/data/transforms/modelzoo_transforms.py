@@ -4,6 +4,7 @@ transforms adopted from model zoo.
 import cv2
 import numpy as np
 import math
+import random
 import warnings
 import pyclipper
 from shapely.geometry import Polygon
@@ -11,14 +12,21 @@ import numpy as np
 from mindspore.dataset.vision import RandomColorAdjust, ToPIL, ToTensor
 from mindcv.data.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 
+from ...utils.polygons import RaggedPolygons
+from .det_transforms import edge_distance_map, shrink_convex_quads, _ScratchBuffers, _fill_polys
+from .key_schema import KeySchema
+
 #IMAGENET_DEFAULT_MEAN = [0.485 * 255, 0.456 * 255, 0.406 * 255]
 #IMAGENET_DEFAULT_STD = [0.229 * 255, 0.224 * 255, 0.225 * 255]
 
 __all__ = ['MZRandomColorAdjust', 'MZScalePad', 'MZResizeByGrid', 'MZRandomCropData',
-            'MZRandomScaleByShortSide', 'MZMakeSegDetectionData', 'MZMakeBorderMap', 'MZIncorrectNormToCHW']
+            'MZRandomScaleByShortSide', 'MZRandomAffineCrop', 'MZMakeSegDetectionData', 'MZMakeBorderMap',
+            'MZIncorrectNormToCHW']
 
 # TODO: Does it support BGR mode?
 class MZRandomColorAdjust():
+    key_schema = KeySchema(reads=('image',), writes=('image',))
+
     def __init__(self, brightness=32.0 / 255, saturation=0.5, to_numpy=False):
         self.colorjitter = RandomColorAdjust(brightness=brightness, saturation=saturation)
         self.to_numpy = to_numpy
@@ -44,6 +52,8 @@ class MZIncorrectNormToCHW():
     WARNING: this op can be problematic.
     '''
     # TODO: by default, image deocde op (using cv2) output in BGR mode. but the default mean in ImageNet is in RGB mode. But in both ppocr and mmocr, they ignore this difference.
+    key_schema = KeySchema(reads=('image',), writes=('image',))
+
     def __init__(self, mean=IMAGENET_DEFAULT_MEAN):
         self.mean = np.array(mean)
         self.to_tensor = ToTensor()
@@ -63,6 +73,8 @@ class MZScalePad():
     scale image and polys with short side, then pad to eval_size.
     input image format: hwc
     '''
+    key_schema = KeySchema(reads=('image', 'polys'), writes=('image', 'shape'))
+
     def __init__(self, eval_size=[736, 1280]):
         self.eval_size = eval_size
 
@@ -97,7 +109,7 @@ class MZScalePad():
         data['image'] = padimg
         #print('polys: ', type(polys))
         if polys is not None:
-            polys = polys * scale
+            polys = polys.scale(scale) if isinstance(polys, RaggedPolygons) else polys * scale
             data['polys'] = polys
 
         data['shape'] = np.array([h, w, scale, scale], dtype='float32')
@@ -109,6 +121,8 @@ class MZResizeByGrid(object):
     resize image by ratio so that it's shape is align to grid of divisor
     required key in data: img in shape of (h, w, c)
     '''
+    key_schema = KeySchema(reads=('image', 'polys'), writes=('image',))
+
     def __init__(self, divisor=32, transform_polys=True):
         self.divisor = divisor
         #self.is_train = is_train
@@ -129,6 +143,9 @@ class MZResizeByGrid(object):
 
         if polys is None:
             return data
+        if isinstance(polys, RaggedPolygons):
+            data['polys'] = polys.scale(w_scale, h_scale)
+            return data
 
         #if self.is_train:
         polys[:, :, 0] = polys[:, :, 0] * w_scale
@@ -159,6 +176,8 @@ def solve_polys(polys):
 
 class MZRandomCropData:
     """Random crop class, include many crop relevant functions."""
+    key_schema = KeySchema(reads=('image', 'polys', 'ignore_tags'), writes=('image', 'polys', 'ignore_tags'))
+
     def __init__(self, max_tries=10, min_crop_side_ratio=0.1, crop_size=(640, 640)):
         self.size = crop_size
         self.min_crop_side_ratio = min_crop_side_ratio
@@ -184,6 +203,15 @@ class MZRandomCropData:
         padimg[:h, :w] = cv2.resize(img[crop_y:crop_y + crop_h, crop_x:crop_x + crop_w], (w, h))
         img = padimg
 
+        if isinstance(polys, RaggedPolygons):
+            polys = polys.transform([[scale, 0, -crop_x * scale], [0, scale, -crop_y * scale]])
+            # Filter out the polys in the cropped rectangle.
+            polys = polys.select(~polys.outside_rect(0, 0, w, h))
+            data['image'] = img
+            data['polys'] = polys
+            data['ignore_tags'] = polys.ignore
+            return data
+
         # TODO: use numpy compute, not list
         new_polys = []
         new_dontcare = []
@@ -268,7 +296,13 @@ class MZRandomCropData:
         Randomly select a rectangle containing polys from the img.
         Return the start point and side lengths of the selected rectangle.
         '''
-        h, w, _ = img.shape
+        h, w = img.shape[:2]
+        return self.crop_area_by_size(h, w, polys)
+
+    def crop_area_by_size(self, h, w, polys):
+        '''
+        Randomly select a rectangle containing polys from an image of size (h, w), see `crop_area`.
+        '''
         h_array = np.zeros(h, dtype=np.int32)
         w_array = np.zeros(w, dtype=np.int32)
 
@@ -320,6 +354,8 @@ class MZRandomCropData:
         return 0, 0, w, h
 
 class MZRandomScaleByShortSide():
+    key_schema = KeySchema(reads=('image', 'polys'), writes=('image', 'polys'))
+
     def __init__(self, short_side):
         self.short_side = short_side
 
@@ -332,15 +368,18 @@ class MZRandomScaleByShortSide():
         img = data['image']
         short_side =self.short_side
 
-        polys, max_points = solve_polys(polys)
+        ragged = isinstance(polys, RaggedPolygons)
+        if not ragged:
+            polys, max_points = solve_polys(polys)
         h, w = img.shape[0:2]
+        src_h, src_w = h, w
 
         #print(h, w, polys, max_points)
 
         # polys -> polys' scale w.r.t original.
         # TODO: use np compute, not list
         polys_scale = []
-        for poly in polys:
+        for poly in ([] if ragged else polys):
             poly = np.asarray(poly)
             #poly = poly / ([w * 1.0, h * 1.0] * max_points)
             poly = poly / [w * 1.0, h * 1.0]
@@ -365,13 +404,118 @@ class MZRandomScaleByShortSide():
         # Rescale polys: (N, 8) -> (N, 4, 2)
         #new_polys = (polys_scale * ([img.shape[1], img.shape[0]] * max_points)).reshape((polys.shape[0], polys.shape[1] // 2, 2))
 
-        new_polys = polys_scale * ([img.shape[1], img.shape[0]])
+        if ragged:
+            new_polys = polys.scale(img.shape[1] / src_w, img.shape[0] / src_h)
+        else:
+            new_polys = polys_scale * ([img.shape[1], img.shape[0]])
         #print(new_polys.shape, )
 
         data['image'] = img
         data['polys'] = new_polys
         return data
 
+class MZRandomAffineCrop(object):
+    '''
+    Random scale, rotation, horizontal flip and crop in one affine warp, equivalent in distribution to the chain of
+    MZRandomScaleByShortSide, IaaAugment (Affine rotate and Fliplr) and MZRandomCropData, which resamples the full
+    (often upscaled) image at every step.
+
+    The random parameters are drawn as in the chain: the scale from `scales` (clipped so that the short side is larger
+    than `short_side`), the rotation angle about the image center and the flip. The polygons are transformed by the
+    composed matrix, and the crop window is selected on them in the coordinates of the scaled and rotated image (of
+    the same size as in the chain) by MZRandomCropData. The output image of crop_size is then warped from the input
+    image directly.
+
+    Args:
+        short_side (int): the minimum short side after scaling
+        max_side (int): the image is first scaled down to this max side if larger
+        scales (list): scales to randomly choose from
+        rotate (list): range of the rotation angle in degrees
+        flip_prob (float): probability of horizontal flip
+        max_tries, min_crop_side_ratio, crop_size: see MZRandomCropData
+    '''
+    key_schema = KeySchema(reads=('image', 'polys', 'ignore_tags'), writes=('image', 'polys', 'ignore_tags'))
+
+    def __init__(self, short_side=736, max_side=1280, scales=(0.5, 1.0, 2.0, 3.0), rotate=(-10, 10), flip_prob=0.5,
+                 max_tries=100, min_crop_side_ratio=0.1, crop_size=(640, 640)):
+        self.short_side = short_side
+        self.max_side = max_side
+        self.scales = np.array(scales)
+        self.rotate = rotate
+        self.flip_prob = flip_prob
+        self.cropper = MZRandomCropData(max_tries, min_crop_side_ratio, crop_size)
+
+    def get_params(self, h, w):
+        '''
+        Draw the random parameters for an image of size (h, w).
+        Return the (3, 3) matrix to the scaled, rotated and flipped image, and its size (h, w).
+        '''
+        # scale, as MZRandomScaleByShortSide
+        if max(h, w) > self.max_side:
+            pre_scale = self.max_side / max(h, w)
+            scaled_h, scaled_w = round(h * pre_scale), round(w * pre_scale)
+        else:
+            scaled_h, scaled_w = h, w
+        scale = np.random.choice(self.scales)
+        if min(scaled_h, scaled_w) * scale <= self.short_side:
+            scale = (self.short_side + 10) * 1.0 / min(scaled_h, scaled_w)
+        scaled_h, scaled_w = round(scaled_h * scale), round(scaled_w * scale)
+        matrix = np.diag([scaled_w / w, scaled_h / h, 1.])
+
+        # rotation about the center and flip, as imgaug Affine and Fliplr on keypoints. They are drawn from a separate
+        # random generator like imgaug, so that np.random is consumed in the same way as the chain.
+        angle = np.deg2rad(random.uniform(*self.rotate))
+        cos, sin = np.cos(angle), np.sin(angle)
+        center_x, center_y = scaled_w / 2., scaled_h / 2.
+        rotation = np.array([[cos, -sin, center_x - cos * center_x + sin * center_y],
+                             [sin, cos, center_y - sin * center_x - cos * center_y],
+                             [0, 0, 1.]])
+        matrix = rotation @ matrix
+        if random.random() < self.flip_prob:
+            matrix = np.array([[-1, 0, scaled_w], [0, 1, 0], [0, 0, 1.]]) @ matrix
+        return matrix, scaled_h, scaled_w
+
+    def __call__(self, data):
+        '''
+        required keys:
+            image, polys, ignore_tags
+        modified keys:
+            image, polys, ignore_tags
+        '''
+        img = data['image']
+        ragged = isinstance(data['polys'], RaggedPolygons)
+        polys = data['polys'] if ragged else RaggedPolygons.from_polys(data['polys'], data['ignore_tags'])
+        h, w = img.shape[:2]
+
+        matrix, scaled_h, scaled_w = self.get_params(h, w)
+        scaled_polys = polys.transform(matrix)
+
+        # crop, as MZRandomCropData
+        all_care_polys = [scaled_polys[i] for i in np.flatnonzero(~polys.ignore)]
+        crop_x, crop_y, crop_w, crop_h = self.cropper.crop_area_by_size(scaled_h, scaled_w, all_care_polys)
+        size = self.cropper.size
+        scale = min(size[0] / crop_w, size[1] / crop_h)
+        crop_h, crop_w = int(crop_h * scale), int(crop_w * scale)
+        matrix = np.array([[scale, 0, -crop_x * scale], [0, scale, -crop_y * scale], [0, 0, 1.]]) @ matrix
+
+        # the matrix maps the polygon coordinates, where the center of pixel (i, j) is (j + 0.5, i + 0.5),
+        # warpAffine takes the pixel indices
+        pixel_matrix = matrix.copy()
+        pixel_matrix[:2, 2] += pixel_matrix[:2, :2].sum(axis=1) * 0.5 - 0.5
+        padimg = np.zeros((size[1], size[0]) + img.shape[2:], img.dtype)
+        padimg[:crop_h, :crop_w] = cv2.warpAffine(img, pixel_matrix[:2], (crop_w, crop_h), flags=cv2.INTER_LINEAR,
+                                                  borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        polys = polys.transform(matrix)
+        # Filter out the polys outside the cropped rectangle.
+        polys = polys.select(~polys.outside_rect(0, 0, crop_w, crop_h))
+
+        data['image'] = padimg
+        data['polys'] = polys if ragged else polys.to_padded()
+        data['ignore_tags'] = polys.ignore if ragged else polys.ignore.tolist()
+        return data
+
+
 # lable
 """DBNet Dataset pre process functions."""
 warnings.filterwarnings("ignore")
@@ -381,6 +525,9 @@ class MZMakeSegDetectionData:
     Making binary mask from detection data with ICDAR format.
     Typically following the process of class `MakeICDARData`.
     """
+    key_schema = KeySchema(reads=('image', 'polys', 'ignore_tags'),
+                           writes=('polys', 'ignore_tags', 'shrink_map', 'shrink_mask'))
+
     def __init__(self, min_text_size=8, shrink_ratio=0.4, is_training=True):
         self.min_text_size = min_text_size
         self.shrink_ratio = shrink_ratio
@@ -403,15 +550,22 @@ class MZMakeSegDetectionData:
         h, w = img.shape[:2]
         if self.is_training:
             polys, dontcare = self.validate_polygons(polys, dontcare, h, w)
+            # polygons are validated in place, except RaggedPolygons which gives a new container
+            data['polys'], data['ignore_tags'] = polys, dontcare
         gt = np.zeros((1, h, w), dtype=np.float32)
         mask = np.ones((h, w), dtype=np.float32)
+        # convex quads are shrunk analytically all at once, other polygons by pyclipper
+        shrunk_quads = shrink_convex_quads(polys, self.shrink_ratio)
+        ignored_polys, shrunk_polys = [], []
         for i in range(len(polys)):
             polygon = polys[i]
             height = max(polygon[:, 1]) - min(polygon[:, 1])
             width = max(polygon[:, 0]) - min(polygon[:, 0])
             if dontcare[i] or min(height, width) < self.min_text_size:
-                cv2.fillPoly(mask, polygon.astype(np.int32)[np.newaxis, :, :], 0)
+                ignored_polys.append(polygon.astype(np.int32))
                 dontcare[i] = True
+            elif shrunk_quads[i] is not None:
+                shrunk_polys.append(shrunk_quads[i])
             else:
                 polygon_shape = Polygon(polygon)
                 distance = polygon_shape.area * \
@@ -421,11 +575,14 @@ class MZMakeSegDetectionData:
                 padding.AddPath(subject, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
                 shrunk = padding.Execute(-distance)
                 if shrunk == []:
-                    cv2.fillPoly(mask, polygon.astype(np.int32)[np.newaxis, :, :], 0)
+                    ignored_polys.append(polygon.astype(np.int32))
                     dontcare[i] = True
                     continue
                 shrunk = np.array(shrunk[0]).reshape(-1, 2)
-                cv2.fillPoly(gt[0], [shrunk.astype(np.int32)], 1)
+                shrunk_polys.append(shrunk.astype(np.int32))
+
+        _fill_polys(mask, ignored_polys, 0)
+        _fill_polys(gt[0], shrunk_polys, 1)
 
         data['shrink_map'] = gt
         data['shrink_mask'] = mask
@@ -436,6 +593,14 @@ class MZMakeSegDetectionData:
         if polygons is None:
             return polygons, ignore_tags
         assert len(polygons) == len(ignore_tags)
+        if isinstance(polygons, RaggedPolygons):
+            polygons = polygons.clip(w, h)
+            # polygon_area of all polygons
+            edges = polygons.edges().astype(np.float64)
+            areas = polygons.reduce(edges[:, 0] * edges[:, 1]) / 2.
+            polygons.ignore[np.abs(areas) < 1] = True
+            polygons = polygons.reverse(areas > 0)
+            return polygons, polygons.ignore
 
         for polygon in polygons:
             polygon[:, 0] = np.clip(polygon[:, 0], 0, w - 1)
@@ -459,12 +624,17 @@ class MZMakeSegDetectionData:
 
 
 class MZMakeBorderMap:
-    def __init__(self, shrink_ratio=0.4, thresh_min=0.3, thresh_max=0.7):
+    key_schema = KeySchema(reads=('image', 'polys', 'ignore_tags'), writes=('threshold_map', 'threshold_mask'))
+
+    def __init__(self, shrink_ratio=0.4, thresh_min=0.3, thresh_max=0.7, distance_mode='exact'):
 
         super(MZMakeBorderMap, self).__init__()
+        assert distance_mode in ['exact', 'approx'], f'Invalid distance_mode {distance_mode}, valid values are exact and approx'
         self.shrink_ratio = shrink_ratio
         self.thresh_min = thresh_min
         self.thresh_max = thresh_max
+        self.distance_mode = distance_mode
+        self._buffers = _ScratchBuffers()
 
     #def process(self, img, polys, dontcare):
     def __call__(self, data):
@@ -517,18 +687,9 @@ class MZMakeBorderMap:
         polygon[:, 0] = polygon[:, 0] - xmin
         polygon[:, 1] = polygon[:, 1] - ymin
 
-        xs = np.broadcast_to(
-            np.linspace(0, width - 1, num=width).reshape(1, width), (height, width))
-        ys = np.broadcast_to(
-            np.linspace(0, height - 1, num=height).reshape(height, 1), (height, width))
-
-        distance_map = np.zeros(
-            (polygon.shape[0], height, width), dtype=np.float32)
-        for i in range(polygon.shape[0]):
-            j = (i + 1) % polygon.shape[0]
-            absolute_distance = self.distance(xs, ys, polygon[i], polygon[j])
-            distance_map[i] = np.clip(absolute_distance / distance, 0, 1)
-        distance_map = distance_map.min(axis=0)
+        distance_map = edge_distance_map(polygon, height, width, self.distance_mode, self._buffers)
+        distance_map /= distance
+        np.clip(distance_map, 0, 1, out=distance_map)
 
         xmin_valid = min(max(0, xmin), canvas.shape[1] - 1)
         xmax_valid = min(max(0, xmax), canvas.shape[1] - 1)
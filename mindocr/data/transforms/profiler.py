@@ -0,0 +1,146 @@
+'''
+Per-transform profiler for the data pipeline, aggregated over the dataloader worker processes.
+'''
+from typing import Optional
+import glob
+import json
+import os
+import time
+import tracemalloc
+import uuid
+import numpy as np
+
+__all__ = ['TransformProfiler', 'load_transform_profile', 'report_transform_profile']
+
+_FILE_PREFIX = 'transforms'
+
+
+class TransformProfiler(object):
+    '''
+    Record the wall time and the memory allocated by each transform class in `run_transforms`. Each process, e.g., a
+    dataloader worker forked with a copy of the dataset, writes its own statistics to a json file in `output_dir`
+    every `flush_interval` seconds, so that they are aggregated by `load_transform_profile` in the main process without
+    communicating with the workers.
+
+    The memory allocated by a transform is either counted as the size of the new arrays in its output data (cheap), or
+    if `trace_memory` is True, traced by tracemalloc including the temporary arrays (slow, as all python allocations
+    of the worker are traced).
+
+    The statistics files of the previous runs in `output_dir` are removed when the profiler is created, so use a
+    separate directory for each profiled dataset of a run.
+
+    Args:
+        output_dir (str): directory to write the statistics of the processes
+        trace_memory (bool): whether to trace the memory allocations with tracemalloc
+        flush_interval (float): interval in seconds to write the statistics of a process
+    '''
+    def __init__(self, output_dir: str, trace_memory: bool = False, flush_interval: float = 5.):
+        self.output_dir = output_dir
+        self.trace_memory = trace_memory
+        self.flush_interval = flush_interval
+        # identifies the files of this profiler, as several datasets may profile into the same directory
+        self._token = uuid.uuid4().hex[:8]
+        self._pid = None
+        os.makedirs(output_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(output_dir, f'{_FILE_PREFIX}.*.json')):
+            os.remove(path)
+
+    def _reset(self):
+        # statistics of each transform class: [num_calls, total_time, total_bytes, peak_bytes]
+        self.stats = {}
+        self._pid = os.getpid()
+        self._last_flush = time.time()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state.pop('stats', None)
+        return state
+
+    def run(self, transform, data: dict):
+        ''' run the transform on data and record it '''
+        if self._pid != os.getpid():
+            # in a new (forked) process, not to count the statistics of the parent process again
+            self._reset()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        else:
+            input_ids = set(id(v) for v in data.values())
+        start = time.perf_counter()
+        out = transform(data)
+        elapsed = time.perf_counter() - start
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            total_bytes, peak_bytes = max(current - start_bytes, 0), peak - start_bytes
+        else:
+            total_bytes = sum(v.nbytes for v in (out or {}).values()
+                              if isinstance(v, np.ndarray) and id(v) not in input_ids)
+            peak_bytes = total_bytes
+
+        stats = self.stats.setdefault(type(transform).__name__, [0, 0., 0, 0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += total_bytes
+        stats[3] = max(stats[3], peak_bytes)
+        return out
+
+    def step(self):
+        ''' called after each sample, to write the statistics every flush_interval seconds '''
+        if self._pid == os.getpid() and time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        path = os.path.join(self.output_dir, f'{_FILE_PREFIX}.{self._token}.{self._pid}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'pid': self._pid, 'stats': self.stats}, f)
+        os.replace(path + '.tmp', path)
+        self._last_flush = time.time()
+
+
+def load_transform_profile(output_dir: str):
+    '''
+    Aggregate the statistics of all processes written in output_dir.
+
+    Returns:
+        dict of transform class name to the dict of num_calls, total_time (s), total_bytes and peak_bytes
+    '''
+    profile = {}
+    for path in glob.glob(os.path.join(output_dir, f'{_FILE_PREFIX}.*.json')):
+        try:
+            with open(path) as f:
+                stats = json.load(f)['stats']
+        except (OSError, ValueError):
+            continue
+        for name, (num_calls, total_time, total_bytes, peak_bytes) in stats.items():
+            p = profile.setdefault(name, {'num_calls': 0, 'total_time': 0., 'total_bytes': 0, 'peak_bytes': 0})
+            p['num_calls'] += num_calls
+            p['total_time'] += total_time
+            p['total_bytes'] += total_bytes
+            p['peak_bytes'] = max(p['peak_bytes'], peak_bytes)
+    return profile
+
+
+def report_transform_profile(output_dir: str, json_path: Optional[str] = None):
+    '''
+    Return the report of the transforms profiled in output_dir sorted by the total time, and save the aggregated
+    statistics to json_path if given. The report lists the number of calls, the total and mean time, the share of the
+    time of all transforms, the mean memory allocated per call, and the max memory allocated in a call.
+    '''
+    profile = load_transform_profile(output_dir)
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump(profile, f, indent=2)
+
+    overall_time = sum(p['total_time'] for p in profile.values()) or 1.
+    lines = [f'{"transform":<28}{"calls":>10}{"total(s)":>12}{"share":>8}{"mean(ms)":>10}{"mean MB":>10}{"peak MB":>10}']
+    for name, p in sorted(profile.items(), key=lambda x: -x[1]['total_time']):
+        num_calls = max(p['num_calls'], 1)
+        lines.append(f'{name:<28}{p["num_calls"]:>10}{p["total_time"]:>12.2f}'
+                     f'{p["total_time"] / overall_time:>8.1%}{p["total_time"] / num_calls * 1e3:>10.2f}'
+                     f'{p["total_bytes"] / num_calls / 2 ** 20:>10.2f}{p["peak_bytes"] / 2 ** 20:>10.2f}')
+    return '\n'.join(lines)
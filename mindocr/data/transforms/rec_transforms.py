@@ -6,6 +6,8 @@ import cv2
 import math
 import numpy as np
 
+from .key_schema import KeySchema
+
 __all__ = ['RecCTCLabelEncode', 'RecResizeImg']
 
 class RecCTCLabelEncode(object):
@@ -25,6 +27,8 @@ class RecCTCLabelEncode(object):
 
 
     '''
+    key_schema = KeySchema(reads=('label',), writes=('length', 'text_seq', 'text_length', 'text_padded'))
+
     def __init__(self,
                 max_text_len=23,
                 character_dict_path=None,
@@ -216,23 +220,42 @@ def resize_norm_img_chinese(img, image_shape):
 class RecResizeImg(object):
     ''' adopted from paddle
     resize, convert from hwc to chw, rescale pixel value to -1 to 1
+
+    Args:
+        image_shape: (H, W) of the output image
+        width_buckets (List[int]): optional, candidate output widths. If given, the image is resized to height H and
+            padded (or stretched if padding is False) to the smallest bucket width that fits, instead of always to W,
+            which saves the computation on padding for short text. W is always added as the largest bucket.
+            The dataloader then batches the images of the same width together (see `build_dataset`). For CTCLoss, the
+            sequence lengths given by the buckets are set by `bucket_seq_lens`, and must be larger than max_text_len.
     '''
+    key_schema = KeySchema(reads=('image',), writes=('image', 'valid_ratio'))
+
     def __init__(self,
                  image_shape,
                  infer_mode=False,
                  character_dict_path=None,
                  padding=True,
+                 width_buckets=None,
                  **kwargs):
         self.image_shape = image_shape
         self.infer_mode = infer_mode
         self.character_dict_path = character_dict_path
         self.padding = padding
+        self.width_buckets = None
+        if width_buckets is not None:
+            self.width_buckets = np.array(sorted(set(w for w in width_buckets if w < image_shape[1]) | {image_shape[1]}))
 
     def __call__(self, data):
         img = data['image']
         if self.infer_mode and self.character_dict_path is not None:
             norm_img, valid_ratio = resize_norm_img_chinese(img,
                                                             self.image_shape)
+        elif self.width_buckets is not None:
+            imgH, imgW = self.image_shape
+            resized_w = min(math.ceil(imgH * img.shape[1] / float(img.shape[0])), imgW)
+            bucket_w = int(self.width_buckets[np.searchsorted(self.width_buckets, resized_w)])
+            norm_img, valid_ratio = resize_norm_img(img, (imgH, bucket_w), self.padding)
         else:
             norm_img, valid_ratio = resize_norm_img(img, self.image_shape,
                                                     self.padding)
@@ -10,11 +10,12 @@ from .rec_transforms import *
 # TODO: merge transforms in modelzoo to det_transforms if verified to be correct
 from .modelzoo_transforms import *
 from .iaa_augment import *
+from .key_schema import get_output_keys, plan_key_drops
 
 __all__ = ['create_transforms', 'run_transforms', 'transforms_dbnet_icdar15']
 
 # TODO: use class with __call__, to perform transformation
-def create_transforms(transform_pipeline, global_config=None):
+def create_transforms(transform_pipeline, global_config=None, fuse=True, input_keys=None, output_keys=None):
     """
     Create a squence of callable transforms.
 
@@ -22,6 +23,13 @@ def create_transforms(transform_pipeline, global_config=None):
         transform_pipeline (List): list of callable instances or dicts where each key is a transformation class name, and its value are the args.
             e.g. [{'DecodeImage': {'img_mode': 'BGR', 'channel_first': False}}]
                  [DecodeImage(img_mode='BGR')]
+        fuse (bool): if True, adjacent transforms that have a fused equivalent are replaced by it, i.e.,
+            NormalizeImage (is_hwc=True) followed by ToCHWImage are replaced by NormalizeToCHW.
+        input_keys (List): keys of the input data dict, e.g. ['img_path', 'label']. If given with output_keys, the
+            pipeline is compiled with the `key_schema` of the transforms: output_keys are checked to be produced (if
+            all transforms declare their keys), and DropKeys is inserted to delete each key not in output_keys after
+            the last transform using it.
+        output_keys (List): keys of the data dict needed after the transforms
 
     Returns:
         list of data transformation functions
@@ -47,19 +55,60 @@ def create_transforms(transform_pipeline, global_config=None):
         else:
             raise TypeError('transform_config must be a dict or a callable instance')
         #print(global_config)
+    if fuse:
+        transforms = fuse_transforms(transforms)
+    if input_keys is not None and output_keys is not None:
+        transforms = compile_transforms(transforms, input_keys, output_keys)
     return transforms
 
 
-def run_transforms(data, transforms=None, verbose=False):
+def compile_transforms(transforms, input_keys, output_keys):
+    ''' check output_keys statically and insert DropKeys to delete the keys once they are not used any more '''
+    available_keys = get_output_keys(transforms, input_keys)
+    if available_keys is not None:
+        for k in output_keys:
+            if k not in available_keys:
+                raise ValueError(f'Key {k} is not produced by the transform pipeline (available keys: '
+                                 f'{available_keys}). Please check the name or the completeness transformation '
+                                 f'pipeline.')
+
+    drops = plan_key_drops(transforms, input_keys, output_keys)
+    compiled = [DropKeys(drops[0])] if drops[0] else []
+    for transform, keys in zip(transforms, drops[1:]):
+        compiled.append(transform)
+        if keys:
+            compiled.append(DropKeys(keys))
+    return compiled
+
+
+def fuse_transforms(transforms):
+    ''' replace adjacent NormalizeImage (is_hwc=True) and ToCHWImage by NormalizeToCHW '''
+    fused = []
+    for transform in transforms:
+        if isinstance(transform, ToCHWImage) and len(fused) > 0 \
+                and type(fused[-1]) is NormalizeImage and fused[-1].is_hwc:
+            fused[-1] = NormalizeToCHW.from_transforms(fused[-1])
+        else:
+            fused.append(transform)
+    return fused
+
+
+def run_transforms(data, transforms=None, verbose=False, profiler=None):
+    '''
+    Run the transforms on data in sequence. If a TransformProfiler is given, the time and memory of each transform
+    are recorded by it.
+    '''
     if transforms is None:
         transforms = []
     for i, transform in enumerate(transforms):
         if verbose:
             print(f'Trans {i}: ', transform)
             print(f'\t Input: ', {k: data[k].shape for k in data if isinstance(data[k], np.ndarray)})
-        data = transform(data)
+        data = transform(data) if profiler is None else profiler.run(transform, data)
         if data is None:
-            return None
+            break
+    if profiler is not None:
+        profiler.step()
     return data
 
 # ---------------------- Predefined transform pipeline ------------------------------------
@@ -14,15 +14,17 @@ class L1BalancedCELoss(nn.LossBase):
     MaskL1Loss on `thresh`,
     DiceLoss on `thresh_binary`.
     Note: The meaning of inputs can be figured out in `SegDetectorLossBuilder`.
+    ohem_mode and max_positive_fraction: the hard negative mining of BalancedBCELoss, see BalancedBCELoss.
     """
-    def __init__(self, eps=1e-6, bce_scale=5, l1_scale=10, bce_replace="bceloss"):
+    def __init__(self, eps=1e-6, bce_scale=5, l1_scale=10, bce_replace="bceloss", ohem_mode="sort",
+                 max_positive_fraction=0.03):
         super().__init__()
 
         self.dice_loss = DiceLoss(eps=eps)
         self.l1_loss = MaskL1Loss()
 
         if bce_replace == "bceloss":
-            self.bce_loss = BalancedBCELoss()
+            self.bce_loss = BalancedBCELoss(ohem_mode=ohem_mode, max_positive_fraction=max_positive_fraction)
         elif bce_replace == "diceloss":
             self.bce_loss = DiceLoss()
         else:
@@ -91,12 +93,34 @@ class MaskL1Loss(nn.LossBase):
 
 
 class BalancedBCELoss(nn.LossBase):
-    """Balanced cross entropy loss."""
-    def __init__(self, negative_ratio=3, eps=1e-6):
+    """
+    Balanced cross entropy loss, where the negatives of the largest losses, at most negative_ratio times the positives,
+    are mined in each image (OHEM).
+
+    Args:
+        negative_ratio: max ratio of the mined negatives to the positives
+        eps: for numerical stability of the normalization
+        ohem_mode: how to find the loss threshold of the mined negatives in each image.
+            'sort': sort all the H * W losses.
+            'topk': take the top-k losses with a static k = negative_ratio * max_positive_fraction * H * W, which is
+                much cheaper than sorting for a small fraction. No negative is mined in an image without positives.
+                The number of mined negatives is truncated to k, i.e. an image with more than k hard negatives (more
+                than max_positive_fraction * H * W positives) only gets its k hardest negatives, and its loss differs
+                from 'sort'.
+        max_positive_fraction: the expected upper bound of the positives as a fraction of H * W, from which the bound of
+            the mined negatives is derived for ohem_mode 'topk'. The default 0.03 (k = 0.09 * H * W for negative_ratio
+            3) covers the text regions of most images, raise it for the datasets of dense text.
+    """
+    def __init__(self, negative_ratio=3, eps=1e-6, ohem_mode='sort', max_positive_fraction=0.03):
         super().__init__()
+        assert ohem_mode in ['sort', 'topk'], f'Invalid ohem_mode {ohem_mode}, valid values are sort and topk'
+        assert 0 < max_positive_fraction <= 1, f'max_positive_fraction should be in (0, 1], but get {max_positive_fraction}'
         self._negative_ratio = negative_ratio
         self._eps = eps
         self._bce_loss = ops.BinaryCrossEntropy(reduction='none')
+        self._ohem_mode = ohem_mode
+        self._max_negative_fraction = min(1., negative_ratio * max_positive_fraction)
+        self._topk = ops.TopK(sorted=True)
 
     def construct(self, pred, gt, mask):
         """
@@ -120,11 +144,20 @@ class BalancedBCELoss(nn.LossBase):
         pos_loss = loss * positive
         neg_loss = (loss * negative).view(loss.shape[0], -1)
 
-        neg_vals, _ = ops.sort(neg_loss)
-        neg_index = ops.stack((mnp.arange(loss.shape[0]), neg_vals.shape[1] - neg_count), axis=1)
+        if self._ohem_mode == 'topk':
+            # the k-th largest loss is the threshold, k is capped by the static size of top-k
+            max_k = max(1, int(neg_loss.shape[1] * self._max_negative_fraction))
+            neg_count = ops.minimum(neg_count, max_k)
+            neg_vals, _ = self._topk(neg_loss, max_k)
+            neg_index = ops.stack((mnp.arange(loss.shape[0]), ops.maximum(neg_count, 1) - 1), axis=1)
+        else:
+            neg_vals, _ = ops.sort(neg_loss)
+            neg_index = ops.stack((mnp.arange(loss.shape[0]), neg_vals.shape[1] - neg_count), axis=1)
         min_neg_score = ops.expand_dims(ops.gather_nd(neg_vals, neg_index), axis=1)
 
         neg_loss_mask = (neg_loss >= min_neg_score).astype(ms.float32)  # filter values less than top k
+        if self._ohem_mode == 'topk':
+            neg_loss_mask = neg_loss_mask * ops.expand_dims((neg_count > 0).astype(ms.float32), axis=1)
         neg_loss_mask = ops.stop_gradient(neg_loss_mask)
 
         neg_loss = neg_loss_mask * neg_loss
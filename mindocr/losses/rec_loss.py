@@ -18,12 +18,22 @@ class CTCLoss(LossBase):
             E.g., for a training image in shape (3, 32, 100), the feature map encoded by resnet34 bacbkone is in shape (512, 1, 4), W = 4, sequence len is 4. 
         max_label_len(int): the maximum number of characters in a text label, i.e. max_text_len in yaml.
         batch_size(int): batch size of input logits. bs
+        bucket_seq_lens(List[int]): the sequence lengths of the logits of the narrower width buckets, required if
+            `width_buckets` is set for RecResizeImg. Each of them must be larger than max_label_len, which is checked
+            here, so the width buckets too narrow for max_text_len have to be removed. Default: None.
      """
 
-    def __init__(self, pred_seq_len=26, max_label_len=25, batch_size=32, reduction='mean'):
+    def __init__(self, pred_seq_len=26, max_label_len=25, batch_size=32, reduction='mean', bucket_seq_lens=None):
         super(CTCLoss, self).__init__()
         assert pred_seq_len > max_label_len, 'pred_seq_len is required to be larger than max_label_len for CTCLoss. Please adjust the strides in the backbone, or reduce max_text_length in yaml'
-        self.sequence_length = Tensor(np.array([pred_seq_len] * batch_size), mstype.int32)
+        for seq_len in bucket_seq_lens or []:
+            assert seq_len > max_label_len, f'The sequence length {seq_len} of a width bucket is required to be ' \
+                f'larger than max_label_len {max_label_len} for CTCLoss. Please remove the width buckets too narrow ' \
+                f'for max_text_len in RecResizeImg.'
+        # sequence lengths of the batch for each possible length of the logits, the batch size is fixed since the
+        # bucketed batches drop the remainder
+        self.sequence_lengths = {seq_len: Tensor(np.array([seq_len] * batch_size), mstype.int32)
+                                 for seq_len in set(bucket_seq_lens or []) | {pred_seq_len}}
         label_indices = []
         for i in range(batch_size):
             for j in range(max_label_len):
@@ -50,7 +60,7 @@ class CTCLoss(LossBase):
         #logit = ops.reshape(logit, (T*bs, nc))
         label_values = ops.reshape(label, (-1,))
 
-        loss, _ = self.ctc_loss(logit, self.label_indices, label_values, self.sequence_length)
+        loss, _ = self.ctc_loss(logit, self.label_indices, label_values, self.sequence_lengths[logit.shape[0]])
         
         if self.reduction=='mean':
             loss = loss.mean()
@@ -2,12 +2,17 @@
 Code adopted from paddle.
 TODO: overwrite
 """
-from typing import List
+from typing import List, Union
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
 
 import numpy as np
-from mindspore import nn
+import mindspore as ms
+from mindspore import nn, ops
 from shapely.geometry import Polygon
-from sklearn.metrics import recall_score, precision_score, f1_score
+
+from ..utils.polygons import RaggedPolygons
 
 __all__ = ['DetMetric']
 
@@ -20,57 +25,186 @@ def _get_iou(pd, pg):
     return pd.intersection(pg).area / pd.union(pg).area
 
 
+def _signed_areas(polys):
+    """
+    Shoelace areas of polygons with the same number of points, (K, N, 2) -> (K,)
+    """
+    x, y = polys[..., 0], polys[..., 1]
+    return 0.5 * (x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y).sum(axis=-1)
+
+
+def _bboxes(polys: List[np.ndarray]):
+    """
+    Axis-aligned bounding boxes of polygons, in (K, 4) as (xmin, ymin, xmax, ymax)
+    """
+    if len(polys) == 0:
+        return np.zeros((0, 4))
+    lengths = np.array([len(p) for p in polys])
+    points = np.concatenate(polys)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return np.concatenate([np.minimum.reduceat(points, starts), np.maximum.reduceat(points, starts)], axis=1)
+
+
+def _bbox_overlaps(boxes_a, boxes_b):
+    """
+    Whether the bounding boxes overlap, (K, 4) x (M, 4) -> (K, M) bool. Polygons of not overlapped boxes can not
+    intersect, so their intersection needs not be computed.
+    """
+    return (boxes_a[:, None, 0] <= boxes_b[None, :, 2]) & (boxes_b[None, :, 0] <= boxes_a[:, None, 2]) & \
+           (boxes_a[:, None, 1] <= boxes_b[None, :, 3]) & (boxes_b[None, :, 1] <= boxes_a[:, None, 3])
+
+
+def _convex_quads(polys: List[np.ndarray]):
+    """
+    Find the convex quads among polygons and orient them to positive signed area.
+
+    Returns:
+        is_quad: (K,) bool, whether the polygon is a convex quad
+        quads: (K, 4, 2), the oriented quads, only meaningful where is_quad
+    """
+    is_quad = np.array([p.shape == (4, 2) for p in polys], dtype=bool)
+    quads = np.zeros((len(polys), 4, 2))
+    if not is_quad.any():
+        return is_quad, quads
+    quads[is_quad] = np.stack([p for p, q in zip(polys, is_quad) if q])
+
+    areas = _signed_areas(quads)
+    quads = np.where((areas < 0)[:, None, None], quads[:, ::-1], quads)
+    edges = np.roll(quads, -1, axis=1) - quads
+    turns = edges[..., 0] * np.roll(edges[..., 1], -1, axis=1) - edges[..., 1] * np.roll(edges[..., 0], -1, axis=1)
+    is_quad &= (areas != 0) & (turns >= 0).all(axis=1)
+    return is_quad, quads
+
+
+def _convex_quads_intersection(quads_a, quads_b):
+    """
+    Intersection areas of pairs of convex quads with positive signed area, (P, 4, 2) x (P, 4, 2) -> (P,).
+    Sutherland-Hodgman clipping of quads_a by the 4 edges of quads_b, vectorized over the pairs.
+    """
+    num_pairs = len(quads_a)
+    # clipping a quad by k half planes leaves at most 4 + k vertices
+    poly = np.zeros((num_pairs, 8, 2))
+    poly[:, :4] = quads_a
+    count = np.full(num_pairs, 4)
+    slots = np.arange(8)
+    rows = np.arange(num_pairs)[:, None]
+    for k in range(4):
+        start = quads_b[:, k][:, None]
+        edge = (quads_b[:, (k + 1) % 4] - quads_b[:, k])[:, None]
+        cross = edge[..., 0] * (poly[..., 1] - start[..., 1]) - edge[..., 1] * (poly[..., 0] - start[..., 0])
+        inside = cross >= 0
+        valid = slots[None] < count[:, None]
+        prev = (slots[None] - 1) % np.maximum(count, 1)[:, None]
+        prev_poly, prev_cross, prev_inside = poly[rows, prev], cross[rows, prev], inside[rows, prev]
+
+        # each vertex emits the crossing point on the edge from its previous vertex, and then itself if inside
+        denom = prev_cross - cross
+        t = np.divide(prev_cross, denom, out=np.zeros_like(denom), where=denom != 0)
+        crossing = prev_poly + t[..., None] * (poly - prev_poly)
+        out = np.stack([crossing, poly], axis=2).reshape(num_pairs, 16, 2)
+        emit = np.stack([valid & (inside != prev_inside), valid & inside], axis=2).reshape(num_pairs, 16)
+
+        order = np.argsort(~emit, axis=1, kind='stable')[:, :8]
+        poly = np.take_along_axis(out, order[..., None], axis=1)
+        count = emit.sum(axis=1)
+
+    # pad with the first vertex so that the padded points add nothing to the shoelace sum
+    poly = np.where((slots[None] < count[:, None])[..., None], poly, poly[:, :1])
+    return np.where(count >= 3, np.abs(_signed_areas(poly)), 0.)
+
+
+def _intersection_matrix(polys_a, shapes_a, polys_b, shapes_b):
+    """
+    Intersection areas of all pairs of polygons, (K, M). Pairs whose bounding boxes do not overlap are skipped,
+    pairs of convex quads are computed in batch, and the other pairs by shapely.
+
+    polys_a, polys_b: list of np.ndarray, polygon points
+    shapes_a, shapes_b: list of the shapely Polygons of the points
+    """
+    inter = np.zeros((len(polys_a), len(polys_b)))
+    if len(polys_a) == 0 or len(polys_b) == 0:
+        return inter
+
+    is_quad_a, quads_a = _convex_quads(polys_a)
+    is_quad_b, quads_b = _convex_quads(polys_b)
+
+    overlaps = _bbox_overlaps(_bboxes(polys_a), _bboxes(polys_b))
+    quad_pairs = overlaps & is_quad_a[:, None] & is_quad_b[None, :]
+    idx_a, idx_b = np.nonzero(quad_pairs)
+    if len(idx_a) > 0:
+        inter[idx_a, idx_b] = _convex_quads_intersection(quads_a[idx_a], quads_b[idx_b])
+    for i, j in zip(*np.nonzero(overlaps & ~quad_pairs)):
+        inter[i, j] = _get_intersect(shapes_a[i], shapes_b[j])
+    return inter
+
+
 class DetectionIoUEvaluator:
+    """
+    Match the predicted polygons to the groundtruth polygons by IoU.
+
+    The intersections are only computed for the polygon pairs whose bounding boxes overlap. The intersections of
+    convex quads, the common case, are computed in batch with numpy; shapely is used for other polygons.
+    """
     def __init__(self, min_iou=0.5, min_intersect=0.5):
         self._min_iou = min_iou
         self._min_intersect = min_intersect
 
-    def __call__(self, gt: List[dict], preds: List[np.ndarray]):
+    def __call__(self, gt: Union[List[dict], RaggedPolygons], preds: Union[List[np.ndarray], RaggedPolygons]):
+        """
+        gt: list of dict with keys polys (points of a polygon) and ignore, or RaggedPolygons with the ignore flags
+        preds: list of the points of predicted polygons, or RaggedPolygons
+        """
+        if isinstance(gt, RaggedPolygons):
+            gt = [{'polys': points, 'ignore': ignore} for points, ignore in zip(gt, gt.ignore)]
         # filter invalid groundtruth polygons and split them into useful and ignored
         gt_polys, gt_ignore = [], []
+        gt_points, gt_ignore_points = [], []
         for sample in gt:
-            poly = Polygon(sample['polys'])
+            points = np.asarray(sample['polys'], dtype=np.float64)
+            poly = Polygon(points)
             if poly.is_valid and poly.is_simple:
                 if not sample['ignore']:
                     gt_polys.append(poly)
+                    gt_points.append(points)
                 else:
                     gt_ignore.append(poly)
+                    gt_ignore_points.append(points)
 
         # repeat the same step for the predicted polygons
-        det_polys, det_ignore = [], []
+        det_candidates, det_candidate_points = [], []
         for pred in preds:
-            poly = Polygon(pred)
+            points = np.asarray(pred, dtype=np.float64)
+            poly = Polygon(points)
             if poly.is_valid and poly.is_simple:
-                poly_area = poly.area
-                if gt_ignore and poly_area > 0:
-                    for ignore_poly in gt_ignore:
-                        intersect_area = _get_intersect(ignore_poly, poly)
-                        precision = intersect_area / poly_area
-                        # If precision enough, append as ignored detection
-                        if precision > self._min_intersect:
-                            det_ignore.append(poly)
-                            break
-                    else:
-                        det_polys.append(poly)
-                else:
-                    det_polys.append(poly)
+                det_candidates.append(poly)
+                det_candidate_points.append(points)
+
+        # a prediction mostly covered by an ignored groundtruth is ignored
+        det_polys, det_points = det_candidates, det_candidate_points
+        if gt_ignore and det_candidates:
+            det_areas = np.array([poly.area for poly in det_candidates])
+            inter = _intersection_matrix(det_candidate_points, det_candidates, gt_ignore_points, gt_ignore)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                precision = inter / det_areas[:, None]
+            is_ignored = (det_areas > 0) & (precision > self._min_intersect).any(axis=1)
+            det_polys = [poly for poly, ignored in zip(det_candidates, is_ignored) if not ignored]
+            det_points = [points for points, ignored in zip(det_candidate_points, is_ignored) if not ignored]
 
         det_labels = [0] * len(gt_polys)
         if det_polys:
-            iou_mat = np.zeros([len(gt_polys), len(det_polys)])
-            det_rect_mat = np.zeros(len(det_polys), np.int8)
-
-            for det_idx in range(len(det_polys)):
-                if det_rect_mat[det_idx] == 0:  # the match is not found yet
-                    for gt_idx in range(len(gt_polys)):
-                        iou_mat[gt_idx, det_idx] = _get_iou(det_polys[det_idx], gt_polys[gt_idx])
-                        if iou_mat[gt_idx, det_idx] > self._min_iou:
-                            # Mark the visit arrays
-                            det_rect_mat[det_idx] = 1
-                            det_labels[gt_idx] = 1
-                            break
-                    else:
-                        det_labels.append(1)
+            inter = _intersection_matrix(gt_points, gt_polys, det_points, det_polys)
+            gt_areas = np.array([poly.area for poly in gt_polys])
+            det_areas = np.array([poly.area for poly in det_polys])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                iou_mat = inter / (gt_areas[:, None] + det_areas[None, :] - inter)
+
+            # each prediction is matched to the first groundtruth with enough IoU
+            hits = iou_mat > self._min_iou
+            matched = hits.any(axis=0)
+            if matched.any():
+                for gt_idx in hits.argmax(axis=0)[matched]:
+                    det_labels[gt_idx] = 1
+            det_labels.extend([1] * int((~matched).sum()))
 
         gt_labels = [1] * len(gt_polys) + [0] * (len(det_labels) - len(gt_polys))
         return gt_labels, det_labels
@@ -85,24 +219,29 @@ class QuadMetric:
         """
         batch: (image, polygons, ignore_tags)
             image: numpy array of shape (N, C, H, W).
-            polys: numpy array of shape (N, K, 4, 2), the polygons of objective regions.
+            polys: numpy array of shape (N, K, 4, 2), the polygons of objective regions, or a list of N RaggedPolygons
+                with their ignore flags.
             ignore: numpy array of shape (N, K), indicates whether a region is ignorable or not.
-        output: (polygons, ...)
+        output: (polygons, scores), polygons of each sample in numpy array of shape (K, 4, 2) or RaggedPolygons
         """
-        gt_polys = batch['polys'].astype(np.float32)
+        gt_polys = batch['polys']
         gt_ignore_info = batch['ignore']
-        pred_polys = np.array(output[0])
-        pred_scores = np.array(output[1])
+        pred_polys, pred_scores = output[0], output[1]
 
         gt_labels, det_labels = [], []
         for sample_id in range(len(gt_polys)):
-            gt = [{'polys': gt_polys[sample_id][j], 'ignore': gt_ignore_info[sample_id][j]}
-                  for j in range(len(gt_polys[sample_id]))]
+            if isinstance(gt_polys[sample_id], RaggedPolygons):
+                gt = gt_polys[sample_id]
+            else:
+                sample_polys = np.asarray(gt_polys[sample_id], dtype=np.float32)
+                gt = [{'polys': sample_polys[j], 'ignore': gt_ignore_info[sample_id][j]}
+                      for j in range(len(sample_polys))]
+            sample_preds, sample_scores = pred_polys[sample_id], np.asarray(pred_scores[sample_id])
             if self.is_output_polygon:
-                pred = [sample for sample in pred_polys[sample_id]]     # TODO: why are polygons not filtered?
+                pred = [sample for sample in sample_preds]     # TODO: why are polygons not filtered?
             else:
-                pred = [pred_polys[sample_id][j].astype(np.int32)
-                        for j in range(pred_polys[sample_id].shape[0]) if pred_scores[sample_id][j] >= box_thresh]
+                pred = [np.asarray(sample_preds[j]).astype(np.int32)
+                        for j in range(len(sample_preds)) if sample_scores[j] >= box_thresh]
 
             gt_label, det_label = self.evaluator(gt, pred)
             gt_labels.append(gt_label)
@@ -113,15 +252,92 @@ class QuadMetric:
         return self(batch, output, box_thresh=0.55)  # TODO: why is here a fixed threshold and different from the above?
 
 
-# TODO: improve the efficiency ?
+class DetMetricState:
+    """
+    Running counters of the detection metric. States are mergeable, so that partial results of batches, worker
+    processes or devices can be summed up.
+
+    Args:
+        num_gt: number of (not ignored) groundtruth polygons
+        num_tp: number of groundtruth polygons matched by a prediction
+        num_fp: number of predictions matching no groundtruth
+    """
+    def __init__(self, num_gt=0, num_tp=0, num_fp=0):
+        self.num_gt = int(num_gt)
+        self.num_tp = int(num_tp)
+        self.num_fp = int(num_fp)
+
+    def update(self, gt_labels: List[List[int]], det_labels: List[List[int]]):
+        """
+        Accumulate the per-sample labels output by DetectionIoUEvaluator, where the groundtruth polygons come first
+        and each unmatched prediction adds an entry labeled (gt=0, det=1).
+        """
+        for gt_label, det_label in zip(gt_labels, det_labels):
+            num_gt = sum(gt_label)
+            self.num_gt += num_gt
+            self.num_tp += sum(det_label[:num_gt])
+            self.num_fp += len(det_label) - num_gt
+        return self
+
+    def merge(self, other: 'DetMetricState'):
+        self.num_gt += other.num_gt
+        self.num_tp += other.num_tp
+        self.num_fp += other.num_fp
+        return self
+
+    def to_array(self):
+        return np.array([self.num_gt, self.num_tp, self.num_fp], dtype=np.int64)
+
+    @classmethod
+    def from_array(cls, array):
+        return cls(*np.asarray(array).tolist())
+
+    def compute(self):
+        """
+        Returns: dict of recall, precision and f-score. A value is 0 if its denominator is 0.
+        """
+        num_fn = self.num_gt - self.num_tp
+        recall = self.num_tp / self.num_gt if self.num_gt > 0 else 0.
+        precision = self.num_tp / (self.num_tp + self.num_fp) if self.num_tp + self.num_fp > 0 else 0.
+        f_denom = 2 * self.num_tp + self.num_fp + num_fn
+        f_score = 2 * self.num_tp / f_denom if f_denom > 0 else 0.
+        return {'recall': recall, 'precision': precision, 'f-score': f_score}
+
+
+def _measure(metric: QuadMetric, gt: dict, output: tuple):
+    """
+    Match a batch in a worker process of the asynchronous DetMetric.
+    """
+    gt_labels, det_labels = metric.validate_measure(gt, output)
+    return DetMetricState().update(gt_labels, det_labels)
+
+
 class DetMetric(nn.Metric):
-    def __init__(self, **kwargs):
+    """
+    Detection metric with running TP/FP/groundtruth counters, so the memory is constant and eval() is O(1).
+
+    In distributed evaluation, call `all_reduce()` before `eval()` to sum the counters over all devices, or merge
+    the states returned by `get_state()` manually.
+
+    Args:
+        num_workers: if > 0, the metric runs asynchronously: `update()` only sends numpy copies of the predictions
+            and groundtruth to a persistent pool of `num_workers` processes, which do the matching while the network
+            runs the next batches, and `eval()` joins the results. Default: 0, match in `update()`.
+    """
+    def __init__(self, num_workers=0, **kwargs):
         super().__init__()
+        self.num_workers = num_workers
+        self._pool = None
+        self._pending = deque()
         self.clear()
 
     def clear(self):
         self._metric = QuadMetric()
-        self._gt_labels, self._det_labels = [], []
+        self._state = DetMetricState()
+        # results of an unfinished evaluation are dropped, the batches not started yet are cancelled and the running
+        # ones are not waited for
+        while self._pending:
+            self._pending.popleft().cancel()
 
     def update(self, *inputs):
         """
@@ -137,11 +353,53 @@ class DetMetric(nn.Metric):
         preds, gts = inputs
         polys, ignore = gts
         boxes, scores = preds['polygons'], preds['scores']
-        gt = {'polys': polys.asnumpy(), 'ignore': ignore.asnumpy()}
+        if isinstance(polys, ms.Tensor):
+            polys, ignore = polys.asnumpy(), ignore.asnumpy()
+        gt = {'polys': polys, 'ignore': ignore}
+
+        if self.num_workers > 0:
+            if self._pool is None:
+                # spawn instead of fork, which is unsafe for a process running the MindSpore runtime threads
+                self._pool = ProcessPoolExecutor(self.num_workers, mp_context=mp.get_context('spawn'))
+            output = ([b if isinstance(b, RaggedPolygons) else np.array(b) for b in boxes],
+                      [np.array(s) for s in scores])
+            self._pending.append(self._pool.submit(_measure, self._metric, gt, output))
+            # bound the number of batches in flight
+            while len(self._pending) > 2 * self.num_workers:
+                self._state.merge(self._pending.popleft().result())
+            return
 
         gt_labels, det_labels = self._metric.validate_measure(gt, (boxes, scores))
-        self._gt_labels.extend(gt_labels)
-        self._det_labels.extend(det_labels)
+        self._state.update(gt_labels, det_labels)
+
+    def _join(self):
+        while self._pending:
+            self._state.merge(self._pending.popleft().result())
+
+    def close(self):
+        """
+        Shut down the worker processes of the asynchronous mode. Called by the Evaluator at the end of evaluation
+        or training, the pool is started again if the metric is updated afterwards.
+        """
+        self._join()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def get_state(self):
+        self._join()
+        return self._state
+
+    def merge_state(self, state: DetMetricState):
+        self._state.merge(state)
+
+    def all_reduce(self):
+        """
+        Sum the counters over all devices. The communication must be initialized.
+        """
+        self._join()
+        counters = ms.Tensor(self._state.to_array().astype(np.int32))
+        self._state = DetMetricState.from_array(ops.AllReduce()(counters).asnumpy())
 
     def eval(self):
         """
@@ -152,14 +410,8 @@ class DetMetric(nn.Metric):
             recall: recall,
             f-score: f-score
         """
-        # flatten predictions and labels into 1D-array
-        self._det_labels = np.array([l for label in self._det_labels for l in label])
-        self._gt_labels = np.array([l for label in self._gt_labels for l in label])
-        return {
-            'recall': recall_score(self._gt_labels, self._det_labels),
-            'precision': precision_score(self._gt_labels, self._det_labels),
-            'f-score': f1_score(self._gt_labels, self._det_labels)
-        }
+        self._join()
+        return self._state.compute()
 
 
 if __name__ == '__main__':
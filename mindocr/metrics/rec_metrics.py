@@ -1,6 +1,7 @@
 """Metric for accuracy evaluation."""
 import string
 import numpy as np
+from rapidfuzz import process
 from rapidfuzz.distance import Levenshtein
 
 from mindspore import nn
@@ -9,6 +10,30 @@ import mindspore as ms
 
 __all__ = ['RecMetric']
 
+
+class _CharFilterTable(dict):
+    ''' Translation table for str.translate which keeps the chars in `keep` and deletes the others.
+    Entries are resolved lazily on first lookup, so the cost does not grow with the dictionary size.
+    '''
+    def __init__(self, keep, delete=()):
+        super().__init__()
+        self.keep = keep
+        for c in delete:
+            self[ord(c)] = None
+
+    def __missing__(self, key):
+        value = key if chr(key) in self.keep else None
+        self[key] = value
+        return value
+
+
+def _normalized_edit_distances(preds, labels):
+    ''' Normalized Levenshtein distances of the paired strings, as np.ndarray '''
+    if len(preds) == 0:
+        return np.zeros(0)
+    return process.cpdist(preds, labels, scorer=Levenshtein.normalized_distance, dtype=np.float64)
+
+
 class RecMetric(nn.Metric):
     """
     Define accuracy metric for warpctc network.
@@ -17,6 +42,9 @@ class RecMetric(nn.Metric):
         ignore_space: remove space in prediction and ground truth text if True 
         filter_ood: filter out-of-dictionary characters(e.g., '$' for the default digit+en dictionary) in ground truth text. Default is True. 
         lower: convert GT text to lower case. Recommend to set True if the dictionary does not contains upper letters 
+        length_buckets (List[int]): upper bounds of GT text length buckets, for which accuracy is reported separately as
+            `acc_len_{low}-{high}` in eval results, and `acc_len_{low}+` for the texts longer than the last bound, e.g.
+            [5, 10, 15, 20, 25]. Default: None, not reported.
 
     Notes:
         Since the OOD characters are skipped during label encoding in data transformation by default, filter_ood should be True. (Paddle skipped the OOD character in label encoding and then decoded the label indices back to text string, which has no ood character.  
@@ -28,28 +56,37 @@ class RecMetric(nn.Metric):
             filter_ood=True,  
             lower=True, 
             print_flag=False, 
+            length_buckets=None,
             **kwargs):
         super().__init__()
-        self.clear()
         self.ignore_space = ignore_space
         self.filter_ood = filter_ood
         self.lower = lower
         self.print_flag = print_flag
+        self.length_buckets = np.array(sorted(length_buckets) if length_buckets is not None else [], dtype=np.int64)
+        self.clear()
         
         # TODO: use parsed dictionary object
         if character_dict_path is None:
-            self.dict  = [c for c in  "0123456789abcdefghijklmnopqrstuvwxyz"]
+            self.dict  = set("0123456789abcdefghijklmnopqrstuvwxyz")
         else:
-            self.dict = []
+            self.dict = set()
             with open(character_dict_path, 'r') as f:
                 for line in f:
                     c = line.rstrip('\n\r')
-                    self.dict.append(c)
+                    self.dict.add(c)
+
+        # GT text filter, removes space (if ignore_space) and out-of-dictionary chars in one pass
+        if self.filter_ood:
+            self._label_table = _CharFilterTable(self.dict, delete=[' '] if self.ignore_space else [])
 
     def clear(self):
         self._correct_num = 0
         self._total_num = 0
         self.norm_edit_dis = 0.0
+        num_buckets = len(self.length_buckets) + 1
+        self._bucket_correct = np.zeros(num_buckets, dtype=np.int64)
+        self._bucket_total = np.zeros(num_buckets, dtype=np.int64)
 
     def update(self, *inputs):
         """
@@ -92,31 +129,36 @@ class RecMetric(nn.Metric):
                 gt_texts = gt_texts.asnumpy()
         
         #print('2: ', gt_texts)
-        for pred, label in zip(pred_texts, gt_texts):
-            #print('pred', pred, 'END')
-            #print('label ', label, 'END')
-
-            if self.ignore_space:
-                pred = pred.replace(' ', '')
-                label = label.replace(' ', '')
-
-            if self.lower: # convert to lower case
-                label = label.lower()
-
-            if self.filter_ood: # filter out of dictionary characters
-                label = ''.join([c for c in label if c in self.dict]) 
-
-            if self.print_flag:
+        gt_texts = [str(label) for label in gt_texts]
+        if self.ignore_space:
+            pred_texts = [pred.replace(' ', '') for pred in pred_texts]
+        if self.lower: # convert to lower case
+            gt_texts = [label.lower() for label in gt_texts]
+        if self.filter_ood: # filter out of dictionary characters, and space if ignore_space
+            gt_texts = [label.translate(self._label_table) for label in gt_texts]
+        elif self.ignore_space:
+            gt_texts = [label.replace(' ', '') for label in gt_texts]
+
+        if self.print_flag:
+            for pred, label in zip(pred_texts, gt_texts):
                 print(pred, " :: ", label)
 
-            edit_distance = Levenshtein.normalized_distance(pred, label)
-            self.norm_edit_dis += edit_distance 
-            if pred == label:
-                self._correct_num += 1
-            #if edit_distance == 0:
-            #    self._correct_num += 1
+        num = min(len(pred_texts), len(gt_texts))
+        pred_texts, gt_texts = pred_texts[:num], gt_texts[:num]
+        correct = np.array([pred == label for pred, label in zip(pred_texts, gt_texts)], dtype=bool)
+
+        # edit distance is 0 for the correct ones, only compute the others
+        wrong = np.flatnonzero(~correct)
+        edit_distances = _normalized_edit_distances([pred_texts[i] for i in wrong], [gt_texts[i] for i in wrong])
+        self.norm_edit_dis += float(edit_distances.sum())
+        self._correct_num += int(correct.sum())
+        self._total_num += num
 
-            self._total_num += 1
+        gt_lens = np.array([len(label) for label in gt_texts], dtype=np.int64)
+        buckets = np.searchsorted(self.length_buckets, gt_lens, side='left')
+        num_buckets = len(self._bucket_total)
+        self._bucket_total += np.bincount(buckets, minlength=num_buckets)
+        self._bucket_correct += np.bincount(buckets, weights=correct, minlength=num_buckets).astype(np.int64)
 
     def eval(self):
         if self._total_num == 0:
@@ -127,7 +169,17 @@ class RecMetric(nn.Metric):
         sequence_accurancy = self._correct_num / self._total_num
         norm_edit_distance =  1 - self.norm_edit_dis / self._total_num
 
-        return {'acc': sequence_accurancy, 'norm_edit_distance': norm_edit_distance} 
+        res = {'acc': sequence_accurancy, 'norm_edit_distance': norm_edit_distance}
+
+        bucket_acc = self._bucket_correct / np.maximum(self._bucket_total, 1)
+        low = 0
+        for i, high in enumerate(self.length_buckets.tolist()):
+            res[f'acc_len_{low}-{high}'] = float(bucket_acc[i])
+            low = high + 1
+        if len(self.length_buckets) > 0:
+            res[f'acc_len_{low}+'] = float(bucket_acc[-1])
+
+        return res
 
 if __name__ == '__main__':
     gt = ['ba xla la!    ', 'ba       ']
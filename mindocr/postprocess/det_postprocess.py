@@ -1,4 +1,5 @@
 from typing import Union, List
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 from shapely.geometry import Polygon
@@ -7,12 +8,29 @@ import pyclipper
 import mindspore as ms
 from mindspore import ops
 
+from ..utils.polygons import RaggedPolygons
+
 __all__ = ['DBPostprocess']
 
 # TODO: improve code, adopted from modelzoo which is adopted from WenmuZhou/DBNet.pytorch
 class DBPostprocess(object):
     '''
     region_type: the text region type 'quad' or 'poly'.
+    engine: 'loop' or 'batch'. 'loop' processes the candidates contour by contour. 'batch' scores all candidates of
+        an image in one pass (connected-component labeling + per-label mean), computes the min-area-rect corners of
+        all candidates at once and, for 'quad' region type, expands boxes analytically instead of through
+        shapely/pyclipper. Boxes may differ from 'loop' by about one pixel due to the integer rounding in pyclipper.
+    region_extractor: 'contour' or 'cc'. 'contour' takes the contours found by cv2.findContours as candidates.
+        'cc' labels the map with cv2.connectedComponentsWithStats, which gives the area, bounding box and score sum
+        of all regions at once, so that small regions (bounding box thinner than min_size) and low-score regions
+        are rejected before any geometry runs. Contours are then traced only for the remaining regions, and
+        max_candidates counts the remaining regions.
+    num_workers: if > 0, the maps in a batch are processed in parallel by a persistent pool of `num_workers`
+        threads (cv2 releases the GIL). The output order is kept. Call `close()` to shut the pool down when done.
+        Default: 0, process the maps one after another.
+    ragged: if True and region_type is 'poly', the polygons of each map are returned as RaggedPolygons, which keeps
+        the points of all polygons in one array for the vectorized geometry of the metrics. Default: False, a list
+        of the polygons in np.ndarray of shape (num_points, 2).
     '''
     def __init__(self, 
                 thresh=0.3, 
@@ -21,7 +39,11 @@ class DBPostprocess(object):
                 unclip_ratio=1.5,
                 region_type='quad', 
                 dest='binary',
-                score_mode='fast'):
+                score_mode='fast',
+                engine='loop',
+                region_extractor='contour',
+                num_workers=0,
+                ragged=False):
 
         self.min_size = 3
         self.thresh = thresh
@@ -32,6 +54,14 @@ class DBPostprocess(object):
         self.dest = dest
         self.score_mode = score_mode
         assert score_mode in ['fast', 'slow'], 'Invalid value'
+        self.engine = engine
+        assert engine in ['loop', 'batch'], f'Invalid engine {engine}, valid values are loop and batch'
+        self.region_extractor = region_extractor
+        assert region_extractor in ['contour', 'cc'], \
+            f'Invalid region_extractor {region_extractor}, valid values are contour and cc'
+        self.num_workers = num_workers
+        self._pool = None
+        self.ragged = ragged
 
     def __call__(self, pred: Union[dict, List], data_samples=None):
         '''
@@ -43,7 +73,9 @@ class DBPostprocess(object):
             data_samples: optional, data samples mapping
         Returns:
             result (dict) with keys: 
-                polygons: np.ndarray of shape (N, K, 4, 2) for the polygons of objective regions if region_type is 'quad' 
+                polygons: np.ndarray of shape (N, K, 4, 2) for the polygons of objective regions if region_type is 'quad'.
+                    If region_type is 'poly', a list of N lists of polygons in shape (num_points, 2), or a list of N
+                    RaggedPolygons if ragged.
                 scores: np.ndarray of shape (N, K), score for each box
         '''
         if isinstance(pred, dict):
@@ -55,22 +87,41 @@ class DBPostprocess(object):
         if isinstance(pred, ms.Tensor):
             pred = pred.asnumpy()
         segmentation = self.binarize(pred)
-        boxes_batch = []
-        scores_batch = []
-        for batch_index in range(pred.shape[0]):
-            height, width = pred.shape[1:]
-            if self.region_type == 'poly':
-                boxes, scores = self.polygons_from_bitmap(pred[batch_index], segmentation[batch_index], width, height)
-            else:
-                boxes, scores = self.boxes_from_bitmap(pred[batch_index], segmentation[batch_index], width, height)
-            boxes_batch.append(boxes)
-            scores_batch.append(scores)
+        height, width = pred.shape[1:]
+        if self.region_type == 'poly':
+            from_bitmap = self.polygons_from_bitmap
+        elif self.engine == 'batch':
+            from_bitmap = self.boxes_from_bitmap_batch
+        else:
+            from_bitmap = self.boxes_from_bitmap
+
+        def _process(batch_index):
+            return from_bitmap(pred[batch_index], segmentation[batch_index], width, height)
+
+        if self.num_workers > 0 and pred.shape[0] > 1:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.num_workers)
+            outputs = list(self._pool.map(_process, range(pred.shape[0])))  # map keeps the input order
+        else:
+            outputs = [_process(batch_index) for batch_index in range(pred.shape[0])]
+
+        boxes_batch = [boxes for boxes, _ in outputs]
+        scores_batch = [scores for _, scores in outputs]
 
         result = {} 
         result['polygons'] = boxes_batch
         result['scores'] = scores_batch
         return result
 
+    def close(self):
+        ''' shut down the thread pool (if any), it is created again if called afterwards '''
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def __del__(self):
+        self.close()
+
     def binarize(self, pred):
         return pred > self.thresh
 
@@ -80,21 +131,24 @@ class DBPostprocess(object):
         '''
 
         assert len(_bitmap.shape) == 2
-        bitmap = _bitmap.asnumpy()  # The first channel
+        bitmap = _bitmap if isinstance(_bitmap, np.ndarray) else _bitmap.asnumpy()  # The first channel
         height, width = bitmap.shape
         boxes = []
         scores = []
 
-        contours, _ = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        contours, contour_scores = self.get_candidates(pred, bitmap, batch_score=self.engine == 'batch')
 
-        for contour in contours[:self.max_candidates]:
+        for index, contour in enumerate(contours):
             epsilon = 0.005 * cv2.arcLength(contour, True)
             approx = cv2.approxPolyDP(contour, epsilon, True)
             points = approx.reshape((-1, 2))
             if points.shape[0] < 4:
                 continue
 
-            score = self.box_score_fast(pred, contour.squeeze(1))
+            if contour_scores is not None:
+                score = contour_scores[index]
+            else:
+                score = self.box_score_fast(pred, contour.squeeze(1))
             if self.box_thresh > score:
                 continue
 
@@ -117,6 +171,8 @@ class DBPostprocess(object):
             box[:, 1] = np.clip(np.round(box[:, 1] / height * dest_height), 0, dest_height)
             boxes.append(box)
             scores.append(score)
+        if self.ragged:
+            return RaggedPolygons.from_polys(boxes), scores
         return boxes, scores
     
     # TODO: diff from paddle? if no boxes, return [] instead of [0,0,0,0]
@@ -137,8 +193,8 @@ class DBPostprocess(object):
 
         # Contour & Constraint
         height, width = bitmap.shape
-        contours, _ = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        num_contours = min(len(contours), self.max_candidates)
+        contours, contour_scores = self.get_candidates(pred, bitmap)
+        num_contours = len(contours)
 
         # Init
         boxes = np.zeros((num_contours, 4, 2), dtype=np.int16)
@@ -148,7 +204,10 @@ class DBPostprocess(object):
             # (4, 1, 2) -> (4, 2)
             contour = contours[index].squeeze(1)
             # Score
-            score = self.box_score_fast(pred, contour)
+            if contour_scores is not None:
+                score = contour_scores[index]
+            else:
+                score = self.box_score_fast(pred, contour)
             if self.box_thresh > score:
                 continue
             # Box's points
@@ -172,6 +231,162 @@ class DBPostprocess(object):
             boxes[index, :, :] = box.astype(np.int16)
             scores[index] = score
         return boxes, scores 
+
+    def boxes_from_bitmap_batch(self, pred, _bitmap, dest_width, dest_height):
+        '''
+        Vectorized version of `boxes_from_bitmap`, the output format is the same.
+        Only outer contours are taken as candidates, since a hole shares the score of the region around it.
+
+        _bitmap: single map with shape (H, W), whose values are binarized as {0, 1}
+        '''
+        assert len(_bitmap.shape) == 2
+        bitmap = _bitmap if isinstance(_bitmap, np.ndarray) else _bitmap.asnumpy()
+        if not isinstance(pred, np.ndarray):
+            pred = ops.stop_gradient(pred).asnumpy()
+
+        height, width = bitmap.shape
+        # all candidates are scored in one pass
+        contours, cand_scores = self.get_candidates(pred, bitmap, batch_score=True)
+        num_contours = len(contours)
+
+        boxes = np.zeros((num_contours, 4, 2), dtype=np.int16)
+        scores = np.zeros((num_contours,), dtype=np.float32)
+        if num_contours == 0:
+            return boxes, scores
+
+        keep = np.flatnonzero(cand_scores >= self.box_thresh)
+
+        # min area rects in (cx, cy, w, h, angle)
+        rects = np.array([[*r[0], *r[1], r[2]] for r in map(cv2.minAreaRect, (contours[i] for i in keep))],
+                         dtype=np.float64).reshape(-1, 5)
+        valid = rects[:, 2:4].min(axis=1) >= self.min_size
+        keep, rects = keep[valid], rects[valid]
+
+        # unclip: offsetting a w x h rectangle by d with round joins gives a min area rect of (w + 2d) x (h + 2d)
+        w, h = rects[:, 2], rects[:, 3]
+        distance = w * h * self.unclip_ratio / (2 * (w + h))
+        rects[:, 2:4] += 2 * distance[:, None]
+        valid = rects[:, 2:4].min(axis=1) >= self.min_size + 2
+        keep, rects = keep[valid], rects[valid]
+
+        box = self.order_box_points(self.rect_points(rects))
+        if not isinstance(dest_width, int):
+            dest_width = dest_width.item()
+            dest_height = dest_height.item()
+        box[:, :, 0] = np.clip(np.round(box[:, :, 0] / width * dest_width), 0, dest_width)
+        box[:, :, 1] = np.clip(np.round(box[:, :, 1] / height * dest_height), 0, dest_height)
+        boxes[keep] = box.astype(np.int16)
+        scores[keep] = cand_scores[keep]
+        return boxes, scores
+
+    def get_candidates(self, pred, bitmap, batch_score=False):
+        '''
+        Find the candidate regions in a binary map.
+
+        Args:
+            pred: score map with shape (H, W)
+            bitmap: binary map with shape (H, W)
+            batch_score: if True, the scores of all candidates are computed at once and only outer contours are
+                returned. Always True for the 'cc' region extractor.
+        Returns:
+            contours: list of at most max_candidates contours, each in shape (num_points, 1, 2)
+            scores: np.ndarray of shape (len(contours),), the mean score of each candidate. None if not batch_score,
+                the scores are then left to `box_score_fast`.
+        '''
+        bitmap = self.to_uint8(bitmap)
+        if self.region_extractor == 'cc':
+            return self.cc_candidates(pred, bitmap)
+
+        if not batch_score:
+            contours, _ = cv2.findContours(bitmap, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+            return contours[:self.max_candidates], None
+
+        contours, _ = cv2.findContours(bitmap, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contours = contours[:self.max_candidates]
+        return contours, self.contour_scores(pred, bitmap, contours)
+
+    def cc_candidates(self, pred, bitmap):
+        '''
+        Candidates from connected components. Regions are filtered by size and score with the label stats first,
+        so that contours are only traced for the regions left.
+        '''
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(bitmap, connectivity=8, ltype=cv2.CV_32S)
+        label_sums = np.bincount(labels.ravel(), weights=pred.ravel(), minlength=num_labels)
+        label_scores = (label_sums / np.maximum(stats[:, cv2.CC_STAT_AREA], 1)).astype(np.float32)
+
+        # label 0 is the background
+        sides = np.minimum(stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT])
+        valid = (label_scores >= self.box_thresh) & (sides >= self.min_size)
+        valid[0] = False
+        keep = np.flatnonzero(valid)[:self.max_candidates]
+
+        contours = []
+        for label in keep:
+            x, y, w, h = stats[label, :4]
+            mask = (labels[y:y + h, x:x + w] == label).astype(np.uint8)
+            contour, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(int(x), int(y)))
+            contours.append(contour[0])
+        return contours, label_scores[keep]
+
+    @staticmethod
+    def to_uint8(bitmap):
+        '''
+        Binary map to a uint8 map in {0, 1} for cv2. Bool maps are viewed without copy.
+        '''
+        if bitmap.dtype == np.bool_:
+            return bitmap.view(np.uint8)
+        return (bitmap > 0).astype(np.uint8)
+
+    @staticmethod
+    def contour_scores(pred, bitmap, contours):
+        '''
+        Mean score of the connected region enclosed by each outer contour, computed for all contours at once.
+        A contour and its region are 8-connected, so the region is found by the label at the first contour point.
+        '''
+        if len(contours) == 0:
+            return np.zeros((0,), dtype=np.float32)
+        num_labels, labels = cv2.connectedComponents(bitmap, connectivity=8, ltype=cv2.CV_32S)
+        label_sums = np.bincount(labels.ravel(), weights=pred.ravel(), minlength=num_labels)
+        label_areas = np.bincount(labels.ravel(), minlength=num_labels)
+        label_scores = (label_sums / np.maximum(label_areas, 1)).astype(np.float32)
+
+        starts = np.array([c[0, 0] for c in contours])
+        return label_scores[labels[starts[:, 1], starts[:, 0]]]
+
+    @staticmethod
+    def rect_points(rects):
+        '''
+        Vectorized cv2.boxPoints. rects: (K, 5) in (cx, cy, w, h, angle in degree). Return (K, 4, 2) corners.
+        '''
+        angle = np.deg2rad(rects[:, 4])
+        b = np.cos(angle) * 0.5
+        a = np.sin(angle) * 0.5
+        cx, cy, w, h = rects[:, 0], rects[:, 1], rects[:, 2], rects[:, 3]
+        points = np.empty((len(rects), 4, 2), dtype=np.float64)
+        points[:, 0, 0] = cx - a * h - b * w
+        points[:, 0, 1] = cy + b * h - a * w
+        points[:, 1, 0] = cx + a * h - b * w
+        points[:, 1, 1] = cy - b * h - a * w
+        points[:, 2] = 2 * rects[:, :2] - points[:, 0]
+        points[:, 3] = 2 * rects[:, :2] - points[:, 1]
+        return points
+
+    @staticmethod
+    def order_box_points(points):
+        '''
+        Vectorized point ordering of `get_mini_boxes`. points: (K, 4, 2). Return (K, 4, 2) in the order of
+        top-left, top-right, bottom-right, bottom-left.
+        '''
+        order = np.argsort(points[:, :, 0], axis=1, kind='stable')
+        points = np.take_along_axis(points, order[:, :, None], axis=1)
+        left_down = (points[:, 1, 1] > points[:, 0, 1])[:, None]
+        right_down = (points[:, 3, 1] > points[:, 2, 1])[:, None]
+        box = np.empty_like(points)
+        box[:, 0] = np.where(left_down, points[:, 0], points[:, 1])
+        box[:, 3] = np.where(left_down, points[:, 1], points[:, 0])
+        box[:, 1] = np.where(right_down, points[:, 2], points[:, 3])
+        box[:, 2] = np.where(right_down, points[:, 3], points[:, 2])
+        return box
     # TODO: adopted from paddle
     '''
     def boxes_from_bitmap(self, pred, _bitmap, dest_width, dest_height):
@@ -8,6 +8,67 @@ import mindspore as ms
 
 __all__ = ['RecCTCLabelDecode']
 
+
+def _segment_logsumexp(values, starts):
+    ''' log(sum(exp(values))) of each segment of values beginning at starts, -inf for the segments of -inf only '''
+    seg_max = np.maximum.reduceat(values, starts)
+    seg_max = np.where(np.isfinite(seg_max), seg_max, 0.)
+    counts = np.diff(np.append(starts, len(values)))
+    sums = np.add.reduceat(np.exp(values - np.repeat(seg_max, counts)), starts)
+    with np.errstate(divide='ignore'):
+        return seg_max + np.log(sums)
+
+
+class CharTrie(object):
+    ''' Compact prefix trie over char indices, used to constrain beam search decoding to a lexicon.
+
+    Nodes are integers with root 0. The transitions are kept in sorted numpy arrays of the keys
+    (node * stride + char index) and the child nodes, so that the children of many (node, char) pairs are looked up at
+    once by binary search, and the word-end flags in a numpy bool array.
+
+    Args:
+        words (List[List[int]]): words as sequences of char indices
+    '''
+    def __init__(self, words):
+        transitions = {}
+        word_ends = [False]
+        for word in words:
+            node = 0
+            for c in word:
+                child = transitions.get((node, c))
+                if child is None:
+                    child = len(word_ends)
+                    transitions[(node, c)] = child
+                    word_ends.append(False)
+                node = child
+            word_ends[node] = True
+        self.is_word = np.array(word_ends, dtype=bool)
+
+        self.stride = max([c for _, c in transitions] + [0]) + 1
+        keys = np.array([node * self.stride + c for node, c in transitions], dtype=np.int64)
+        order = np.argsort(keys)
+        self._keys = keys[order]
+        self._children = np.array(list(transitions.values()), dtype=np.int64)[order]
+
+    def children(self, nodes, chars):
+        ''' the child nodes through the char indices, -1 where the prefix is not in the lexicon '''
+        nodes, chars = np.broadcast_arrays(np.asarray(nodes, dtype=np.int64), np.asarray(chars, dtype=np.int64))
+        if len(self._keys) == 0:
+            return np.full(nodes.shape, -1, dtype=np.int64)
+        keys = nodes * self.stride + np.minimum(chars, self.stride - 1)
+        pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        found = (chars < self.stride) & (self._keys[pos] == keys)
+        return np.where(found, self._children[pos], -1)
+
+    def child(self, node, c):
+        ''' the child node through char index c, None if the prefix is not in the lexicon '''
+        child = int(self.children(node, c))
+        return None if child < 0 else child
+
+    def __len__(self):
+        return len(self.is_word)
+
+
 class RecCTCLabelDecode(object):
     ''' Convert text label (str) to a sequence of character indices according to the char dictionary
 
@@ -16,6 +77,9 @@ class RecCTCLabelDecode(object):
         use_space_char(bool): if True, add space char to the dict to recognize the space in between two words
         blank_at_last(bool): padding with blank index (not the space index). If True, a blank/padding token will be appended to the end of the dictionary, so that blank_index = num_chars, where num_chars is the number of character in the dictionary including space char if used. If False, blank token will be inserted in the beginning of the dictionary, so blank_index=0.
         lower (bool): if True, all upper-case chars in the label text will be converted to lower case. Set to be True if dictionary only contains lower-case chars. Set to be False if not and want to recognition both upper-case and lower-case.
+        decode_mode (str): 'greedy' takes the argmax char at each step. 'beam_search' runs CTC prefix beam search, which is slower but more accurate.
+        beam_width (int): number of prefixes kept at each step in beam search. It also limits the candidate chars per step to the top-k most probable ones.
+        lexicon_path (str): optional, path to a lexicon file with one word per line. If given, beam search only keeps prefixes of the lexicon words and outputs a lexicon word if any is reachable. Words with chars out of the dictionary are skipped.
 
     Attributes:
         blank_idx: the index of the blank token for padding
@@ -29,9 +93,15 @@ class RecCTCLabelDecode(object):
                 use_space_char=False,
                 blank_at_last=True,
                 lower=False,
+                decode_mode='greedy',
+                beam_width=10,
+                lexicon_path=None,
                 ):
         self.space_idx = None
         self.lower = lower
+        assert decode_mode in ['greedy', 'beam_search'], f'Invalid decode_mode {decode_mode}, valid values are greedy and beam_search'
+        self.decode_mode = decode_mode
+        self.beam_width = beam_width
 
         # read dict
         if character_dict_path is None:
@@ -68,9 +138,25 @@ class RecCTCLabelDecode(object):
         self.ignore_indices = [self.blank_idx]
         
         self.character = {idx:c for idx, c in enumerate(char_list)}
+        # object array for looking up the chars of a batch of indices at once
+        self._char_array = np.array(char_list, dtype=object)
 
         self.num_classes = len(self.character)
 
+        self.trie = None
+        if lexicon_path is not None:
+            char_to_idx = {c: idx for idx, c in enumerate(char_list) if idx not in self.ignore_indices}
+            words = []
+            with open(lexicon_path, 'r') as f:
+                for line in f:
+                    word = line.rstrip('\n\r')
+                    if self.lower:
+                        word = word.lower()
+                    if len(word) > 0 and all(c in char_to_idx for c in word):
+                        words.append([char_to_idx[c] for c in word])
+            self.trie = CharTrie(words)
+            print(f'INFO: {len(words)} lexicon words loaded for beam search decoding, trie size {len(self.trie)}')
+
     def decode(self, char_indices, prob=None, remove_duplicate=False):
         '''
         Convert to a squence of char indices to text string
@@ -80,37 +166,172 @@ class RecCTCLabelDecode(object):
             text
         '''
 
-        """ convert text-index into text-label. """
-        texts = []
-        confs = []
-        batch_size = len(char_indices)
-        for batch_idx in range(batch_size):
-            selection = np.ones(len(char_indices[batch_idx]), dtype=bool)
-            if remove_duplicate:
-                selection[1:] = char_indices[batch_idx][1:] != char_indices[
-                    batch_idx][:-1]
-            for ignored_token in self.ignore_indices:
-                selection &= char_indices[batch_idx] != ignored_token
-
-            char_list = [
-                self.character[text_id]
-                for text_id in char_indices[batch_idx][selection]
-            ]
-            if prob is not None:
-                conf_list = prob[batch_idx][selection]
-            else:
-                conf_list = [1] * len(selection)
-            if len(conf_list) == 0:
-                conf_list = [0]
-
-            text = ''.join(char_list)
-
-            #result_list.append((text, np.mean(conf_list).tolist()))
-            texts.append(text)
-            confs.append(np.mean(conf_list))
+        """ convert text-index into text-label. All samples in the batch are processed at once. """
+        char_indices = np.asarray(char_indices)
+        batch_size = char_indices.shape[0]
+        if batch_size == 0:
+            return [], []
+
+        selection = ~np.isin(char_indices, self.ignore_indices)
+        if remove_duplicate:
+            selection[:, 1:] &= char_indices[:, 1:] != char_indices[:, :-1]
+
+        # flattened selected chars of all samples, split by the sample lengths
+        lengths = selection.sum(axis=1)
+        chars = self._char_array[char_indices[selection]]
+        texts = [''.join(sample_chars) for sample_chars in np.split(chars, np.cumsum(lengths)[:-1])]
+
+        if prob is not None:
+            # mean confidence of the selected chars, 0 if no char is selected
+            sample_ids = np.repeat(np.arange(batch_size), lengths)
+            conf_sums = np.bincount(sample_ids, weights=np.asarray(prob)[selection], minlength=batch_size)
+            confs = (conf_sums / np.maximum(lengths, 1)).tolist()
+        else:
+            confs = [1.0 if char_indices.shape[1] > 0 else 0.0] * batch_size
         return texts, confs
 
-        
+
+    def beam_search_decode(self, probs):
+        '''
+        CTC prefix beam search.
+        Args:
+            probs (np.ndarray): char probabilities in shape [BS, W, num_classes]
+        Returns:
+            texts (List[str]), confs (List[float]): the best label sequences and their probabilities
+        '''
+        if probs.shape[0] == 0:
+            return [], []
+        log_probs = np.log(np.maximum(probs, 1e-30))
+        char_indices, scores = self._beam_search(log_probs)
+        texts = [''.join(self._char_array[indices]) for indices in char_indices]
+        return texts, np.exp(scores).tolist()
+
+    def _beam_search(self, log_probs):
+        '''
+        Prefix beam search on a batch, log_probs in shape [BS, W, num_classes]. Returns the char indices of the best
+        prefix of each sample and its log probability.
+
+        The prefixes of all samples are node ids of one prefix tree grown during the search, with the parent node, the
+        last char, the sample and, if a lexicon is used, the lexicon trie node of each node in preallocated arrays.
+        Each beam keeps the log probabilities of the alignments ending in blank and in non-blank. At each step, all
+        beams of the batch are extended by the top-k chars of their sample at once, an extension equal to an existing
+        beam (its parent and last char) is merged into it, the extensions out of the lexicon are dropped, and the
+        probabilities of the same prefix are summed by a segmented log-sum-exp.
+        '''
+        batch_size, seq_len, num_classes = log_probs.shape
+        blank = self.blank_idx
+        beam_width = self.beam_width
+        top_k = min(beam_width, num_classes)
+        rows = np.arange(batch_size)
+
+        # prefix tree with the empty prefix of each sample as its root, a step adds at most BS * beam_width * top_k nodes
+        capacity = batch_size * (1 + seq_len * beam_width * top_k)
+        parents = np.empty(capacity, dtype=np.int64)
+        last_chars = np.empty(capacity, dtype=np.int64)
+        lex_nodes = np.empty(capacity, dtype=np.int64)
+        node_samples = np.empty(capacity, dtype=np.int64)
+        parents[:batch_size], last_chars[:batch_size], lex_nodes[:batch_size] = -1, -1, 0
+        node_samples[:batch_size] = rows
+        num_nodes = batch_size
+
+        # beams in [BS, beam_width], -1 for none
+        beams = np.full((batch_size, beam_width), -1, dtype=np.int64)
+        beams[:, 0] = rows
+        p_blank = np.full((batch_size, beam_width), -np.inf)
+        p_blank[:, 0] = 0.
+        p_non_blank = np.full((batch_size, beam_width), -np.inf)
+
+        for t in range(seq_len):
+            step = log_probs[:, t]
+            chars = np.argpartition(step, -top_k, axis=1)[:, -top_k:]
+            valid_beams = beams >= 0
+            totals = np.logaddexp(p_blank, p_non_blank)
+            last = np.where(valid_beams, last_chars[np.maximum(beams, 0)], -1)
+
+            # staying at the same prefix: a blank, or the last char repeated without blank in between
+            stay_blank = totals + step[:, blank:blank + 1]
+            stay_non_blank = np.where(last >= 0, p_non_blank + np.take_along_axis(step, np.maximum(last, 0), axis=1),
+                                      -np.inf)
+
+            # extending by each char: after a repeated char, only from the alignments ending in blank
+            ext_probs = np.where(chars[:, None, :] == last[:, :, None], p_blank[:, :, None], totals[:, :, None]) \
+                + np.take_along_axis(step, chars, axis=1)[:, None, :]
+            ext_mask = valid_beams[:, :, None] & ~np.isin(chars, self.ignore_indices)[:, None, :]
+            ext_beams = np.broadcast_to(beams[:, :, None], ext_probs.shape)[ext_mask]
+            ext_chars = np.broadcast_to(chars[:, None, :], ext_probs.shape)[ext_mask]
+            ext_probs = ext_probs[ext_mask]
+
+            # an extension is an existing beam if that beam has the same parent and last char
+            beam_nodes = beams[valid_beams]
+            child_beams = beam_nodes[parents[beam_nodes] >= 0]
+            beam_keys = parents[child_beams] * num_classes + last_chars[child_beams]
+            order = np.argsort(beam_keys)
+            beam_keys, child_beams = beam_keys[order], child_beams[order]
+            keys = ext_beams * num_classes + ext_chars
+            ext_nodes = np.full(len(keys), -1, dtype=np.int64)
+            found = np.zeros(len(keys), dtype=bool)
+            if len(beam_keys) > 0:
+                pos = np.minimum(np.searchsorted(beam_keys, keys), len(beam_keys) - 1)
+                found = beam_keys[pos] == keys
+                ext_nodes[found] = child_beams[pos[found]]
+
+            # create the nodes of the other extensions, within the lexicon if any
+            new_parents, new_chars = ext_beams[~found], ext_chars[~found]
+            new_lex = lex_nodes[new_parents]
+            if self.trie is not None:
+                new_lex = self.trie.children(new_lex, new_chars)
+            in_lexicon = new_lex >= 0
+            new_ids = np.full(len(new_parents), -1, dtype=np.int64)
+            num_new = int(in_lexicon.sum())
+            new_ids[in_lexicon] = np.arange(num_nodes, num_nodes + num_new)
+            parents[num_nodes: num_nodes + num_new] = new_parents[in_lexicon]
+            last_chars[num_nodes: num_nodes + num_new] = new_chars[in_lexicon]
+            lex_nodes[num_nodes: num_nodes + num_new] = new_lex[in_lexicon]
+            node_samples[num_nodes: num_nodes + num_new] = node_samples[new_parents[in_lexicon]]
+            num_nodes += num_new
+            ext_nodes[~found] = new_ids
+            kept = ext_nodes >= 0
+
+            # sum the probabilities of the same prefix
+            cand_nodes = np.concatenate([beam_nodes, ext_nodes[kept]])
+            cand_blank = np.concatenate([stay_blank[valid_beams], np.full(int(kept.sum()), -np.inf)])
+            cand_non_blank = np.concatenate([stay_non_blank[valid_beams], ext_probs[kept]])
+            order = np.argsort(cand_nodes, kind='stable')
+            cand_nodes = cand_nodes[order]
+            starts = np.flatnonzero(np.concatenate([[True], cand_nodes[1:] != cand_nodes[:-1]]))
+            nodes = cand_nodes[starts]
+            next_blank = _segment_logsumexp(cand_blank[order], starts)
+            next_non_blank = _segment_logsumexp(cand_non_blank[order], starts)
+
+            # keep the top beam_width prefixes of each sample
+            samples = node_samples[nodes]
+            order = np.lexsort((-np.logaddexp(next_blank, next_non_blank), samples))
+            samples = samples[order]
+            ranks = np.arange(len(order)) - np.searchsorted(samples, rows)[samples]
+            selected = ranks < beam_width
+            order, samples, ranks = order[selected], samples[selected], ranks[selected]
+            beams = np.full((batch_size, beam_width), -1, dtype=np.int64)
+            p_blank = np.full((batch_size, beam_width), -np.inf)
+            p_non_blank = np.full((batch_size, beam_width), -np.inf)
+            beams[samples, ranks] = nodes[order]
+            p_blank[samples, ranks] = next_blank[order]
+            p_non_blank[samples, ranks] = next_non_blank[order]
+
+        scores = np.logaddexp(p_blank, p_non_blank)
+        if self.trie is not None:
+            is_word = (beams >= 0) & self.trie.is_word[lex_nodes[np.maximum(beams, 0)]]
+            scores = np.where(is_word.any(axis=1, keepdims=True) & ~is_word, -np.inf, scores)
+        best = scores.argmax(axis=1)
+
+        char_indices = []
+        for node in beams[rows, best].tolist():
+            indices = []
+            while parents[node] >= 0:
+                indices.append(int(last_chars[node]))
+                node = int(parents[node])
+            char_indices.append(indices[::-1])
+        return char_indices, scores[rows, best]
+
     def __call__(self, preds: Union[dict, List], labels = None, **kwargs):
         '''
         Args:
@@ -129,6 +350,10 @@ class RecCTCLabelDecode(object):
             preds = preds.asnumpy()
         
         preds = preds.transpose([1, 0, 2]) # [W, BS, C] -> [BS, W, C]
+        if self.decode_mode == 'beam_search':
+            texts, confs = self.beam_search_decode(preds)
+            return {'texts': texts, 'confs': confs}
+
         pred_indices = preds.argmax(axis=-1)
         pred_prob = preds.max(axis=-1)
         
@@ -136,7 +361,7 @@ class RecCTCLabelDecode(object):
         #print('pred prob: ', pred_prob.shape)
 
         # TODO: for debug only
-        raw_chars = [[self.character[idx] for idx in pred_indices[b]] for b in range(pred_indices.shape[0])]
+        raw_chars = self._char_array[pred_indices].tolist()
         
         texts, confs = self.decode(pred_indices, pred_prob, remove_duplicate=True)
 
@@ -8,8 +8,9 @@ from mindspore import save_checkpoint
 from mindspore.train.callback._callback import Callback, _handle_loss
 from mindocr.utils.visualize import show_img, draw_bboxes, show_imgs, recover_image
 from mindocr.utils.recorder import PerfRecorder
+from mindocr.data.transforms.profiler import report_transform_profile
 
-__all__ = ['Evaluator', 'EvalSaveCallback']
+__all__ = ['Evaluator', 'EvalSaveCallback', 'TransformProfileCallback']
 
 
 class Evaluator:
@@ -102,6 +103,12 @@ class Evaluator:
 
         return eval_res
 
+    def close(self):
+        ''' release the workers of the postprocessor and metrics, if any '''
+        for obj in [self.postprocessor] + list(self.metrics or []):
+            if hasattr(obj, 'close'):
+                obj.close()
+
     # TODO: add checkpoint save manager for better modulation
 
 
@@ -220,4 +227,22 @@ class EvalSaveCallback(Callback):
     def on_train_end(self, run_context):
         if self.rank_id in [0, None]:
             self.rec.save_curves()  # save performance curve figure
+            self.net_evaluator.close()
             print(f'=> best {self.main_indicator}: {self.best_perf} \nTraining completed!')
+
+
+class TransformProfileCallback(Callback):
+    """
+    Print the report of the data transforms profiled (accumulated from the start of training) at the end of each
+    epoch, and save it to `transform_profile.json` in the profile directory.
+
+    Args:
+        profile_dir (str): the `transform_profile_dir` of the train dataset
+    """
+    def __init__(self, profile_dir):
+        self.profile_dir = profile_dir
+
+    def on_train_epoch_end(self, run_context):
+        cur_epoch = run_context.original_args().cur_epoch_num
+        report = report_transform_profile(self.profile_dir, os.path.join(self.profile_dir, 'transform_profile.json'))
+        print(f'Transform profile till epoch {cur_epoch}:\n{report}')
@@ -0,0 +1,162 @@
+'''
+Compact container of polygons with various numbers of points, shared by the detection data transforms,
+postprocess and metrics.
+'''
+import numpy as np
+
+__all__ = ['RaggedPolygons']
+
+
+class RaggedPolygons(object):
+    '''
+    Polygons stored as flat float32 point coordinates with int32 offsets, and the ignore flags of the polygons.
+    Polygon i is `points[offsets[i]: offsets[i + 1]]`.
+
+    Compared to a list of point arrays, or an array padded to the max number of points, the geometric operations
+    (transform, clip, areas, bounding boxes, selection) run on all polygons at once without per-polygon objects, and
+    pickling a sample (e.g., to dataloader worker processes) only copies three arrays.
+
+    Indexing with an integer returns a view of the points of that polygon, so the code iterating polygons as arrays
+    works on it as is. Indexing with a slice, an index array or a bool mask returns the selected polygons.
+
+    Args:
+        points (np.ndarray): point coordinates of all polygons in shape [total_points, 2]
+        offsets (np.ndarray): start of each polygon in points, in shape [num_polygons + 1]. Polygons must not be empty.
+        ignore (np.ndarray): optional, bool flags of the ignored polygons in shape [num_polygons], default all False.
+            The array is shared (not copied) by the containers derived without selection, e.g. by `transform`, so that
+            it can be kept as the `ignore_tags` of a data sample.
+    '''
+    def __init__(self, points: np.ndarray, offsets: np.ndarray, ignore: np.ndarray = None):
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int32)
+        num_polygons = len(self.offsets) - 1
+        self.ignore = np.zeros(num_polygons, dtype=bool) if ignore is None else np.asarray(ignore, dtype=bool)
+        assert len(self.ignore) == num_polygons, \
+            f'The number of ignore flags {len(self.ignore)} mismatches the number of polygons {num_polygons}'
+
+    @classmethod
+    def from_polys(cls, polys, ignore=None):
+        '''
+        Create from a list of point arrays in shape [num_points, 2], or an array in shape [num_polygons, num_points, 2].
+        '''
+        if isinstance(polys, RaggedPolygons):
+            return polys if ignore is None else cls(polys.points, polys.offsets, ignore)
+        if isinstance(polys, np.ndarray) and polys.ndim == 3:
+            num_polygons, num_points = polys.shape[:2]
+            return cls(polys.reshape(-1, 2), np.arange(num_polygons + 1) * num_points, ignore)
+        lengths = [len(p) for p in polys]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum(lengths)
+        points = np.concatenate([np.asarray(p, dtype=np.float32).reshape(-1, 2) for p in polys]) if len(polys) > 0 \
+            else np.zeros((0, 2), dtype=np.float32)
+        return cls(points, offsets, ignore)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            return self.points[self.offsets[index]: self.offsets[index + 1]]
+        return self.select(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.points[self.offsets[i]: self.offsets[i + 1]]
+
+    def __repr__(self):
+        return f'RaggedPolygons(num_polygons={len(self)}, num_points={self.num_points().tolist()})'
+
+    def num_points(self):
+        return np.diff(self.offsets)
+
+    def polygon_ids(self):
+        ''' index of the polygon of each point, in shape [total_points] '''
+        return np.repeat(np.arange(len(self)), self.num_points())
+
+    def select(self, index):
+        ''' the polygons (with their ignore flags) selected by a slice, an index array or a bool mask '''
+        selected = np.arange(len(self))[index]
+        counts = self.num_points()[selected]
+        offsets = np.zeros(len(selected) + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum(counts)
+        point_index = np.repeat(self.offsets[selected] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return RaggedPolygons(self.points[point_index], offsets, self.ignore[selected])
+
+    def transform(self, matrix):
+        ''' apply an affine transformation given by a matrix in shape [2, 2], [2, 3] or [3, 3] '''
+        matrix = np.asarray(matrix, dtype=np.float64)
+        points = self.points @ matrix[:2, :2].T
+        if matrix.shape[1] == 3:
+            points += matrix[:2, 2]
+        return RaggedPolygons(points, self.offsets, self.ignore)
+
+    def scale(self, scale_x, scale_y=None):
+        scale_y = scale_x if scale_y is None else scale_y
+        return RaggedPolygons(self.points * np.array([scale_x, scale_y], dtype=np.float32), self.offsets, self.ignore)
+
+    def clip(self, width, height):
+        ''' clip the points into the image of size (height, width), i.e. x in [0, width - 1], y in [0, height - 1] '''
+        return RaggedPolygons(np.clip(self.points, 0, np.array([width - 1, height - 1], dtype=np.float32)),
+                              self.offsets, self.ignore)
+
+    def reverse(self, mask=None):
+        ''' reverse the point order (orientation) of the polygons where mask is True, or of all polygons '''
+        point_index = np.arange(len(self.points))
+        polygon_ids = self.polygon_ids()
+        reversed_index = self.offsets[polygon_ids] + self.offsets[polygon_ids + 1] - 1 - point_index
+        if mask is not None:
+            reversed_index = np.where(np.asarray(mask)[polygon_ids], reversed_index, point_index)
+        return RaggedPolygons(self.points[reversed_index], self.offsets, self.ignore)
+
+    def next_point_index(self):
+        ''' index of the next point of each point in its polygon (the first point follows the last one) '''
+        next_index = np.arange(1, len(self.points) + 1)
+        next_index[self.offsets[1:] - 1] = self.offsets[:-1]
+        return next_index
+
+    def edges(self):
+        ''' edge vectors from each point to the next point in its polygon, in shape [total_points, 2] '''
+        return self.points[self.next_point_index()] - self.points
+
+    def reduce(self, values):
+        ''' sum of per-point values over each polygon, in shape [num_polygons] '''
+        if len(self) == 0:
+            return np.zeros(0, dtype=values.dtype)
+        return np.add.reduceat(values, self.offsets[:-1])
+
+    def areas(self):
+        '''
+        Signed areas by the shoelace formula, in shape [num_polygons]. The area is positive if the points go
+        counterclockwise in the x-right, y-up axes, i.e. clockwise on an image.
+        '''
+        next_index = self.next_point_index()
+        x, y = self.points[:, 0].astype(np.float64), self.points[:, 1].astype(np.float64)
+        return 0.5 * self.reduce(x * y[next_index] - x[next_index] * y)
+
+    def bboxes(self):
+        ''' axis-aligned bounding boxes in shape [num_polygons, 4], as (xmin, ymin, xmax, ymax) '''
+        if len(self) == 0:
+            return np.zeros((0, 4), dtype=np.float32)
+        starts = self.offsets[:-1]
+        return np.concatenate([np.minimum.reduceat(self.points, starts), np.maximum.reduceat(self.points, starts)],
+                              axis=1)
+
+    def outside_rect(self, x, y, width, height):
+        ''' whether each polygon lies entirely outside the rectangle, in shape [num_polygons] '''
+        boxes = self.bboxes()
+        return (boxes[:, 2] < x) | (boxes[:, 0] > x + width) | (boxes[:, 3] < y) | (boxes[:, 1] > y + height)
+
+    def to_padded(self):
+        '''
+        Array in shape [num_polygons, max_num_points, 2], where the polygons with fewer points are padded by repeating
+        their last point, the same as `DetLabelEncode.expand_points_num`.
+        '''
+        num_points = self.num_points()
+        max_num_points = int(num_points.max()) if len(self) > 0 else 0
+        point_index = self.offsets[:-1, None] + np.minimum(np.arange(max_num_points)[None], num_points[:, None] - 1)
+        return self.points[point_index]
+
+    def to_list(self):
+        return list(self)
@@ -1,6 +1,7 @@
 import sys
 sys.path.append('.')
 
+import os
 import yaml
 import glob
 import pytest
@@ -13,6 +14,10 @@ from mindocr.data import build_dataset
 from mindocr.data.det_dataset import DetDataset
 from mindocr.data.transforms.transforms_factory import transforms_dbnet_icdar15
 from mindocr.data.rec_dataset import RecDataset
+from mindocr.data.rec_lmdb_dataset import LMDBDataset
+from mindocr.data.rec_shard_dataset import RecShardDataset, write_rec_shard
+from mindocr.data.sample_index import SampleIndex, _FeistelPermutation
+from mindocr.data.annot_cache import load_annotation_table
 from mindspore import load_checkpoint, load_param_into_net
 
 from mindocr.utils.visualize import show_img, draw_bboxes, show_imgs, recover_image
@@ -202,6 +207,194 @@ def test_rec_dataset(visualize=True):
     '''
 
 
+def test_rec_shard_dataset(tmp_path):
+    import cv2
+    import pickle
+    samples = []
+    for i in range(5):
+        img = np.full((32, 40 + i, 3), i * 10, dtype=np.uint8)
+        samples.append((cv2.imencode('.png', img)[1].tobytes(), f'text{i}'))
+    assert write_rec_shard(str(tmp_path / 'a.shard'), samples[:3]) == 3
+    assert write_rec_shard(str(tmp_path / 'b.shard'), samples[3:]) == 2
+
+    ds = RecShardDataset(data_dir=str(tmp_path), shuffle=False,
+                         transform_pipeline=[{'DecodeImage': {'img_mode': 'BGR'}}],
+                         output_keys=['image', 'label'])
+    assert len(ds) == 5
+    ds = pickle.loads(pickle.dumps(ds)) # as in dataloader workers
+    for i in range(5):
+        image, label = ds[i]
+        assert label == f'text{i}'
+        assert image.shape == (32, 40 + i, 3) and (image == i * 10).all()
+
+    # per-shard ratios: the samples of a.shard once and of b.shard twice, shuffled
+    ds = RecShardDataset(data_dir=str(tmp_path), sample_ratios=[1.0, 2.0], shuffle=True,
+                         transform_pipeline=[{'DecodeImage': {'img_mode': 'BGR'}}],
+                         output_keys=['image', 'label'])
+    assert len(ds) == 7
+    labels = sorted(ds[i][1] for i in range(len(ds)))
+    assert labels == ['text0', 'text1', 'text2', 'text3', 'text3', 'text4', 'text4']
+    with pytest.raises(ValueError):
+        RecShardDataset(data_dir=str(tmp_path), sample_ratios=[1.0, 1.0, 1.0],
+                        transform_pipeline=[{'DecodeImage': {'img_mode': 'BGR'}}], output_keys=['image', 'label'])
+
+
+def _write_lmdb(path, labels):
+    import cv2
+    import lmdb
+    os.makedirs(path)
+    with lmdb.open(path, map_size=1 << 24) as env, env.begin(write=True) as txn:
+        for i, label in enumerate(labels):
+            img = np.full((32, 40, 3), i * 10, dtype=np.uint8)
+            txn.put(b'image-%09d' % (i + 1), cv2.imencode('.png', img)[1].tobytes())
+            txn.put(b'label-%09d' % (i + 1), label.encode())
+        txn.put(b'num-samples', str(len(labels)).encode())
+
+
+def test_feistel_permutation():
+    for size in [1, 2, 7, 100, 1025]:
+        perm = _FeistelPermutation(size, seed=size)
+        assert sorted(perm(i) for i in range(size)) == list(range(size))
+    with pytest.raises(IndexError):
+        _FeistelPermutation(0, seed=0)(0)
+    assert len(SampleIndex([0], 1.0, shuffle=True)) == 0
+    # empty datasets are skipped
+    index = SampleIndex([3, 0, 2], 1.0, shuffle=False)
+    assert [index(i) for i in range(len(index))] == [(0, 0), (0, 1), (0, 2), (2, 0), (2, 1)]
+    with pytest.raises(IndexError):
+        index(len(index))
+
+
+def test_lmdb_dataset(tmp_path):
+    _write_lmdb(str(tmp_path / 'a'), ['a0', 'a1', 'a2'])
+    _write_lmdb(str(tmp_path / 'b'), ['b0', 'b1'])
+    kwargs = dict(data_dir=str(tmp_path), transform_pipeline=[{'DecodeImage': {'img_mode': 'BGR'}}],
+                  output_keys=['image', 'label'])
+
+    # the samples of a once and of b twice, mapped to the LMDB keys starting from 1
+    ds = LMDBDataset(sample_ratios=[1.0, 2.0], shuffle=False, **kwargs)
+    assert len(ds) == 7
+    assert [ds.get_lmdb_idx(i) for i in range(7)] == [(0, 1), (0, 2), (0, 3), (1, 1), (1, 2), (1, 1), (1, 2)]
+    assert [ds[i][1] for i in range(7)] == ['a0', 'a1', 'a2', 'b0', 'b1', 'b0', 'b1']
+
+    # shuffled, each sample of b is repeated twice
+    ds = LMDBDataset(sample_ratios=[1.0, 2.0], shuffle=True, **kwargs)
+    labels = [ds[i][1] for i in range(len(ds))]
+    assert sorted(labels) == ['a0', 'a1', 'a2', 'b0', 'b0', 'b1', 'b1']
+    assert len(LMDBDataset(sample_ratios=0.5, shuffle=True, **kwargs)) == 3
+
+    with pytest.raises(ValueError):
+        LMDBDataset(sample_ratios=[1.0, 1.0, 1.0], shuffle=False, **kwargs)
+
+
+def _read_lmdb_in_worker(ds, queue):
+    from mindocr.data import rec_lmdb_dataset
+    labels = [ds[i][1] for i in range(len(ds))]
+    env = ds.get_lmdb_env(0)
+    queue.put((labels, rec_lmdb_dataset._lmdb_envs_pid == os.getpid(), env is rec_lmdb_dataset._lmdb_envs[
+        os.path.abspath(ds.lmdb_sets[0]['dirpath'])]))
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='fork is not available')
+def test_lmdb_dataset_fork(tmp_path):
+    import multiprocessing as mp
+    _write_lmdb(str(tmp_path / 'a'), ['a0', 'a1', 'a2'])
+    ds = LMDBDataset(data_dir=str(tmp_path), shuffle=False, transform_pipeline=[{'DecodeImage': {'img_mode': 'BGR'}}],
+                     output_keys=['image', 'label'])
+    # no environment is kept open in the parent process after building the dataset, so none is inherited by fork
+    from mindocr.data import rec_lmdb_dataset
+    dirpath = os.path.abspath(ds.lmdb_sets[0]['dirpath'])
+    assert dirpath not in rec_lmdb_dataset._lmdb_envs or rec_lmdb_dataset._lmdb_envs_pid != os.getpid()
+
+    ctx = mp.get_context('fork')
+    queue = ctx.Queue()
+    worker = ctx.Process(target=_read_lmdb_in_worker, args=(ds, queue))
+    worker.start()
+    labels, own_pid, own_env = queue.get(timeout=60)
+    worker.join()
+    assert labels == ['a0', 'a1', 'a2']
+    assert own_pid and own_env
+    # the parent opens its own environment on its first read
+    assert ds[2][1] == 'a2' and ds.get_lmdb_env(0) is rec_lmdb_dataset._lmdb_envs[dirpath]
+
+
+def test_annotation_cache(tmp_path):
+    label_file = tmp_path / 'gt.txt'
+    label_file.write_text('a.jpg\tlabel_a\nb.jpg\tlabel_b\n')
+    num_parsed = [0]
+    def parse(line):
+        num_parsed[0] += 1
+        img_path, label = line.strip().split('\t')
+        return {'img_path': img_path, 'label': label}
+
+    cache_dir = str(tmp_path / 'cache')
+    table = load_annotation_table([str(label_file)], parse, cache_dir)
+    assert len(table) == 2 and table[1] == {'img_path': 'b.jpg', 'label': 'label_b'}
+    assert num_parsed[0] == 2
+
+    # loaded from cache, also after the label file is touched
+    table = load_annotation_table([str(label_file)], parse, cache_dir)
+    os.utime(label_file, ns=(0, 0))
+    table = load_annotation_table([str(label_file)], parse, cache_dir)
+    assert num_parsed[0] == 2
+    assert table.take([1, 0])[0] == {'img_path': 'b.jpg', 'label': 'label_b'}
+
+    # compiled again after the label file is changed
+    label_file.write_text('a.jpg\tlabel_a\nb.jpg\tlabel_b\nc.jpg\tlabel_c\n')
+    table = load_annotation_table([str(label_file)], parse, cache_dir)
+    assert len(table) == 3 and num_parsed[0] == 5
+
+
+
+class _ArrayDataset(object):
+    def __init__(self, num_samples):
+        self.num_samples = num_samples
+
+    def __len__(self):
+        return self.num_samples
+
+    def get_column_names(self):
+        return ['image', 'polys', 'index']
+
+    def __getitem__(self, index):
+        # sample 3 is larger than the slot and falls back to pickling
+        size = 64 if index == 3 else 32
+        return np.full((3, size, size), index, dtype=np.float32), np.zeros((index % 3, 4, 2)), index
+
+
+def test_shared_memory_loader():
+    from mindocr.data.shm_loader import SharedMemoryLoader, infer_max_rowsize, probe_samples
+    dataset = _ArrayDataset(10)
+    assert infer_max_rowsize([dataset[0]]) == 1
+    # the probed samples include the larger one
+    probed = probe_samples(dataset, num_samples=4)
+    assert [s[2] for s in probed] == [0, 3, 6, 9]
+    assert SharedMemoryLoader(dataset, num_workers=1, samples=probed, margin=1.).slot_size >= 3 * 64 * 64 * 4
+
+    loader = SharedMemoryLoader(dataset, num_workers=2, samples=[dataset[0]])
+    for _ in range(2):
+        samples = list(loader)
+        assert [s[2] for s in samples] == list(range(10))
+        for image, polys, index in samples:
+            assert (image == index).all() and polys.shape == (index % 3, 4, 2)
+    # an epoch stopped early does not affect the next one
+    it = iter(loader)
+    next(it)
+    del it
+    assert [s[2] for s in loader] == list(range(10))
+    loader.close()
+
+    # shuffled shards of the same seed cover the dataset in every epoch
+    loaders = [SharedMemoryLoader(dataset, num_workers=1, shuffle=True, num_shards=3, shard_id=i) for i in range(3)]
+    for loader in loaders:
+        loader.seed = loaders[0].seed
+    for _ in range(2):
+        indices = [s[2] for loader in loaders for s in loader]
+        assert len(indices) == 12 and sorted(set(indices)) == list(range(10))
+    for loader in loaders:
+        loader.close()
+
+
 if __name__ == '__main__':
     #test_build_dataset(task='det', phase='eval', visualize=True)
     test_build_dataset(task='det', phase='train', visualize=False)
@@ -0,0 +1,47 @@
+import sys
+sys.path.append('.')
+
+import numpy as np
+import mindspore as ms
+import pytest
+from mindocr.losses.det_loss import BalancedBCELoss
+from mindocr.losses.rec_loss import CTCLoss
+
+
+def test_balanced_bce_ohem_topk():
+    rng = np.random.RandomState(0)
+    pred = ms.Tensor(rng.uniform(0.01, 0.99, (2, 1, 32, 32)).astype(np.float32))
+    gt = ms.Tensor((rng.rand(2, 1, 32, 32) < 0.1).astype(np.float32))
+    mask = ms.Tensor((rng.rand(2, 32, 32) < 0.95).astype(np.float32))
+
+    # the same negatives are mined as long as their number is within the top-k bound
+    loss_sort = BalancedBCELoss(ohem_mode='sort')(pred, gt, mask).asnumpy()
+    loss_topk = BalancedBCELoss(ohem_mode='topk', max_positive_fraction=0.15)(pred, gt, mask).asnumpy()
+    print('loss sort, topk: ', loss_sort, loss_topk)
+    assert np.allclose(loss_sort, loss_topk, rtol=1e-5)
+
+    # fewer negatives with a smaller bound
+    loss_capped = BalancedBCELoss(ohem_mode='topk', max_positive_fraction=0.02)(pred, gt, mask).asnumpy()
+    assert not np.allclose(loss_sort, loss_capped)
+
+
+def test_ctc_loss_width_buckets():
+    rng = np.random.RandomState(0)
+    bs, num_classes, max_label_len = 4, 10, 8
+    label = ms.Tensor(rng.randint(0, num_classes - 1, (bs, max_label_len)).astype(np.int32))
+    loss_fn = CTCLoss(pred_seq_len=24, max_label_len=max_label_len, batch_size=bs, bucket_seq_lens=[12, 16])
+
+    # a batch of a narrower bucket is computed with its own sequence length
+    logits = ms.Tensor(rng.randn(16, bs, num_classes).astype(np.float32))
+    loss = loss_fn({'head_out': logits}, label).asnumpy()
+    expected = CTCLoss(pred_seq_len=16, max_label_len=max_label_len, batch_size=bs)({'head_out': logits}, label)
+    assert np.isfinite(loss) and np.allclose(loss, expected.asnumpy())
+
+    # a bucket too narrow for the labels is rejected when the loss is built
+    with pytest.raises(AssertionError):
+        CTCLoss(pred_seq_len=24, max_label_len=max_label_len, batch_size=bs, bucket_seq_lens=[max_label_len, 16])
+
+
+if __name__ == '__main__':
+    test_balanced_bce_ohem_topk()
+    test_ctc_loss_width_buckets()
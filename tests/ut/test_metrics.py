@@ -5,7 +5,8 @@ import numpy as np
 
 from mindocr.data.det_dataset import DetDataset
 from mindocr.postprocess.det_postprocess import DBPostprocess
-from mindocr.metrics.det_metrics import DetMetric
+from mindocr.metrics.det_metrics import DetMetric, DetMetricState, DetectionIoUEvaluator, _convex_quads, _convex_quads_intersection
+from mindocr.metrics.rec_metrics import RecMetric
 
 
 def test_det_metric():
@@ -35,5 +36,95 @@ def test_det_metric():
     print(res)
     
 
+def test_det_iou_evaluator():
+    from shapely.geometry import Polygon
+    rng = np.random.RandomState(0)
+    quads = []
+    for _ in range(100):
+        x, y = rng.uniform(0, 200, 2)
+        w, h = rng.uniform(10, 50, 2)
+        quads.append(np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]]) + rng.normal(0, 2, (4, 2)))
+    shifted = [q + rng.normal(0, 10, 2) for q in quads]
+
+    # batched quad intersection against shapely
+    is_quad_a, quads_a = _convex_quads(quads)
+    is_quad_b, quads_b = _convex_quads(shifted)
+    valid = is_quad_a & is_quad_b
+    inter = _convex_quads_intersection(quads_a[valid], quads_b[valid])
+    inter_shapely = [Polygon(a).intersection(Polygon(b)).area for a, b, v in zip(quads, shifted, valid) if v]
+    assert np.allclose(inter, inter_shapely)
+
+    # one prediction matched, one duplicated match neither TP nor FP, one mostly on an ignored region, one FP
+    gt = [{'polys': quads[0], 'ignore': False}, {'polys': quads[1], 'ignore': True}, {'polys': quads[2], 'ignore': False}]
+    preds = [quads[0] + 1, quads[0] - 1, quads[1], quads[0] + 500]
+    gt_labels, det_labels = DetectionIoUEvaluator()(gt, preds)
+    assert gt_labels == [1, 1, 0]
+    assert det_labels == [1, 0, 1]
+
+    # the same with ragged polygons
+    from mindocr.utils.polygons import RaggedPolygons
+    ragged_gt = RaggedPolygons.from_polys(quads[:3], ignore=[False, True, False])
+    assert DetectionIoUEvaluator()(ragged_gt, RaggedPolygons.from_polys(preds)) == (gt_labels, det_labels)
+
+
+def test_det_metric_state_merge():
+    # two samples: 2 gts with 1 matched and 1 FP; 1 gt matched
+    gt_labels = [[1, 1, 0], [1]]
+    det_labels = [[1, 0, 1], [1]]
+    state = DetMetricState().update(gt_labels, det_labels)
+    assert (state.num_gt, state.num_tp, state.num_fp) == (3, 2, 1)
+
+    merged = DetMetricState().update(gt_labels[:1], det_labels[:1])
+    merged.merge(DetMetricState.from_array(DetMetricState().update(gt_labels[1:], det_labels[1:]).to_array()))
+    assert merged.compute() == state.compute()
+
+    res = state.compute()
+    assert np.isclose(res['recall'], 2 / 3) and np.isclose(res['precision'], 2 / 3) and np.isclose(res['f-score'], 2 / 3)
+    assert DetMetricState().compute() == {'recall': 0., 'precision': 0., 'f-score': 0.}
+
+
+def test_det_metric_num_workers():
+    rng = np.random.RandomState(0)
+    batches = []
+    for _ in range(5):
+        # 2 images of 8 gt quads each, predicted with noise, some missed and some false positives
+        xy = rng.uniform(0, 400, (2, 8, 1, 2))
+        wh = rng.uniform(20, 60, (2, 8, 1, 2))
+        polys = np.concatenate([xy, xy + wh * [1, 0], xy + wh, xy + wh * [0, 1]], axis=2).astype(np.float32)
+        ignore = rng.rand(2, 8) < 0.1
+        boxes = [np.concatenate([p[rng.rand(8) < 0.8] + rng.normal(0, 5, (1, 2)),
+                                 rng.uniform(0, 400, (2, 1, 2)) + [[0, 0], [30, 0], [30, 30], [0, 30]]])
+                 for p in polys]
+        scores = [np.full(len(b), 0.9) for b in boxes]
+        batches.append(({'polygons': boxes, 'scores': scores}, (polys, ignore)))
+
+    results = []
+    for num_workers in [0, 2]:
+        m = DetMetric(num_workers=num_workers)
+        for preds, gt in batches:
+            m.update(preds, gt)
+        results.append(m.eval())
+        m.close()
+        assert m._pool is None
+    print(results)
+    assert results[0] == results[1]
+    assert 0 < results[0]['recall'] < 1 and 0 < results[0]['precision'] < 1
+
+
+def test_rec_metric():
+    gt = np.array(['ba xla la!    ', 'ba       ', 'Abcdefgh'])
+    gt_len = np.array([len('ba xla la!'), len('ba'), len('Abcdefgh')])
+    pred = ['balala', 'ba', 'abcdxfgh']
+
+    m = RecMetric(length_buckets=[5])
+    m.update({'texts': pred}, (gt, gt_len))
+    res = m.eval()
+    print(res)
+    # 'ba xla la!' -> 'baxlala', 'Abcdefgh' -> 'abcdefgh'
+    assert np.isclose(res['acc'], 1 / 3)
+    assert np.isclose(res['norm_edit_distance'], 1 - (1 / 7 + 1 / 8) / 3)
+    assert np.isclose(res['acc_len_0-5'], 1.0) and np.isclose(res['acc_len_6+'], 0.0)
+
+
 if __name__=='__main__':
     test_det_metric()
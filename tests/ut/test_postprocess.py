@@ -1,10 +1,12 @@
 import sys
 sys.path.append('.')
 
+import cv2
 import numpy as np
 
 from mindocr.data.det_dataset import DetDataset
 from mindocr.postprocess.det_postprocess import DBPostprocess
+from mindocr.postprocess.rec_postprocess import RecCTCLabelDecode
 
 
 def test_det_db_postprocess():
@@ -26,5 +28,131 @@ def test_det_db_postprocess():
     res = proc({'binary': bmap})
     print(res)
 
+def _synthetic_prob_map(num_texts=50, h=320, w=320, seed=0):
+    rng = np.random.RandomState(seed)
+    pred = rng.uniform(0, 0.1, (1, 1, h, w)).astype(np.float32)
+    for _ in range(num_texts):
+        rect = (tuple(rng.uniform(20, min(h, w) - 20, 2)), (rng.uniform(10, 60), rng.uniform(6, 20)), rng.uniform(-30, 30))
+        cv2.fillPoly(pred[0, 0], [cv2.boxPoints(rect).astype(np.int32)], float(rng.uniform(0.4, 1.0)))
+    return pred
+
+
+def test_det_db_postprocess_batch_engine():
+    pred = _synthetic_prob_map()
+    res_loop = DBPostprocess(box_thresh=0.5, engine='loop')({'binary': pred})
+    res_batch = DBPostprocess(box_thresh=0.5, engine='batch')({'binary': pred})
+
+    boxes_loop = res_loop['polygons'][0][res_loop['scores'][0] > 0].astype(np.float32)
+    boxes_batch = res_batch['polygons'][0][res_batch['scores'][0] > 0].astype(np.float32)
+    print('num boxes: ', len(boxes_loop), len(boxes_batch))
+    assert len(boxes_loop) == len(boxes_batch)
+    # each box should have a counterpart differing in about one pixel (pyclipper rounding)
+    diff = np.abs(boxes_loop[:, None] - boxes_batch[None]).max(axis=(2, 3))
+    assert diff.min(axis=1).max() <= 2
+
+
+def test_det_db_postprocess_cc_extractor():
+    pred = _synthetic_prob_map()
+    res_contour = DBPostprocess(box_thresh=0.5, region_extractor='contour')({'binary': pred})
+    res_cc = DBPostprocess(box_thresh=0.5, region_extractor='cc')({'binary': pred})
+
+    boxes_contour = res_contour['polygons'][0][res_contour['scores'][0] > 0]
+    boxes_cc = res_cc['polygons'][0][res_cc['scores'][0] > 0]
+    assert len(boxes_cc) == len(boxes_contour)
+    assert np.array_equal(np.sort(boxes_cc.reshape(len(boxes_cc), -1), axis=0),
+                          np.sort(boxes_contour.reshape(len(boxes_contour), -1), axis=0))
+
+
+def test_det_db_postprocess_num_workers():
+    pred = np.concatenate([_synthetic_prob_map(num_texts=10 * (i + 1), seed=i) for i in range(6)])
+    for region_type in ['quad', 'poly']:
+        res_serial = DBPostprocess(box_thresh=0.5, region_type=region_type, num_workers=0)({'binary': pred})
+        proc = DBPostprocess(box_thresh=0.5, region_type=region_type, num_workers=4)
+        res_parallel = proc({'binary': pred})
+        proc.close()
+        assert proc._pool is None
+        # the same results in the order of the images
+        assert len(res_parallel['polygons']) == len(res_serial['polygons']) == 6
+        for boxes_s, boxes_p, scores_s, scores_p in zip(res_serial['polygons'], res_parallel['polygons'],
+                                                         res_serial['scores'], res_parallel['scores']):
+            assert len(boxes_s) == len(boxes_p)
+            assert all(np.array_equal(a, b) for a, b in zip(boxes_s, boxes_p))
+            assert np.array_equal(scores_s, scores_p)
+
+
+def test_det_db_postprocess_ragged():
+    from mindocr.utils.polygons import RaggedPolygons
+    pred = _synthetic_prob_map()
+    polys = DBPostprocess(box_thresh=0.5, region_type='poly')({'binary': pred})['polygons'][0]
+    ragged = DBPostprocess(box_thresh=0.5, region_type='poly', ragged=True)({'binary': pred})['polygons'][0]
+    assert isinstance(polys, list) and isinstance(ragged, RaggedPolygons)
+    assert len(polys) == len(ragged) > 0
+    assert all(np.array_equal(a, b) for a, b in zip(polys, ragged))
+
+
+def test_rec_ctc_decode():
+    dec = RecCTCLabelDecode()
+    blank = dec.blank_idx
+    idx = np.array([[0, 0, 1, blank, 1, 10, blank],
+                    [blank] * 7,
+                    [11, blank, 11, 11, 12, blank, blank]])
+    prob = np.full(idx.shape, 0.5)
+    prob[0, 0] = 1.0
+
+    texts, confs = dec.decode(idx, prob, remove_duplicate=True)
+    assert texts == ['011a', '', 'bbc']
+    assert np.allclose(confs, [(1.0 + 0.5 * 3) / 4, 0, 0.5])
+
+    texts, _ = dec.decode(idx, prob, remove_duplicate=False)
+    assert texts == ['0011a', '', 'bbbc']
+
+    # empty batch
+    assert dec.decode(np.zeros((0, 7), dtype=np.int64), np.zeros((0, 7)), remove_duplicate=True) == ([], [])
+    assert dec.decode(np.zeros((0, 7), dtype=np.int64)) == ([], [])
+
+
+def test_rec_ctc_beam_search(tmp_path):
+    chars = '0123456789abcdefghijklmnopqrstuvwxyz'
+    # [W, BS, C] probabilities, greedy decoding gives 'hellp'
+    preds = np.full((12, 1, len(chars) + 1), 0.01)
+    for t, c in enumerate('hh-e-l-l-pp-'):
+        if c == '-':
+            preds[t, 0, -1] = 0.6
+        else:
+            preds[t, 0, chars.index(c)] = 0.6
+        if c == 'p':
+            preds[t, 0, chars.index('o')] = 0.3
+    preds /= preds.sum(axis=-1, keepdims=True)
+
+    greedy = RecCTCLabelDecode()(preds)
+    beam = RecCTCLabelDecode(decode_mode='beam_search', beam_width=5)(preds)
+    assert greedy['texts'] == beam['texts'] == ['hellp']
+
+    lexicon_path = tmp_path / 'lexicon.txt'
+    lexicon_path.write_text('hello\nworld\nhe\n')
+    lex = RecCTCLabelDecode(decode_mode='beam_search', beam_width=5, lexicon_path=str(lexicon_path))(preds)
+    print(lex)
+    assert lex['texts'] == ['hello']
+    assert 0 < lex['confs'][0] < 1
+
+
+def test_rec_ctc_beam_search_repeats(tmp_path):
+    chars = '0123456789abcdefghijklmnopqrstuvwxyz'
+    # a char repeated over several frames collapses into one, with and without the lexicon
+    preds = np.full((6, 1, len(chars) + 1), 0.01)
+    for t, c in enumerate('aaabb-'):
+        preds[t, 0, -1 if c == '-' else chars.index(c)] = 0.8
+    preds /= preds.sum(axis=-1, keepdims=True)
+
+    beam = RecCTCLabelDecode(decode_mode='beam_search', beam_width=5)(preds)
+    lexicon_path = tmp_path / 'lexicon.txt'
+    lexicon_path.write_text('ab\nac\n')
+    lex = RecCTCLabelDecode(decode_mode='beam_search', beam_width=5, lexicon_path=str(lexicon_path))(preds)
+    print(beam, lex)
+    assert beam['texts'] == lex['texts'] == ['ab']
+    assert lex['confs'][0] > 0.1
+    assert np.isclose(lex['confs'][0], beam['confs'][0], rtol=1e-3)
+
+
 if __name__=='__main__':
     test_det_db_postprocess()
@@ -1,8 +1,12 @@
 import sys
 sys.path.append('.')
 
+import json
+import cv2
 import numpy as np
-from mindocr.data.transforms.transforms_factory import NormalizeImage, ToCHWImage
+from mindocr.data.transforms.transforms_factory import NormalizeImage, ToCHWImage, NormalizeToCHW, create_transforms, run_transforms
+from mindocr.data.transforms.general_transforms import DecodeImage, jpeg_size
+from mindocr.data.transforms.det_transforms import MakeBorderMap, MakeShrinkMap, edge_distance_map, shrink_convex_quads
 
 def test_norm():
     mean = [123.675, 116.28, 103.53]
@@ -31,5 +35,211 @@ def test_norm():
     assert np.allclose(out_img[0,0], correct), 'Incorrect norm'
 
 
+def test_fused_norm_to_chw():
+    pipeline = [{'NormalizeImage': {'mean': [123.675, 116.28, 103.53], 'std': [58.395, 57.12, 57.375],
+                                    'is_hwc': True, 'bgr_to_rgb': True}},
+                {'ToCHWImage': None}]
+    fused = create_transforms(pipeline)
+    assert len(fused) == 1 and isinstance(fused[0], NormalizeToCHW)
+    unfused = create_transforms(pipeline, fuse=False)
+
+    img = np.random.randint(0, 256, (17, 23, 3), dtype=np.uint8)
+    out = run_transforms({'image': img}, fused)['image']
+    correct = run_transforms({'image': img}, unfused)['image']
+    assert out.shape == (3, 17, 23) and out.flags['C_CONTIGUOUS']
+    assert np.array_equal(out, correct)
+
+    out = NormalizeToCHW.from_transforms(unfused[0], dtype='float16')({'image': img})['image']
+    assert out.dtype == np.float16 and np.array_equal(out, correct.astype(np.float16))
+
+
+def test_decode_reduced():
+    img = cv2.GaussianBlur(np.random.randint(0, 256, (400, 600, 3), dtype=np.uint8), (9, 9), 0)
+    buf = cv2.imencode('.jpg', img)[1].tobytes()
+    assert jpeg_size(buf) == (400, 600)
+    assert jpeg_size(cv2.imencode('.png', img)[1].tobytes()) is None
+
+    for backend in ['cv2', 'pil']:
+        full = DecodeImage(backend=backend)({'img_lmdb': buf})['image']
+        assert full.shape == (400, 600, 3)
+        data = DecodeImage(backend=backend, target_max_side=140)({'img_lmdb': buf, 'polys': np.array([[[600, 400]]], dtype=np.float32)})
+        # 600 / 4 = 150 >= 140, 600 / 8 < 140
+        assert data['image'].shape == (100, 150, 3)
+        assert data['decode_scale'] == (0.25, 0.25)
+        assert np.allclose(data['polys'], [[[150, 100]]])
+        correct = cv2.resize(full, (150, 100), interpolation=cv2.INTER_AREA)
+        assert np.abs(data['image'].astype(np.float32) - correct).mean() < 5
+
+
+def test_decode_reduced_det_labels():
+    # a bright box on a dark JPEG image, labeled after decoding as in the det pipelines
+    img = np.full((400, 600, 3), 20, dtype=np.uint8)
+    img[100:200, 240:480] = 230
+    buf = cv2.imencode('.jpg', img)[1].tobytes()
+    label = json.dumps([{'transcription': 'box', 'points': [[240, 100], [480, 100], [480, 200], [240, 200]]}])
+
+    for ragged in [False, True]:
+        transforms = create_transforms([{'DecodeImage': {'target_max_side': 140}},
+                                        {'DetLabelEncode': {'ragged': ragged}}])
+        data = run_transforms({'img_lmdb': buf, 'label': label}, transforms)
+        image, polys = data['image'], np.asarray(data['polys'][0])
+        assert image.shape == (100, 150, 3)
+        assert np.allclose(polys, [[60, 25], [120, 25], [120, 50], [60, 50]])
+        # the polygon covers the box in the decoded image
+        (x0, y0), (x1, y1) = polys.min(axis=0).astype(int), polys.max(axis=0).astype(int)
+        assert image[y0 + 1: y1 - 1, x0 + 1: x1 - 1].mean() > 200
+        assert image[y1 + 2:].mean() < 50 and image[:, x1 + 2:].mean() < 50
+
+
 if __name__ == '__main__':    
     test_norm()
+
+
+def test_edge_distance_map():
+    polygon = np.array([[3.3, 2.7], [40.2, 5.1], [44.6, 20.8], [25.5, 30.2], [2.1, 18.4]])
+    height, width = 35, 50
+    # reference: per-edge distance of the original MakeBorderMap, min over the edges
+    xs = np.broadcast_to(np.linspace(0, width - 1, num=width).reshape(1, width), (height, width))
+    ys = np.broadcast_to(np.linspace(0, height - 1, num=height).reshape(height, 1), (height, width))
+    ref = np.min([MakeBorderMap()._distance(xs, ys, polygon[i], polygon[(i + 1) % len(polygon)])
+                  for i in range(len(polygon))], axis=0)
+
+    exact = edge_distance_map(polygon, height, width)
+    assert exact.dtype == np.float32 and exact.shape == (height, width)
+    assert np.allclose(exact, ref, atol=1e-4), np.abs(exact - ref).max()
+
+    approx = edge_distance_map(polygon, height, width, mode='approx')
+    print('approx mean abs diff: ', np.abs(approx - ref).mean())
+    assert np.abs(approx - ref).mean() < 0.5
+
+
+def test_shrink_convex_quads():
+    import pyclipper
+    from shapely.geometry import Polygon
+    polys = [np.array([[10.3, 10.7], [90.2, 12.1], [88.9, 40.6], [11.5, 38.2]]),
+             np.array([[120.6, 80.1], [60.4, 82.9], [61.7, 50.3], [118.8, 49.5]]),  # clockwise
+             np.array([[10, 60], [50, 60], [30, 65], [10, 90]]),  # not convex
+             np.array([[10, 100], [30, 100], [40, 110], [30, 120], [10, 120]])]  # not a quad
+    shrunk = shrink_convex_quads(polys, 0.4)
+    assert shrunk[2] is None and shrunk[3] is None
+
+    for polygon, quad in zip(polys[:2], shrunk[:2]):
+        shape = Polygon(polygon)
+        padding = pyclipper.PyclipperOffset()
+        padding.AddPath([tuple(l) for l in polygon], pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
+        expected = np.array(padding.Execute(-shape.area * (1 - 0.4 ** 2) / shape.length)[0]).reshape(-1, 2)
+        print(quad, expected)
+        assert sorted(map(tuple, quad)) == sorted(map(tuple, expected))
+
+    # overlapped polygons are filled as a union
+    data = {'image': np.zeros((60, 60, 3), dtype=np.uint8), 'ignore_tags': [False, False],
+            'polys': [np.array([[5., 5.], [40., 5.], [40., 40.], [5., 40.]]),
+                      np.array([[20., 20.], [55., 20.], [55., 55.], [20., 55.]])]}
+    shrink_map = MakeShrinkMap()(data)['shrink_map']
+    assert shrink_map[30, 30] == 1 and shrink_map[12, 12] == 1 and shrink_map[48, 48] == 1
+
+
+def test_random_affine_crop():
+    from mindocr.data.transforms.modelzoo_transforms import MZRandomScaleByShortSide, MZRandomCropData, MZRandomAffineCrop
+    from mindocr.data.transforms.iaa_augment import IaaAugment
+    img = cv2.GaussianBlur((np.random.RandomState(0).rand(360, 640, 3) * 255).astype(np.uint8), (0, 0), 3)
+    polys = np.array([[[20, 30], [120, 30], [120, 60], [20, 60]],
+                      [[300, 200], [420, 210], [415, 250], [298, 240]],
+                      [[500, 100], [600, 100], [600, 130], [500, 130]]], dtype=np.float32)
+    data = {'image': img, 'polys': polys, 'ignore_tags': [False, True, False]}
+
+    # with a fixed rotation and flip, the single warp gives the same result as the chain of transforms
+    chain = [MZRandomScaleByShortSide(short_side=736),
+             IaaAugment([{'type': 'Affine', 'args': {'rotate': [7, 7]}}, {'type': 'Fliplr', 'args': {'p': 1}}]),
+             MZRandomCropData(max_tries=100, crop_size=(640, 640))]
+    composed = MZRandomAffineCrop(short_side=736, rotate=(7, 7), flip_prob=1, max_tries=100, crop_size=(640, 640))
+    for seed in range(3):
+        np.random.seed(seed)
+        expected = {k: np.copy(v) if isinstance(v, np.ndarray) else list(v) for k, v in data.items()}
+        for transform in chain:
+            expected = transform(expected)
+        np.random.seed(seed)
+        out = composed({k: np.copy(v) if isinstance(v, np.ndarray) else list(v) for k, v in data.items()})
+
+        assert out['image'].shape == expected['image'].shape == (640, 640, 3)
+        assert out['ignore_tags'] == expected['ignore_tags']
+        assert np.allclose(out['polys'], expected['polys'], atol=1e-2)
+        diff = np.abs(out['image'].astype(np.float32) - expected['image'])
+        print('image mean abs diff: ', diff.mean())
+        assert diff.mean() < 2
+
+
+def test_ragged_polygons():
+    from mindocr.utils.polygons import RaggedPolygons
+    polys = [np.array([[0, 0], [10, 0], [10, 5], [0, 5]]), np.array([[20, 20], [30, 20], [40, 25], [30, 30], [20, 30]])]
+    ragged = RaggedPolygons.from_polys(polys, ignore=[False, True])
+    assert len(ragged) == 2 and ragged.num_points().tolist() == [4, 5]
+    assert np.array_equal(ragged[1], polys[1])
+    assert np.allclose(ragged.areas(), [50, 150])
+    assert np.allclose(ragged.reverse([True, False]).areas(), [-50, 150])
+    assert np.allclose(ragged.bboxes(), [[0, 0, 10, 5], [20, 20, 40, 30]])
+    assert ragged.outside_rect(12, 0, 100, 100).tolist() == [True, False]
+
+    moved = ragged.transform([[1, 0, 5], [0, 2, 1]])
+    assert moved.ignore is ragged.ignore
+    assert np.allclose(moved[0], [[5, 1], [15, 1], [15, 11], [5, 11]])
+    assert np.allclose(ragged.clip(25, 25)[1][2], [24, 24])
+
+    selected = ragged[np.array([False, True])]
+    assert len(selected) == 1 and selected.ignore.tolist() == [True]
+    padded = ragged.to_padded()
+    assert padded.shape == (2, 5, 2) and np.array_equal(padded[0, 4], [0, 5])
+    assert len(ragged[[]]) == 0 and ragged[[]].to_padded().shape == (0, 0, 2)
+
+    # the transforms keep the ragged polygons, with the same result as the padded ones
+    data = {'image': np.zeros((60, 80, 3), dtype=np.uint8), 'polys': RaggedPolygons.from_polys(polys[:1] * 2),
+            'ignore_tags': np.array([False, False])}
+    expected = MakeShrinkMap()({'image': data['image'], 'polys': data['polys'].to_padded(), 'ignore_tags': [False, False]})
+    out = MakeShrinkMap()(data)
+    assert isinstance(out['polys'], RaggedPolygons)
+    assert np.array_equal(out['shrink_map'], expected['shrink_map'])
+
+
+def test_transform_profiler(tmp_path):
+    import multiprocessing
+    from mindocr.data.transforms.profiler import TransformProfiler, load_transform_profile, report_transform_profile
+    transforms = create_transforms([{'NormalizeImage': {'is_hwc': True}}, {'ToCHWImage': None}], fuse=False)
+    profiler = TransformProfiler(str(tmp_path), flush_interval=0.)
+    data = {'image': np.zeros((32, 48, 3), dtype=np.uint8)}
+    run_transforms(dict(data), transforms, profiler=profiler)
+
+    # statistics of the forked processes are aggregated, without counting the ones of the parent again
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=run_transforms, args=(dict(data), transforms, False, profiler)) for _ in range(2)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    profile = load_transform_profile(str(tmp_path))
+    assert profile['NormalizeImage']['num_calls'] == 3 and profile['ToCHWImage']['num_calls'] == 3
+    assert profile['NormalizeImage']['peak_bytes'] == 32 * 48 * 3 * 4
+    print(report_transform_profile(str(tmp_path), str(tmp_path / 'report.json')))
+    assert (tmp_path / 'report.json').exists()
+
+
+def test_key_schema():
+    import pytest
+    from mindocr.data.transforms.general_transforms import DropKeys
+    from mindocr.data.transforms.key_schema import get_output_keys
+    pipeline = [{'DetLabelEncode': None}, {'NormalizeImage': {'is_hwc': True}}, {'ToCHWImage': None}]
+    label = '[{"transcription": "ab", "points": [[0, 0], [10, 0], [10, 5], [0, 5]]}]'
+    transforms = create_transforms(pipeline, input_keys=['image', 'label', 'extra'], output_keys=['image', 'polys'])
+    # unused keys are dropped first, the label and the unused label keys after the label encoding
+    assert [t.keys for t in transforms if isinstance(t, DropKeys)] == [['extra'], ['label', 'texts', 'ignore_tags']]
+    assert get_output_keys(transforms, ['image', 'label', 'extra']) == ['image', 'polys']
+    data = run_transforms({'image': np.zeros((8, 12, 3), dtype=np.uint8), 'label': label, 'extra': 1}, transforms)
+    assert sorted(data.keys()) == ['image', 'polys'] and data['image'].shape == (3, 8, 12)
+
+    with pytest.raises(ValueError):
+        create_transforms(pipeline, input_keys=['image', 'label'], output_keys=['image', 'shrink_map'])
+
+    # a transform without key_schema may use any key, the keys before it are kept
+    transforms = create_transforms([{'DetLabelEncode': None}, lambda data: data, {'ToCHWImage': None}],
+                                   input_keys=['image', 'label'], output_keys=['image'])
+    assert get_output_keys(transforms, ['image', 'label']) is None
+    assert [t.keys for t in transforms if isinstance(t, DropKeys)] == [['label', 'polys', 'texts', 'ignore_tags']]
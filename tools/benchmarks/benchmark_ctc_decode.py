@@ -0,0 +1,59 @@
+'''
+Benchmark the decoding modes of RecCTCLabelDecode on random CTC probabilities.
+
+Example:
+    python tools/benchmarks/benchmark_ctc_decode.py --batch_size 64 --seq_len 25 --beam_width 10
+'''
+import sys
+sys.path.append('.')
+
+import argparse
+import time
+import numpy as np
+
+from mindocr.postprocess.rec_postprocess import RecCTCLabelDecode
+
+
+def random_preds(seq_len, batch_size, num_classes, seed=0):
+    ''' softmax probabilities in shape [W, BS, C], peaked like the output of a trained model '''
+    rng = np.random.default_rng(seed)
+    logits = rng.normal(size=(seq_len, batch_size, num_classes)).astype(np.float32) * 4
+    probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return probs / probs.sum(axis=-1, keepdims=True)
+
+
+def timeit(decoder, preds, repeats):
+    decoder(preds)  # warm up
+    start = time.time()
+    for _ in range(repeats):
+        res = decoder(preds)
+    return (time.time() - start) / repeats, res
+
+
+def main(args):
+    greedy = RecCTCLabelDecode(character_dict_path=args.character_dict_path, use_space_char=args.use_space_char)
+    beam = RecCTCLabelDecode(character_dict_path=args.character_dict_path, use_space_char=args.use_space_char,
+                             decode_mode='beam_search', beam_width=args.beam_width, lexicon_path=args.lexicon_path)
+    preds = random_preds(args.seq_len, args.batch_size, greedy.num_classes)
+
+    greedy_time, greedy_res = timeit(greedy, preds, args.repeats)
+    beam_time, beam_res = timeit(beam, preds, args.repeats)
+    num_diff = sum(g != b for g, b in zip(greedy_res['texts'], beam_res['texts']))
+
+    print(f'batch size {args.batch_size}, seq len {args.seq_len}, num classes {greedy.num_classes}')
+    print(f'greedy: {greedy_time * 1000:.2f} ms/batch')
+    print(f'beam search (width {args.beam_width}): {beam_time * 1000:.2f} ms/batch, '
+          f'{beam_time / greedy_time:.1f}x greedy, {num_diff}/{args.batch_size} texts differ from greedy')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CTC decoding benchmark')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--seq_len', type=int, default=25)
+    parser.add_argument('--beam_width', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--character_dict_path', type=str, default=None)
+    parser.add_argument('--use_space_char', action='store_true')
+    parser.add_argument('--lexicon_path', type=str, default=None)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,64 @@
+'''
+Benchmark the image decoding cost of DecodeImage per backend, at full resolution and with the target_max_side hint.
+
+Example:
+    python tools/benchmarks/benchmark_decode.py --image_dir /path/to/ic15/det/test/ch4_test_images --target_max_side 960
+'''
+import sys
+sys.path.append('.')
+
+import argparse
+import glob
+import os
+import time
+
+from mindocr.data.transforms.general_transforms import DecodeImage
+
+
+def load_buffers(image_dir, num_images):
+    paths = []
+    for ext in ['jpg', 'jpeg', 'JPG', 'png', 'bmp']:
+        paths += glob.glob(os.path.join(image_dir, f'**/*.{ext}'), recursive=True)
+    paths = sorted(paths)[:num_images]
+    if len(paths) == 0:
+        raise ValueError(f'No image found in {image_dir}')
+    buffers = []
+    for p in paths:
+        with open(p, 'rb') as f:
+            buffers.append(f.read())
+    return buffers
+
+
+def timeit(decoder, buffers, repeats):
+    start = time.time()
+    for _ in range(repeats):
+        for buf in buffers:
+            decoder({'img_lmdb': buf})
+    return (time.time() - start) / (repeats * len(buffers))
+
+
+def main(args):
+    buffers = load_buffers(args.image_dir, args.num_images)
+    print(f'{len(buffers)} images, {sum(len(b) for b in buffers) / len(buffers) / 1024:.1f} KB on average')
+
+    for backend in ['cv2', 'pil', 'turbojpeg']:
+        try:
+            full = DecodeImage(backend=backend)
+            reduced = DecodeImage(backend=backend, target_max_side=args.target_max_side)
+        except ImportError as e:
+            print(f'{backend}: skipped, {e}')
+            continue
+        full_time = timeit(full, buffers, args.repeats)
+        reduced_time = timeit(reduced, buffers, args.repeats)
+        print(f'{backend}: full resolution {full_time * 1000:.2f} ms/image, '
+              f'target_max_side={args.target_max_side} {reduced_time * 1000:.2f} ms/image')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Image decoding benchmark')
+    parser.add_argument('--image_dir', type=str, required=True, help='Directory of the sample images, searched recursively')
+    parser.add_argument('--num_images', type=int, default=100)
+    parser.add_argument('--target_max_side', type=int, default=960)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    main(args)
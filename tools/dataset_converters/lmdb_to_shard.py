@@ -0,0 +1,65 @@
+'''
+Script to pack LMDB recognition datasets into shard files, which are read by RecShardDataset.
+
+Each LMDB dataset (a leaf folder containing data.mdb) under `lmdb_dir` is converted to one shard file, keeping the
+relative folder structure, e.g., `lmdb_dir/MJ/MJ_train` -> `output_dir/MJ/MJ_train.shard`.
+
+Example:
+>>> python tools/dataset_converters/lmdb_to_shard.py \
+        --lmdb_dir /path/to/data_lmdb_release/training \
+        --output_dir /path/to/data_shard_release/training
+'''
+import sys
+sys.path.append('.')
+
+import argparse
+import os
+import lmdb
+
+from mindocr.data.rec_shard_dataset import write_rec_shard, SHARD_EXT
+
+
+def iter_lmdb_samples(lmdb_path):
+    ''' yield (image bytes, label) of the samples in an LMDB dataset, skipping the ones without label or image '''
+    env = lmdb.open(lmdb_path, readonly=True, lock=False, readahead=True, meminit=False)
+    with env.begin(write=False) as txn:
+        num_samples = int(txn.get('num-samples'.encode()))
+        for index in range(1, num_samples + 1):
+            label = txn.get('label-%09d'.encode() % index)
+            img = txn.get('image-%09d'.encode() % index)
+            if label is None or img is None:
+                print(f'WARNING: sample {index} in {lmdb_path} is incomplete, skipped.')
+                continue
+            yield img, label.decode('utf-8')
+    env.close()
+
+
+def convert(lmdb_dir, output_dir):
+    lmdb_dir = os.path.normpath(lmdb_dir)
+    for dirpath, dirnames, filenames in os.walk(lmdb_dir):
+        if 'data.mdb' not in filenames:
+            continue
+        rel_path = os.path.relpath(dirpath, lmdb_dir)
+        if rel_path == '.':
+            rel_path = os.path.basename(lmdb_dir)
+        shard_path = os.path.join(output_dir, rel_path + SHARD_EXT)
+        os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+        num_samples = write_rec_shard(shard_path, iter_lmdb_samples(dirpath))
+        print(f'{dirpath} -> {shard_path}, {num_samples} samples')
+    print('Conversion complete.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--lmdb_dir',
+        type=str,
+        required=True,
+        help='Directory of the LMDB dataset(s), searched recursively')
+    parser.add_argument(
+        '--output_dir',
+        type=str,
+        required=True,
+        help='Directory to save the shard files')
+    args = parser.parse_args()
+    convert(args.lmdb_dir, args.output_dir)
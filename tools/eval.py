@@ -62,6 +62,7 @@ def main(cfg):
     print('='*40)
  
     measures = net_evaluator.eval(loader_eval)
+    net_evaluator.close()
     print('Performance: ', measures)
 
 
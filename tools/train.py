@@ -25,7 +25,7 @@ from mindocr.postprocess import build_postprocess
 from mindocr.metrics import build_metric
 from mindocr.utils.model_wrapper import NetWithLossWrapper
 from mindocr.utils.train_step_wrapper import TrainOneStepWrapper 
-from mindocr.utils.callbacks import EvalSaveCallback
+from mindocr.utils.callbacks import EvalSaveCallback, TransformProfileCallback
 from mindocr.utils.seed import set_seed
 
 def main(cfg):
@@ -132,7 +132,10 @@ def main(cfg):
     time_monitor = TimeMonitor()
 
     model = ms.Model(train_net)
-    model.train(cfg.scheduler.num_epochs, loader_train, callbacks=[loss_monitor, time_monitor, eval_cb],
+    callbacks = [loss_monitor, time_monitor, eval_cb]
+    if cfg.train.dataset.get('transform_profile_dir') and is_main_device:
+        callbacks.append(TransformProfileCallback(cfg.train.dataset.transform_profile_dir))
+    model.train(cfg.scheduler.num_epochs, loader_train, callbacks=callbacks,
                 dataset_sink_mode=cfg.train.dataset_sink_mode)
 
 